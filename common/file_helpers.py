@@ -6,6 +6,10 @@ import zstandard as zstd
 
 LOG_COMPRESSION_LEVEL = 10 # little benefit up to level 15. level ~17 is a small step change
 
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+# larger files aren't compressed for upload, this bounds the temporary compressed copy
+MAX_COMPRESS_SIZE = 200 * 1024 * 1024
+
 
 class CallbackReader:
   """Wraps a file, but overrides the read method to also
@@ -47,12 +51,21 @@ def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.Buffered
     file_stream = open(filepath, "rb")
     return file_stream, file_size
 
-  # Compress the file on the fly
-  compressed_stream = io.BytesIO()
-  compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
-
+  # Upload URLs need a Content-Length and chunked transfer isn't accepted, so the compressed size has to be known up front.
+  # Compress once, in blocks, into an unnamed temporary file next to the original. Memory stays bounded and
+  # the copy is at most about MAX_COMPRESS_SIZE.
   with open(filepath, "rb") as f:
-    compressor.copy_stream(f, compressed_stream)
-    compressed_size = compressed_stream.tell()
-    compressed_stream.seek(0)
-    return compressed_stream, compressed_size
+    file_size = os.fstat(f.fileno()).st_size
+    if file_size > MAX_COMPRESS_SIZE:
+      raise ValueError(f"{filepath} is too large to compress for upload ({file_size} bytes)")
+
+    compressed_stream = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filepath)))
+    try:
+      zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL).copy_stream(f, compressed_stream, size=file_size,
+                                                                   read_size=UPLOAD_BLOCK_SIZE, write_size=UPLOAD_BLOCK_SIZE)
+    except BaseException:
+      compressed_stream.close()
+      raise
+  compressed_size = compressed_stream.tell()
+  compressed_stream.seek(0)
+  return compressed_stream, compressed_size
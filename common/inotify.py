@@ -0,0 +1,61 @@
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+
+# from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify:
+  """Minimal inotify wrapper to watch directories for file events, Linux only"""
+  def __init__(self) -> None:
+    self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(self._libc, "inotify_init1"):
+      raise OSError("inotify not available")
+
+    self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.watches: dict[int, str] = {}
+
+  def add_watch(self, path: str, mask: int) -> None:
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+    self.watches[wd] = path
+
+  def read(self, timeout: float | None = None) -> list[tuple[str, int, str]]:
+    """Returns events as (watched path, mask, file name), waits up to timeout seconds for them"""
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    try:
+      buf = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    events = []
+    pos = 0
+    while pos < len(buf):
+      wd, mask, _, length = _EVENT.unpack_from(buf, pos)
+      pos += _EVENT.size
+      name = os.fsdecode(buf[pos:pos + length].rstrip(b"\0"))
+      pos += length
+      # the watch was removed, explicitly or because the watched path is gone
+      path = self.watches.pop(wd, "") if mask & IN_IGNORED else self.watches.get(wd, "")
+      events.append((path, mask, name))
+    return events
+
+  def close(self) -> None:
+    os.close(self.fd)
@@ -36,7 +36,13 @@ class SwagFormatter(logging.Formatter):
     self.swaglogger = swaglogger
     self.host = socket.gethostname()
 
-  def format_dict(self, record):
+  def record_local_ctx(self, record):
+    # handlers formatting on another thread capture the thread local context at emit time
+    if hasattr(record, 'swag_local_ctx'):
+      return record.swag_local_ctx or {}
+    return self.swaglogger.local_ctx()
+
+  def format_dict(self, record, include_ctx=True):
     record_dict = NiceOrderedDict()
 
     if isinstance(record.msg, dict):
@@ -47,7 +53,8 @@ class SwagFormatter(logging.Formatter):
       except (ValueError, TypeError):
         record_dict['msg'] = [record.msg]+record.args
 
-    record_dict['ctx'] = self.swaglogger.get_ctx()
+    if include_ctx:
+      record_dict['ctx'] = dict(self.record_local_ctx(record), **self.swaglogger.global_ctx)
 
     if record.exc_info:
       record_dict['exc_info'] = self.formatException(record.exc_info)
@@ -71,7 +78,13 @@ class SwagFormatter(logging.Formatter):
   def format(self, record):
     if self.swaglogger is None:
       raise Exception("must set swaglogger before calling format()")
-    return json_robust_dumps(self.format_dict(record))
+    if self.record_local_ctx(record):
+      return json_robust_dumps(self.format_dict(record))
+
+    # only the global context, splice in its cached JSON after msg
+    record_dict = self.format_dict(record, include_ctx=False)
+    msg = json_robust_dumps(record_dict.pop('msg'))
+    return f'{{"msg": {msg}, "ctx": {self.swaglogger.global_ctx_json()}, {json_robust_dumps(record_dict)[1:]}'
 
 class SwagLogFileFormatter(SwagFormatter):
   def fix_kv(self, k, v):
@@ -126,6 +139,7 @@ class SwagLogger(logging.Logger):
     logging.Logger.__init__(self, "swaglog")
 
     self.global_ctx = {}
+    self._global_ctx_json = None
 
     self.log_local = local()
     self.log_local.ctx = {}
@@ -155,6 +169,14 @@ class SwagLogger(logging.Logger):
 
   def bind_global(self, **kwargs):
     self.global_ctx.update(kwargs)
+    self._global_ctx_json = None
+
+  def global_ctx_json(self):
+    # the global context rarely changes, only serialize it once
+    ctx_json = self._global_ctx_json
+    if ctx_json is None:
+      ctx_json = self._global_ctx_json = json_robust_dumps(self.global_ctx)
+    return ctx_json
 
   def event(self, event, *args, **kwargs):
     evt = NiceOrderedDict()
@@ -1,8 +1,159 @@
+import os
+import threading
+from collections import defaultdict
+from collections.abc import Callable
+
+from openpilot.common.inotify import IN_CLOSE_WRITE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
 from openpilot.common.params_pyx import Params, ParamKeyType, UnknownKeyName
+from openpilot.common.swaglog import cloudlog
 assert Params
 assert ParamKeyType
 assert UnknownKeyName
 
+PARAMS_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF
+
+
+class CachedParams:
+  """
+  Opt-in Params view for keys that are polled in loops. Values are kept in memory and invalidated by an
+  inotify watch on the params directory, so a get on an unchanged key doesn't touch the filesystem.
+  Callbacks subscribed to a key are called from the watcher thread when it changes.
+  Without inotify every get falls through to Params.
+  """
+  def __init__(self, d: str = ""):
+    self.params = Params(d)
+    self.cache: dict[bytes, bytes | None] = {}
+    self.subscribers: dict[bytes, list[Callable[[str], None]]] = defaultdict(list)
+    # bumped on every invalidation, so a read racing with a change isn't cached
+    self.generation = 0
+    self.lock = threading.Lock()
+
+    self.exit_event = threading.Event()
+    self.thread: threading.Thread | None = None
+    try:
+      self.inotify: Inotify | None = Inotify()
+      self.inotify.add_watch(os.path.realpath(self.params.get_param_path()), PARAMS_WATCH_MASK)
+    except OSError:
+      self.inotify = None
+    else:
+      self.thread = threading.Thread(target=self.watch_thread, name="params_watcher", daemon=True)
+      self.thread.start()
+
+  def __getattr__(self, name):
+    # everything that isn't cached goes to Params
+    if name == "params":
+      raise AttributeError(name)
+    return getattr(self.params, name)
+
+  def close(self) -> None:
+    if self.thread is not None:
+      self.exit_event.set()
+      self.thread.join()
+      self.thread = None
+    if self.inotify is not None:
+      self.inotify.close()
+      self.inotify = None
+
+  def watch_thread(self) -> None:
+    while not self.exit_event.is_set():
+      for _, mask, name in self.inotify.read(timeout=0.1):
+        if mask & IN_DELETE_SELF:
+          self.forget_all()
+        elif mask & IN_IGNORED:
+          # the watch is gone with the directory, always after IN_DELETE_SELF
+          if not self.rewatch():
+            return
+        elif mask & IN_Q_OVERFLOW:
+          self.invalidate_all()
+        else:
+          self.invalidate(os.fsencode(name))
+
+  def rewatch(self) -> bool:
+    """The params directory is gone, e.g. replaced. Watches the current one, or stops caching if there is none"""
+    try:
+      self.inotify.add_watch(os.path.realpath(self.params.get_param_path()), PARAMS_WATCH_MASK)
+    except OSError:
+      cloudlog.exception("params: lost the params directory watch, reading without cache")
+      inotify, self.inotify = self.inotify, None
+      self.invalidate_all()
+      inotify.close()
+      return False
+    self.invalidate_all()
+    return True
+
+  def forget(self, key: bytes) -> None:
+    with self.lock:
+      self.generation += 1
+      self.cache.pop(key, None)
+
+  def forget_all(self) -> None:
+    with self.lock:
+      self.generation += 1
+      self.cache.clear()
+
+  @staticmethod
+  def notify(key: bytes, callbacks: list[Callable[[str], None]]) -> None:
+    # a failing callback must not stop the watcher
+    for callback in callbacks:
+      try:
+        callback(key.decode())
+      except Exception:
+        cloudlog.exception(f"params: subscriber callback for {key.decode()} failed")
+
+  def invalidate(self, key: bytes) -> None:
+    self.forget(key)
+    self.notify(key, self.subscribers.get(key, []))
+
+  def invalidate_all(self) -> None:
+    self.forget_all()
+    for key, callbacks in list(self.subscribers.items()):
+      self.notify(key, callbacks)
+
+  def subscribe(self, key, callback: Callable[[str], None]) -> None:
+    """callback(key) is called from the watcher thread after the param changed or was removed"""
+    self.subscribers[self.params.check_key(key)].append(callback)
+
+  def get(self, key, block: bool = False, encoding: str | None = None):
+    k = self.params.check_key(key)
+    if block or self.inotify is None:
+      return self.params.get(k, block=block, encoding=encoding)
+
+    try:
+      val = self.cache[k]
+    except KeyError:
+      generation = self.generation
+      val = self.params.get(k)
+      with self.lock:
+        if generation == self.generation:
+          self.cache[k] = val
+
+    if val is None or encoding is None:
+      return val
+    return val.decode(encoding)
+
+  def get_bool(self, key, block: bool = False) -> bool:
+    if block or self.inotify is None:
+      return self.params.get_bool(key, block=block)
+    return self.get(key) == b"1"
+
+  # own writes are visible right away, subscribers are still notified by the watcher
+  def put(self, key, dat) -> None:
+    self.params.put(key, dat)
+    self.forget(self.params.check_key(key))
+
+  def put_bool(self, key, val: bool) -> None:
+    self.params.put_bool(key, val)
+    self.forget(self.params.check_key(key))
+
+  def remove(self, key) -> None:
+    self.params.remove(key)
+    self.forget(self.params.check_key(key))
+
+  def clear_all(self, tx_type=ParamKeyType.ALL) -> None:
+    self.params.clear_all(tx_type)
+    self.forget_all()
+
+
 if __name__ == "__main__":
   import sys
 
@@ -1,7 +1,9 @@
 import logging
 import os
+import threading
 import time
 import warnings
+from collections import deque
 from pathlib import Path
 from logging.handlers import BaseRotatingHandler
 
@@ -10,6 +12,16 @@ import zmq
 from openpilot.common.logging_extra import SwagLogger, SwagFormatter, SwagLogFileFormatter
 from openpilot.system.hardware.hw import Paths
 
+# async IPC handler, records are formatted and sent in batches off the logging thread
+SWAGLOG_ASYNC = os.getenv("SWAGLOG_ASYNC") is not None
+SWAGLOG_QUEUE_SIZE = int(os.getenv("SWAGLOG_QUEUE_SIZE", "1000"))
+SWAGLOG_BATCH_INTERVAL = 0.01  # seconds
+
+
+class DropPolicy:
+  OLDEST = 'oldest'
+  NEWEST = 'newest'
+
 
 def get_file_handler():
   Path(Paths.swaglog_root()).mkdir(parents=True, exist_ok=True)
@@ -24,7 +36,8 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
     self.interval = interval # seconds
     self.max_bytes = max_bytes
     self.backup_count = backup_count
-    self.log_files = self.get_existing_logfiles()
+    # newest first, kept up to date on rollover instead of listing the directory
+    self.log_files = deque(reversed(self.get_existing_logfiles()))
     log_indexes = [f.split(".")[-1] for f in self.log_files]
     self.last_file_idx = max([int(i) for i in log_indexes if i.isdigit()] or [-1])
     self.last_rollover = None
@@ -35,16 +48,15 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
     self.last_file_idx += 1
     next_filename = f"{self.base_filename}.{self.last_file_idx:010}"
     stream = open(next_filename, self.mode, encoding=self.encoding)
-    self.log_files.insert(0, next_filename)
+    self.log_files.appendleft(next_filename)
     return stream
 
   def get_existing_logfiles(self):
     log_files = list()
-    base_dir = os.path.dirname(self.base_filename)
-    for fn in os.listdir(base_dir):
-      fp = os.path.join(base_dir, fn)
-      if fp.startswith(self.base_filename) and os.path.isfile(fp):
-        log_files.append(fp)
+    with os.scandir(os.path.dirname(self.base_filename)) as entries:
+      for entry in entries:
+        if entry.path.startswith(self.base_filename) and entry.is_file():
+          log_files.append(entry.path)
     return sorted(log_files)
 
   def shouldRollover(self, record):
@@ -60,8 +72,53 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
     if self.backup_count > 0:
       while len(self.log_files) > self.backup_count:
         to_delete = self.log_files.pop()
-        if os.path.exists(to_delete): # just being safe, should always exist
+        try:
           os.remove(to_delete)
+        except FileNotFoundError: # just being safe, should always exist
+          pass
+
+  def emit_batch(self, records):
+    """
+    Writes records with one write per log file, instead of a write and rollover check per record.
+    Returns the number of records that were dropped, a record that fails to format doesn't take the rest with it.
+    """
+    dropped = 0
+    written = 0
+    if len(records) == 0:
+      return dropped
+
+    try:
+      if self.stream is None or self.shouldRollover(None):
+        self.doRollover()
+
+      size = self.stream.tell()
+      lines = []
+      for record in records:
+        try:
+          line = self.format(record) + self.terminator
+        except Exception:
+          self.handleError(record)
+          dropped += 1
+          continue
+
+        lines.append(line)
+        size += len(line)
+        if self.max_bytes > 0 and size >= self.max_bytes:
+          self.stream.write("".join(lines))
+          written += len(lines)
+          lines.clear()
+          self.doRollover()
+          size = 0
+
+      if len(lines) > 0:
+        self.stream.write("".join(lines))
+        written += len(lines)
+      self.flush()
+    except Exception:
+      # the file is broken, whatever wasn't written yet is lost
+      self.handleError(records[min(written + dropped, len(records) - 1)])
+      return len(records) - written
+    return dropped
 
 class UnixDomainSocketHandler(logging.Handler):
   def __init__(self, formatter):
@@ -72,6 +129,10 @@ class UnixDomainSocketHandler(logging.Handler):
     self.zctx = None
     self.sock = None
 
+    # records dropped by this process, reported to logmessaged with a swaglog_dropped event
+    self.dropped = 0
+    self.reported_dropped = 0
+
   def __del__(self):
     self.close()
 
@@ -87,6 +148,7 @@ class UnixDomainSocketHandler(logging.Handler):
     self.sock.setsockopt(zmq.LINGER, 10)
     self.sock.connect(Paths.swaglog_ipc())
     self.pid = os.getpid()
+    self.dropped = self.reported_dropped = 0
 
   def emit(self, record):
     if os.getpid() != self.pid:
@@ -94,14 +156,104 @@ class UnixDomainSocketHandler(logging.Handler):
       warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<zmq.*>")
       self.connect()
 
+    self.report_dropped()
+    if not self.send(record):
+      # drop :/ it's reported with the next record that gets through
+      self.dropped += 1
+
+  def send(self, record):
     msg = self.format(record).rstrip('\n')
     # print("SEND".format(repr(msg)))
     try:
       s = chr(record.levelno)+msg
       self.sock.send(s.encode('utf8'), zmq.NOBLOCK)
+      return True
     except zmq.error.Again:
-      # drop :/
-      pass
+      return False
+
+  def report_dropped(self):
+    dropped = self.dropped - self.reported_dropped
+    if dropped > 0:
+      record = self.formatter.swaglogger.makeRecord(self.formatter.swaglogger.name, logging.WARNING, __file__, 0,
+                                                    {'event': 'swaglog_dropped', 'count': dropped}, None, None)
+      if self.send(record):
+        self.reported_dropped += dropped
+
+
+class AsyncUnixDomainSocketHandler(UnixDomainSocketHandler):
+  """
+  Puts records on a bounded queue, a background thread formats and sends them in batches.
+  emit only captures the thread local context and appends, so its cost doesn't depend on the record.
+  When the queue is full, either the oldest queued or the new record is dropped.
+  """
+  def __init__(self, formatter, max_queue=SWAGLOG_QUEUE_SIZE, drop_policy=DropPolicy.OLDEST, interval=SWAGLOG_BATCH_INTERVAL):
+    super().__init__(formatter)
+    assert drop_policy in (DropPolicy.OLDEST, DropPolicy.NEWEST)
+    self.max_queue = max_queue
+    self.drop_policy = drop_policy
+    self.interval = interval
+
+    # deque appends and pops are atomic, the caller never waits on the sender
+    self.queue = deque(maxlen=max_queue if drop_policy == DropPolicy.OLDEST else None)
+
+    self.send_lock = threading.Lock()
+    self.exit_event = threading.Event()
+    self.thread = None
+    self.thread_pid = None
+
+  def close(self):
+    if self.thread is not None and self.thread_pid == os.getpid():
+      self.exit_event.set()
+      self.thread.join()
+    self.thread = None
+    self.thread_pid = None
+    super().close()
+
+  def start(self):
+    # connect before queueing, so drops in a forked process are counted from here on
+    self.connect()
+    # the lock might have been held by the parent's sender when forking
+    self.send_lock = threading.Lock()
+    self.exit_event.clear()
+    self.thread = threading.Thread(target=self.send_thread, name="swaglog", daemon=True)
+    self.thread_pid = os.getpid()
+    self.thread.start()
+
+  def handle(self, record):
+    # skip the handler lock, the queue is thread safe
+    rv = self.filter(record)
+    if rv:
+      self.emit(record)
+    return rv
+
+  def emit(self, record):
+    if os.getpid() != self.thread_pid:
+      self.queue.clear()
+      self.start()
+
+    local_ctx = self.formatter.swaglogger.local_ctx()
+    record.swag_local_ctx = dict(local_ctx) if local_ctx else None
+
+    if len(self.queue) >= self.max_queue:
+      self.dropped += 1
+      if self.drop_policy == DropPolicy.NEWEST:
+        return
+    self.queue.append(record)
+
+  def flush(self):
+    # queue drops are reported together with the socket drops
+    with self.send_lock:
+      while len(self.queue) > 0:
+        record = self.queue.popleft()
+        try:
+          super().emit(record)
+        except Exception:
+          self.handleError(record)
+
+  def send_thread(self):
+    while not self.exit_event.wait(self.interval):
+      self.flush()
+    self.flush()
 
 
 class ForwardingHandler(logging.Handler):
@@ -137,7 +289,10 @@ elif print_level == 'info':
 elif print_level == 'warning':
   outhandler.setLevel(logging.WARNING)
 
-ipchandler = UnixDomainSocketHandler(SwagFormatter(log))
+if SWAGLOG_ASYNC:
+  ipchandler = AsyncUnixDomainSocketHandler(SwagFormatter(log), drop_policy=os.getenv("SWAGLOG_DROP", DropPolicy.OLDEST))
+else:
+  ipchandler = UnixDomainSocketHandler(SwagFormatter(log))
 
 log.addHandler(outhandler)
 # logs are sent through IPC before writing to disk to prevent disk I/O blocking
@@ -1,7 +1,10 @@
 import os
+import pytest
+import zstandard as zstd
 from uuid import uuid4
 
-from openpilot.common.file_helpers import atomic_write_in_dir
+import openpilot.common.file_helpers as file_helpers
+from openpilot.common.file_helpers import atomic_write_in_dir, get_upload_stream
 
 
 class TestFileHelpers:
@@ -17,3 +20,36 @@ class TestFileHelpers:
 
   def test_atomic_write_in_dir(self):
     self.run_atomic_write_func(atomic_write_in_dir)
+
+  def test_compressed_upload_stream(self, tmp_path):
+    path = str(tmp_path / "rlog")
+    contents = os.urandom(1024 * 1024) + b"\0" * (3 * 1024 * 1024)
+    with open(path, "wb") as f:
+      f.write(contents)
+
+    for _ in range(2):
+      stream, size = get_upload_stream(path, True)
+      try:
+        compressed = b"".join(iter(lambda: stream.read(8192), b""))
+      finally:
+        stream.close()
+
+      assert len(compressed) == size < len(contents)
+      assert zstd.ZstdDecompressor().decompressobj().decompress(compressed) == contents
+      # the compressed copy isn't left behind for the uploader to find
+      assert os.listdir(tmp_path) == ["rlog"]
+
+  def test_compressed_upload_too_large(self, tmp_path, monkeypatch):
+    path = str(tmp_path / "rlog")
+    with open(path, "wb") as f:
+      f.write(b"\0" * 1024)
+
+    monkeypatch.setattr(file_helpers, "MAX_COMPRESS_SIZE", 1023)
+    with pytest.raises(ValueError):
+      get_upload_stream(path, True)
+    assert os.listdir(tmp_path) == ["rlog"]
+
+    # uncompressed uploads aren't limited
+    stream, size = get_upload_stream(path, False)
+    stream.close()
+    assert size == 1024
@@ -0,0 +1,48 @@
+import os
+
+from openpilot.common.inotify import IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_MOVED_TO, Inotify
+
+
+class TestInotify:
+  def test_events(self, tmp_path):
+    inotify = Inotify()
+    try:
+      inotify.add_watch(str(tmp_path), IN_CREATE | IN_DELETE | IN_MOVED_TO)
+      assert inotify.read(0) == []
+
+      (tmp_path / "a").touch()
+      os.rename(tmp_path / "a", tmp_path / "b")
+      os.unlink(tmp_path / "b")
+
+      events = []
+      while len(events) < 3 and (new_events := inotify.read(1)):
+        events += new_events
+      assert events == [(str(tmp_path), IN_CREATE, "a"), (str(tmp_path), IN_MOVED_TO, "b"), (str(tmp_path), IN_DELETE, "b")]
+    finally:
+      inotify.close()
+
+  def test_undecodable_name(self, tmp_path):
+    inotify = Inotify()
+    try:
+      inotify.add_watch(str(tmp_path), IN_CREATE)
+      name = os.fsdecode(b"\xff\xfe")
+      (tmp_path / name).touch()
+      assert inotify.read(1) == [(str(tmp_path), IN_CREATE, name)]
+    finally:
+      inotify.close()
+
+  def test_watched_dir_removed(self, tmp_path):
+    inotify = Inotify()
+    try:
+      path = str(tmp_path / "watched")
+      os.mkdir(path)
+      inotify.add_watch(path, IN_DELETE_SELF)
+      os.rmdir(path)
+
+      events = []
+      while len(events) < 2 and (new_events := inotify.read(1)):
+        events += new_events
+      assert events == [(path, IN_DELETE_SELF, ""), (path, IN_IGNORED, "")]
+      assert inotify.watches == {}
+    finally:
+      inotify.close()
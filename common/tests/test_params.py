@@ -1,10 +1,31 @@
 import pytest
 import os
+import shutil
 import threading
 import time
 import uuid
 
-from openpilot.common.params import Params, ParamKeyType, UnknownKeyName
+from openpilot.common.params import CachedParams, Params, ParamKeyType, UnknownKeyName
+
+
+class CountingParams:
+  def __init__(self, params):
+    self.params = params
+    self.gets = 0
+
+  def __getattr__(self, name):
+    return getattr(self.params, name)
+
+  def get(self, *args, **kwargs):
+    self.gets += 1
+    return self.params.get(*args, **kwargs)
+
+
+def wait_for(condition, timeout=1.0):
+  start = time.monotonic()
+  while not condition() and time.monotonic() - start < timeout:
+    time.sleep(0.01)
+  return condition()
 
 class TestParams:
   def setup_method(self):
@@ -107,3 +128,104 @@ class TestParams:
     assert len(keys) > 20
     assert len(keys) == len(set(keys))
     assert b"CarParams" in keys
+
+
+class TestCachedParams:
+  def setup_method(self):
+    self.params = Params()
+    self.cached = CachedParams()
+
+  def teardown_method(self):
+    self.cached.close()
+
+  def test_get(self):
+    self.params.put("DongleId", "cb38263377b873ee")
+    assert self.cached.get("DongleId") == b"cb38263377b873ee"
+    assert self.cached.get("DongleId", encoding="utf-8") == "cb38263377b873ee"
+
+    # changed by another process
+    self.params.put("DongleId", "bob")
+    assert wait_for(lambda: self.cached.get("DongleId") == b"bob")
+    self.params.remove("DongleId")
+    assert wait_for(lambda: self.cached.get("DongleId") is None)
+
+    # own writes are visible right away
+    self.cached.put_bool("IsMetric", True)
+    assert self.cached.get_bool("IsMetric")
+    self.cached.put_bool("IsMetric", False)
+    assert not self.cached.get_bool("IsMetric")
+
+    with pytest.raises(UnknownKeyName):
+      self.cached.get("swag")
+
+  def test_subscribe(self):
+    changed = []
+    self.cached.subscribe("IsMetric", changed.append)
+    self.params.put_bool("IsMetric", True)
+    self.params.put("DongleId", "bob")
+    assert wait_for(lambda: len(changed) > 0)
+    assert set(changed) == {"IsMetric"}
+
+  def test_subscriber_raises(self):
+    def fail(key):
+      raise RuntimeError(key)
+
+    changed = []
+    self.cached.subscribe("IsMetric", fail)
+    self.cached.subscribe("IsMetric", changed.append)
+    self.params.put_bool("IsMetric", True)
+    assert wait_for(lambda: changed == ["IsMetric"])
+
+    # the watcher keeps invalidating
+    assert self.cached.get_bool("IsMetric")
+    self.params.put_bool("IsMetric", False)
+    assert wait_for(lambda: not self.cached.get_bool("IsMetric"))
+    assert self.cached.thread.is_alive()
+
+  def test_params_dir_replaced(self):
+    path = os.path.realpath(self.params.get_param_path())
+    changed = []
+    self.cached.subscribe("IsMetric", changed.append)
+    self.params.put_bool("IsMetric", True)
+    assert self.cached.get_bool("IsMetric")
+    assert wait_for(lambda: len(changed) > 0)
+
+    # the new directory is in place by the time the watched one is deleted
+    changed.clear()
+    shutil.copytree(path, path + ".new")
+    os.rename(path, path + ".old")
+    os.rename(path + ".new", path)
+    shutil.rmtree(path + ".old")
+    assert wait_for(lambda: "IsMetric" in changed)
+
+    # the new directory is watched
+    self.params.put_bool("IsMetric", False)
+    assert wait_for(lambda: not self.cached.get_bool("IsMetric"))
+    changed.clear()
+    self.params.put_bool("IsMetric", True)
+    assert wait_for(lambda: changed == ["IsMetric"])
+    assert self.cached.get_bool("IsMetric")
+    assert self.cached.thread.is_alive()
+
+  def test_params_dir_removed(self):
+    path = os.path.realpath(self.params.get_param_path())
+    self.params.put_bool("IsMetric", True)
+    assert self.cached.get_bool("IsMetric")
+
+    # nothing to watch anymore, gets go to Params
+    shutil.rmtree(path)
+    assert wait_for(lambda: self.cached.inotify is None)
+    assert wait_for(lambda: not self.cached.thread.is_alive())
+    os.makedirs(path)
+    self.params.put_bool("IsMetric", False)
+    assert not self.cached.get_bool("IsMetric")
+
+  def test_cached_get_no_reads(self, monkeypatch):
+    self.params.put_bool("IsMetric", True)
+    assert self.cached.get_bool("IsMetric")
+
+    params = CountingParams(self.cached.params)
+    monkeypatch.setattr(self.cached, "params", params)
+    for _ in range(1000):
+      assert self.cached.get_bool("IsMetric")
+    assert params.gets == 0
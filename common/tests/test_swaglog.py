@@ -0,0 +1,142 @@
+import json
+import logging
+import zmq
+
+from openpilot.common.logging_extra import SwagLogger, SwagFormatter, SwagLogFileFormatter, json_robust_dumps
+from openpilot.common.swaglog import AsyncUnixDomainSocketHandler, DropPolicy, SwaglogRotatingFileHandler, UnixDomainSocketHandler
+from openpilot.system.hardware.hw import Paths
+
+
+class FlakySocket:
+  def __init__(self, sock, fail):
+    self.sock = sock
+    self.fail = fail
+
+  def send(self, dat, flags=0):
+    if self.fail > 0:
+      self.fail -= 1
+      raise zmq.error.Again
+    return self.sock.send(dat, flags)
+
+  def close(self):
+    self.sock.close()
+
+
+class TestSwaglog:
+  def setup_method(self):
+    self.log = SwagLogger()
+    self.log.setLevel(logging.DEBUG)
+    self.log.bind_global(dongle_id="test_dongle_id", version="0.0.0")
+
+    self.ctx = zmq.Context()
+    self.sock = self.ctx.socket(zmq.PULL)
+    self.sock.bind(Paths.swaglog_ipc())
+
+  def teardown_method(self):
+    self.sock.close()
+    self.ctx.term()
+
+  def recv_all(self, timeout=1.0):
+    msgs = []
+    poller = zmq.Poller()
+    poller.register(self.sock, zmq.POLLIN)
+    while poller.poll(timeout * 1000):
+      dat = self.sock.recv()
+      msgs.append((dat[0], json.loads(dat[1:].decode())))
+      timeout = 0.1
+    return msgs
+
+  def test_spliced_ctx(self):
+    formatter = SwagFormatter(self.log)
+    record = self.log.makeRecord(self.log.name, logging.INFO, __file__, 1, {'event': 'test', 'x': 1}, None, None)
+    assert formatter.format(record) == json_robust_dumps(formatter.format_dict(record))
+
+    with self.log.ctx(daemon="testy"):
+      msg = json.loads(formatter.format(record))
+    assert msg['ctx'] == {'daemon': "testy", 'dongle_id': "test_dongle_id", 'version': "0.0.0"}
+
+    self.log.bind_global(version="0.0.1")
+    assert json.loads(formatter.format(record))['ctx']['version'] == "0.0.1"
+
+  def test_async_handler(self):
+    handler = AsyncUnixDomainSocketHandler(SwagFormatter(self.log))
+    self.log.addHandler(handler)
+
+    for i in range(100):
+      if i % 2:
+        with self.log.ctx(i=i):
+          self.log.info("%d", i)
+      else:
+        self.log.warning("%d", i)
+    handler.close()
+
+    msgs = self.recv_all()
+    assert [int(m['msg']) for _, m in msgs] == list(range(100))
+    for level, m in msgs:
+      assert level == (logging.INFO if int(m['msg']) % 2 else logging.WARNING)
+      assert m['ctx'].get('i') == (int(m['msg']) if level == logging.INFO else None)
+      assert m['ctx']['dongle_id'] == "test_dongle_id"
+
+  def test_drop_policy(self):
+    for drop_policy, expected in ((DropPolicy.OLDEST, list(range(90, 100))), (DropPolicy.NEWEST, list(range(10)))):
+      # don't let the sender run until all records are queued
+      handler = AsyncUnixDomainSocketHandler(SwagFormatter(self.log), max_queue=10, drop_policy=drop_policy, interval=60)
+      self.log.addHandler(handler)
+      for i in range(100):
+        self.log.info("%d", i)
+      handler.flush()
+      self.log.removeHandler(handler)
+      handler.close()
+
+      msgs = [m for _, m in self.recv_all()]
+      assert msgs[0]['msg'] == {'event': 'swaglog_dropped', 'count': 90}
+      assert [int(m['msg']) for m in msgs[1:]] == expected
+
+  def test_socket_drops(self):
+    handler = UnixDomainSocketHandler(SwagFormatter(self.log))
+    handler.connect()
+    handler.sock = FlakySocket(handler.sock, 3)
+    self.log.addHandler(handler)
+    for i in range(5):
+      self.log.info("%d", i)
+    self.log.removeHandler(handler)
+    handler.close()
+
+    # the first report of the drops doesn't get through either
+    msgs = [m for _, m in self.recv_all()]
+    assert msgs[0]['msg'] == {'event': 'swaglog_dropped', 'count': 2}
+    assert [int(m['msg']) for m in msgs[1:]] == [2, 3, 4]
+
+  def test_emit_batch_bad_record(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(logging, "raiseExceptions", False)
+    handler = SwaglogRotatingFileHandler(str(tmp_path / "swaglog"))
+    handler.setFormatter(SwagLogFileFormatter(None))
+
+    records = [json.dumps({'msg': i}) for i in range(5)]
+    records.insert(2, "not json")
+    assert handler.emit_batch(records) == 1
+    handler.close()
+
+    with open(handler.log_files[0]) as f:
+      assert [json.loads(line)['msg$i'] for line in f] == list(range(5))
+
+  def test_emit_cost(self, monkeypatch):
+    # with the sender waiting, the caller must not pay for formatting or sending, even with a large record
+    handler = AsyncUnixDomainSocketHandler(SwagFormatter(self.log), max_queue=100, interval=60)
+    self.log.addHandler(handler)
+
+    def fail(record):
+      raise AssertionError("record formatted or sent by the caller")
+    monkeypatch.setattr(handler, "format", fail)
+    monkeypatch.setattr(handler, "send", fail)
+
+    big = {'event': 'big', 'data': list(range(10000))}
+    for _ in range(1000):
+      self.log.info(big)
+    assert len(handler.queue) == handler.max_queue
+    assert handler.dropped == 900
+
+    self.log.removeHandler(handler)
+    handler.queue.clear()
+    monkeypatch.undo()
+    handler.close()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+from openpilot.common.params import CachedParams, Params
+
+N_GETS = 1000
+
+
+def read_syscalls() -> int:
+  with open("/proc/self/io") as f:
+    return int(next(line for line in f if line.startswith("syscr")).split()[1])
+
+
+if __name__ == '__main__':
+  params = Params()
+  cached = CachedParams()
+  params.put_bool("IsMetric", True)
+  assert cached.get_bool("IsMetric")
+
+  for label, p in (("Params", params), ("CachedParams", cached)):
+    start = read_syscalls()
+    for _ in range(N_GETS):
+      p.get_bool("IsMetric")
+    # reading /proc/self/io is a few syscalls itself
+    print(f"{label}: {read_syscalls() - start} read syscalls for {N_GETS} gets")
+  cached.close()
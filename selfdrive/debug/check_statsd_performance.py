@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import zmq
+
+import openpilot.system.statsd as statsd
+from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT
+from openpilot.system.statsd import METRIC_TYPE, STATS_BATCH_SIZE, STATS_BATCH_TIME_S, QuantileSketch, StatLog, StatsDir, encode_metrics, decode_metrics, \
+                                    get_influxdb_line
+
+N_RUNS = 10
+N_SAMPLES = 100_000
+NAMES = [f"bench_metric_{i}" for i in range(10)]
+
+
+def run_string_protocol(points):
+  # the previous protocol: one string per point, samples kept in lists and sorted at flush
+  samples: dict[str, list[float]] = {}
+  for name, value in points:
+    metric = f"{name}:{value}|{METRIC_TYPE.SAMPLE}".encode()
+
+    metric = metric.decode()
+    metric_name = metric.split(':')[0]
+    metric_value = float(metric.split('|')[0].split(':')[1])
+    samples.setdefault(metric_name, []).append(metric_value)
+
+  for values in samples.values():
+    values.sort()
+    for percentile in [0.05, 0.5, 0.95]:
+      values[int(round(percentile * (len(values) - 1)))]
+
+
+def run_binary_protocol(points):
+  samples: dict[str, QuantileSketch] = {}
+  for i in range(0, len(points), STATS_BATCH_SIZE):
+    dat = encode_metrics([(METRIC_TYPE.SAMPLE, name, value) for name, value in points[i:i + STATS_BATCH_SIZE]])
+
+    for _, metric_name, metric_value in decode_metrics(dat):
+      if metric_name not in samples:
+        samples[metric_name] = QuantileSketch()
+      samples[metric_name].add(metric_value)
+
+  for sketch in samples.values():
+    for percentile in [0.05, 0.5, 0.95]:
+      sketch.quantile(percentile)
+
+
+def run_statlog_tail() -> float:
+  # seconds until the tail of a burst is received, should be about STATS_BATCH_TIME_S
+  with tempfile.TemporaryDirectory() as tmp:
+    statsd.STATS_SOCKET = f"ipc://{tmp}/stats"
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(statsd.STATS_SOCKET)
+
+    statlog = StatLog()
+    start_t = time.monotonic()
+    for i in range(10):
+      statlog.gauge("burst", i)
+
+    received = 0
+    while received < 10 and sock.poll(STATS_BATCH_TIME_S * 2 * 1000):
+      received += len(list(decode_metrics(sock.recv())))
+    elapsed = time.monotonic() - start_t
+    sock.close()
+    ctx.term()
+  assert received == 10
+  return elapsed
+
+
+def run_full_stats_dir() -> float:
+  # seconds to fill the last 100 slots of a stats dir and get refused 100 times, like a device that has been offline for long
+  with tempfile.TemporaryDirectory() as tmp:
+    for i in range(STATS_DIR_FILE_LIMIT - 100):
+      open(os.path.join(tmp, f"old_{i}"), "w").close()
+
+    stats_dir = StatsDir(tmp)
+    lines = "".join(get_influxdb_line(f"sample.metric_{i}", {'count': 10, 'mean': 1.}, ",started=True", '1000\n') for i in range(100))
+
+    start_t = time.monotonic()
+    written = 0
+    while stats_dir.write(f"new_{written}", lines):
+      written += 1
+    for _ in range(100):
+      stats_dir.write("full", lines)
+    elapsed = time.monotonic() - start_t
+    stats_dir.close()
+  assert written == 100
+  return elapsed
+
+
+if __name__ == '__main__':
+  points = [(random.choice(NAMES), random.uniform(0., 100.)) for _ in range(N_SAMPLES)]
+
+  for label, fn in (("string", run_string_protocol), ("binary", run_binary_protocol)):
+    ets = []
+    for _ in range(N_RUNS):
+      start_t = time.process_time_ns()
+      fn(points)
+      ets.append((time.process_time_ns() - start_t) * 1e-6)
+
+    print(f'{label} protocol, {N_SAMPLES} samples, {N_RUNS} runs')
+    print(f'  {np.mean(ets):.2f} mean ms, {max(ets):.2f} max ms, {min(ets):.2f} min ms, {np.std(ets):.2f} std ms')
+    print(f'  {N_SAMPLES / np.mean(ets) * 1e3:.0f} samples / s')
+
+  print(f'statlog burst tail received after {run_statlog_tail():.2f} s, batch time {STATS_BATCH_TIME_S:.2f} s')
+  print(f'full stats dir, 200 flushes in {run_full_stats_dir():.2f} s')
@@ -3,13 +3,18 @@ import sys
 import math
 import capnp
 import numbers
-import dictdiffer
+import numpy as np
 from collections import Counter
+from typing import Any
 
 from openpilot.tools.lib.logreader import LogReader
 
 EPSILON = sys.float_info.epsilon
 
+NUMERIC_TYPES = ('bool', 'int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64', 'float32', 'float64')
+# sub-structs this close to the root are compared by their serialized bytes first, deeper ones are walked directly
+BYTES_CHECK_DEPTH = 2
+
 
 def remove_ignored_fields(msg, ignore):
   msg = msg.as_builder()
@@ -39,6 +44,134 @@ def remove_ignored_fields(msg, ignore):
   return msg
 
 
+def _dotted(node):
+  # same path notation as dictdiffer
+  if all(isinstance(k, str) and '.' not in k for k in node):
+    return '.'.join(node)
+  return list(node)
+
+
+def _field_type(field):
+  proto = field.proto
+  return 'group' if proto.which() == 'group' else proto.slot.type.which()
+
+
+def _are_different(a, b):
+  # dictdiffer semantics, nan is equal to nan
+  if a == b:
+    return False
+  a_nan, b_nan = a != a, b != b
+  if a_nan or b_nan:
+    return not (a_nan and b_nan)
+  return True
+
+
+def _to_dict(value, typ, list_type=None):
+  # same values as to_dict(verbose=True)
+  if typ in ('struct', 'group'):
+    return value.to_dict(verbose=True)
+  elif typ == 'list':
+    elem_type = list_type.elementType
+    return [_to_dict(v, elem_type.which(), elem_type.list if elem_type.which() == 'list' else None) for v in value]
+  elif typ == 'enum':
+    return str(value)
+  elif typ == 'void':
+    return None
+  return value
+
+
+class LogDiffer:
+  """
+  Compares capnp readers field by field against their schema, producing the same diff tuples as
+  dictdiffer on to_dict(verbose=True) of both messages, without building the dicts.
+  Ignored paths are skipped during the walk, identical sub-structs are skipped by comparing their bytes,
+  and numeric lists are compared vectorized.
+  """
+  def __init__(self, ignore_fields: list[str]):
+    self.ignore = set(ignore_fields)
+    # paths with an ignored descendant can't be compared by bytes
+    self.ignore_parents = {'.'.join(k.split('.')[:i]) for k in ignore_fields for i in range(len(k.split('.')))}
+    # schema node id -> (field types, non-union field names, has union), looked up once per struct type
+    self.schemas: dict[int, tuple[dict[str, tuple[str, Any]], list[str], bool]] = {}
+
+  def _schema_fields(self, schema):
+    node_id = schema.node.id
+    if node_id not in self.schemas:
+      fields = {}
+      for key, field in schema.fields.items():
+        typ = _field_type(field)
+        fields[key] = (typ, field.proto.slot.type.list if typ == 'list' else None)
+      self.schemas[node_id] = (fields, list(schema.non_union_fields), len(schema.union_fields) > 0)
+    return self.schemas[node_id]
+
+  def diff(self, msg1, msg2):
+    yield from self._diff_struct(msg1, msg2, [], 0)
+
+  def _diff_value(self, v1, v2, typ, list_type, node, depth):
+    if typ in ('struct', 'group'):
+      path = '.'.join(map(str, node))
+      if depth <= BYTES_CHECK_DEPTH and path not in self.ignore_parents and v1.as_builder().to_bytes() == v2.as_builder().to_bytes():
+        return
+      yield from self._diff_struct(v1, v2, node, depth)
+    elif typ == 'list':
+      yield from self._diff_list(v1, v2, list_type.elementType, node, depth)
+    else:
+      v1, v2 = _to_dict(v1, typ), _to_dict(v2, typ)
+      if _are_different(v1, v2):
+        yield "change", _dotted(node), (v1, v2)
+
+  def _diff_struct(self, r1, r2, node, depth):
+    fields, keys1, has_union = self._schema_fields(r1.schema)
+    keys2 = keys1
+    if has_union:
+      keys1, keys2 = [r1.which()] + keys1, [r2.which()] + keys2
+    prefix = '.'.join(map(str, node))
+    if prefix in self.ignore_parents:
+      keys1 = [k for k in keys1 if (f"{prefix}.{k}" if node else k) not in self.ignore]
+      keys2 = [k for k in keys2 if (f"{prefix}.{k}" if node else k) not in self.ignore]
+
+    for key in keys1:
+      if key not in keys2:
+        continue
+      typ, list_type = fields[key]
+      yield from self._diff_value(getattr(r1, key), getattr(r2, key), typ, list_type, node + [key], depth + 1)
+
+    # a different union member is active
+    addition = [k for k in keys2 if k not in keys1]
+    deletion = [k for k in keys1 if k not in keys2]
+    if addition:
+      yield "add", _dotted(node), [(k, self._field_to_dict(r2, k)) for k in addition]
+    if deletion:
+      yield "remove", _dotted(node), [(k, self._field_to_dict(r1, k)) for k in deletion]
+
+  def _field_to_dict(self, r, key):
+    typ, list_type = self._schema_fields(r.schema)[0][key]
+    return _to_dict(getattr(r, key), typ, list_type)
+
+  def _diff_list(self, l1, l2, elem_type, node, depth):
+    typ = elem_type.which()
+    list_type = elem_type.list if typ == 'list' else None
+    n1, n2 = len(l1), len(l2)
+    common = min(n1, n2)
+
+    if typ in NUMERIC_TYPES and common > 0:
+      a, b = np.array(list(l1)), np.array(list(l2))
+      different = a[:common] != b[:common]
+      if a.dtype.kind == 'f':
+        different &= ~(np.isnan(a[:common]) & np.isnan(b[:common]))
+      a_list, b_list = a.tolist(), b.tolist()
+      for i in np.flatnonzero(different).tolist():
+        yield "change", _dotted(node + [i]), (a_list[i], b_list[i])
+    else:
+      for i in range(common):
+        yield from self._diff_value(l1[i], l2[i], typ, list_type, node + [i], depth + 1)
+
+    if n2 > common:
+      yield "add", _dotted(node), [(i, _to_dict(l2[i], typ, list_type)) for i in range(common, n2)]
+    if n1 > common:
+      yield "remove", _dotted(node), [(i, _to_dict(l1[i], typ, list_type)) for i in reversed(range(common, n1))]
+
+
 def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
   if ignore_fields is None:
     ignore_fields = []
@@ -56,36 +189,29 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
+  # Absolute and relative tolerance for numbers
+  def outside_tolerance(diff):
+    try:
+      if diff[0] == "change":
+        a, b = diff[2]
+        finite = math.isfinite(a) and math.isfinite(b)
+        if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+          return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+    except TypeError:
+      pass
+    return True
+
+  differ = LogDiffer(ignore_fields)
   diff = []
   for msg1, msg2 in zip(log1, log2, strict=True):
     if msg1.which() != msg2.which():
       raise Exception("msgs not aligned between logs")
 
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
-
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
+    # identical messages are the common case, only walk the ones that differ. the differ skips ignored fields itself
+    if msg1.as_builder().to_bytes() == msg2.as_builder().to_bytes():
+      continue
 
-      diff.extend(dd)
+    diff.extend(filter(outside_tolerance, differ.diff(msg1, msg2)))
   return diff
 
 
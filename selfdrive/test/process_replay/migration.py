@@ -1,10 +1,14 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from collections.abc import Callable
+from hashlib import sha256
 import capnp
 import functools
+import glob
+import inspect
+import os
 import traceback
 
-from cereal import messaging, car, log
+from cereal import CEREAL_PATH, messaging, car, log
 from opendbc.car.fingerprints import MIGRATION
 from opendbc.car.toyota.values import EPS_SCALE, ToyotaSafetyFlags
 from opendbc.car.ford.values import CAR as FORD, FordFlags, FordSafetyFlags
@@ -15,12 +19,21 @@ from openpilot.selfdrive.modeld.fill_model_msg import fill_xyz_poly, fill_lane_l
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_encode_index
 from openpilot.selfdrive.controls.lib.longitudinal_planner import get_accel_from_plan, CONTROL_N_T_IDX
 from openpilot.system.manager.process_config import managed_processes
-from openpilot.tools.lib.logreader import LogIterable
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR
+from openpilot.tools.lib.logreader import LogIterable, LogReader, save_log
 
 MessageWithIndex = tuple[int, capnp.lib.capnp._DynamicStructReader]
 MigrationOps = tuple[list[tuple[int, capnp.lib.capnp._DynamicStructReader]], list[capnp.lib.capnp._DynamicStructReader], list[int]]
 MigrationFunc = Callable[[list[MessageWithIndex]], MigrationOps]
 
+# migrated logs are cached per source log and set of migrations, in memory and on disk
+MIGRATION_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "migrated")
+# least recently used logs are evicted once the cache dir is above this size
+MIGRATION_CACHE_SIZE_LIMIT = int(os.environ.get("MIGRATION_CACHE_SIZE_MB", "2000")) * 1000 * 1000
+MIGRATION_CACHE_EVICT_TARGET = 0.9
+MIGRATION_MEMORY_CACHE_SIZE = 4
+_migration_cache: OrderedDict[str, list[capnp.lib.capnp._DynamicStructReader]] = OrderedDict()
+
 
 # rules for migration functions
 # 1. must use the decorator @migration(inputs=[...], product="...") and MigrationFunc signature
@@ -52,7 +65,87 @@ def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: boo
   if camera_states:
     migrations.append(migrate_cameraStates)
 
-  return migrate(lr, migrations)
+  return migrate_cached(lr, migrations)
+
+
+def _source_files(func: MigrationFunc) -> set[str]:
+  # the module of the migration and of the helpers it calls, e.g. fill_xyz_poly
+  func = inspect.unwrap(func)
+  files = {inspect.getsourcefile(func)}
+  for name in func.__code__.co_names:
+    obj = func.__globals__.get(name)
+    if inspect.ismodule(obj) or inspect.isfunction(obj) or inspect.isclass(obj):
+      try:
+        files.add(inspect.getsourcefile(obj))
+      except TypeError:
+        pass  # builtin
+  files.discard(None)
+  return files
+
+
+@functools.cache
+def _files_hash(paths: tuple[str, ...]) -> str:
+  h = sha256()
+  for path in paths:
+    with open(path, "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+
+def migration_fingerprint(migration_funcs: list[MigrationFunc]) -> str:
+  # changes whenever the set of migrations, their code or the schema changes
+  names = ",".join(func.__name__ for func in migration_funcs)
+  sources = set().union(*(_source_files(func) for func in migration_funcs))
+  schemas = glob.glob(os.path.join(CEREAL_PATH, "*.capnp"))
+  return sha256(f"{names}:{_files_hash(tuple(sorted(sources | set(schemas))))}".encode()).hexdigest()
+
+
+def _evict_migration_cache() -> None:
+  # skips logs that are still being written by another process
+  with os.scandir(MIGRATION_CACHE_DIR) as it:
+    files = sorted((e.stat().st_mtime, e.path, e.stat().st_size) for e in it if e.is_file() and not e.name.endswith(".tmp.zst"))
+  size = sum(f[2] for f in files)
+  if size <= MIGRATION_CACHE_SIZE_LIMIT:
+    return
+
+  # mtime is the last use
+  for _, path, file_size in files:
+    if size <= MIGRATION_CACHE_SIZE_LIMIT * MIGRATION_CACHE_EVICT_TARGET:
+      break
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+    size -= file_size
+
+
+def migrate_cached(lr: LogIterable, migration_funcs: list[MigrationFunc]):
+  """migrate, reusing earlier results for logs that identify their events with a cache_key"""
+  source_key = getattr(lr, "cache_key", None)
+  if source_key is None:
+    return migrate(lr, migration_funcs)
+
+  key = sha256(f"{source_key}:{migration_fingerprint(migration_funcs)}".encode()).hexdigest()
+  if key in _migration_cache:
+    _migration_cache.move_to_end(key)
+    return list(_migration_cache[key])
+
+  path = os.path.join(MIGRATION_CACHE_DIR, f"{key}.zst")
+  if os.path.exists(path):
+    msgs = list(LogReader(path))
+    os.utime(path)
+  else:
+    msgs = migrate(lr, migration_funcs)
+    os.makedirs(MIGRATION_CACHE_DIR, exist_ok=True)
+    tmp_path = os.path.join(MIGRATION_CACHE_DIR, f"{key}.{os.getpid()}.tmp.zst")
+    save_log(tmp_path, msgs)
+    os.replace(tmp_path, path)
+    _evict_migration_cache()
+
+  _migration_cache[key] = msgs
+  if len(_migration_cache) > MIGRATION_MEMORY_CACHE_SIZE:
+    _migration_cache.popitem(last=False)
+  return list(msgs)
 
 
 def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
@@ -74,6 +167,12 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
     add_ops.extend(a_ops)
     del_ops.extend(d_ops)
 
+  # nothing migrated, skip the rebuild and the re-sort if already in order
+  if not (replace_ops or add_ops or del_ops):
+    mono_times = [msg.logMonoTime for msg in lr]
+    if all(a <= b for a, b in zip(mono_times, mono_times[1:], strict=False)):
+      return lr
+
   for index, msg in replace_ops:
     lr[index] = msg
   for index in sorted(del_ops, reverse=True):
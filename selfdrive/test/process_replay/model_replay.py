@@ -216,7 +216,7 @@ def get_frames():
   for fr in frs.values():
     for fidx in range(START_FRAME, END_FRAME):
       fr.get(fidx)
-    fr.it = None
+    fr.close()
   print(f"Dumping frame cache {cache_name}")
   pickle.dump(frs, open(cache_name, "wb"))
   return frs
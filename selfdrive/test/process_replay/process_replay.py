@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 import os
 import time
+import bisect
 import copy
 import heapq
+import multiprocessing
 import signal
 from collections import Counter, OrderedDict
 from dataclasses import dataclass, field
 from typing import Any
 from collections.abc import Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from tqdm import tqdm
 import capnp
 from openpilot.system.hardware.hw import Paths
@@ -652,10 +656,74 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
   return replay_process(cfgs, lr, *args, **kwargs)
 
 
+def get_process_groups(cfgs: list[ProcessConfig]) -> list[list[ProcessConfig]]:
+  """
+  Split processes into groups that don't feed each other, i.e. no process subscribes to anything published by a process of another group.
+  Groups and the processes within them keep the order of cfgs.
+  """
+  parent = list(range(len(cfgs)))
+
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  for i, a in enumerate(cfgs):
+    for j, b in enumerate(cfgs[:i]):
+      if set(a.subs) & set(b.pubs) or set(b.subs) & set(a.pubs):
+        parent[find(i)] = find(j)
+
+  groups: dict[int, list[ProcessConfig]] = {}
+  for i, cfg in enumerate(cfgs):
+    groups.setdefault(find(i), []).append(cfg)
+  return list(groups.values())
+
+
+def _replay_group(cfg_names: list[str], cfg_indices: list[int], msgs: list[bytes], frame_readers: dict[str, tuple[str, str]] | None,
+                  fingerprint: str | None, custom_params: dict[str, Any] | None,
+                  capture_output: bool) -> tuple[list[bytes], list[tuple], dict[str, dict[str, str]] | None]:
+  # runs in a spawned worker, everything is passed in picklable form and rebuilt here
+  cfgs = [get_process_config(name) for name in cfg_names]
+  lr = [messaging.log_from_bytes(dat) for dat in msgs]
+  captured_output_store: dict[str, dict[str, str]] | None = {} if capture_output else None
+  order_keys: list[tuple] = []
+  with ExitStack() as stack:
+    frs = {k: stack.enter_context(FrameReader(fn, pix_fmt=pix_fmt)) for k, (fn, pix_fmt) in frame_readers.items()} if frame_readers is not None else None
+    log_msgs = _replay_multi_process(cfgs, lr, frs, fingerprint, custom_params, captured_output_store, True, order_keys, cfg_indices)
+  return [m.as_builder().to_bytes() for m in log_msgs], order_keys, captured_output_store
+
+
+def _merge_group_outputs(outputs: list[tuple[list[bytes], list[tuple]]]) -> list[capnp._DynamicStructReader]:
+  # each message is keyed by the replay step that emitted it and the process it came from, which is the order of a serial replay
+  keyed = sorted(((key, dat) for group_msgs, order_keys in outputs for dat, key in zip(group_msgs, order_keys, strict=True)), key=lambda x: x[0])
+  return [messaging.log_from_bytes(dat) for _, dat in keyed]
+
+
+def _replay_process_groups(
+  cfgs: list[ProcessConfig], groups: list[list[ProcessConfig]], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, max_workers: int
+) -> list[capnp._DynamicStructReader]:
+  msgs = [m.as_builder().to_bytes() for m in lr]
+  frame_readers = {k: (fr.decoder.fn, fr.pix_fmt) for k, fr in frs.items()} if frs is not None else None
+
+  # spawned, not forked: the parent might already run threads (frame reader prefetch, executors) that a fork would break
+  with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+    futures = [executor.submit(_replay_group, [cfg.proc_name for cfg in group], [cfgs.index(cfg) for cfg in group], msgs, frame_readers,
+                               fingerprint, custom_params, captured_output_store is not None) for group in groups]
+    results = [future.result() for future in futures]
+
+  if captured_output_store is not None:
+    for _, _, group_output in results:
+      captured_output_store.update(group_output)
+
+  return _merge_group_outputs([(group_msgs, order_keys) for group_msgs, order_keys, _ in results])
+
+
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False, max_workers: int = 1
 ) -> list[capnp._DynamicStructReader]:
   if isinstance(cfg, Iterable):
     cfgs = list(cfg)
@@ -666,7 +734,15 @@ def replay_process(
                          manager_states=True,
                          panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
                          camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+
+  # opt-in: independent groups of processes are replayed concurrently in worker processes.
+  # workers rebuild their configs by name, so only unmodified CONFIGS can be replayed this way
+  groups = get_process_groups(cfgs)
+  max_workers = min(len(groups), max_workers)
+  if max_workers > 1 and all(cfg in CONFIGS for cfg in cfgs):
+    process_logs = _replay_process_groups(cfgs, groups, all_msgs, frs, fingerprint, custom_params, captured_output_store, max_workers)
+  else:
+    process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -682,8 +758,13 @@ def replay_process(
 
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  order_keys: list[tuple] | None = None, cfg_indices: list[int] | None = None
 ) -> list[capnp._DynamicStructReader]:
+  """
+  order_keys gets a key per output message, for merging the outputs of independent groups of processes
+  into the order a single replay of all of them would emit. cfg_indices are the positions of cfgs in that replay.
+  """
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
     env_config = generate_environ_config(fingerprint=fingerprint)
@@ -718,26 +799,45 @@ def _replay_multi_process(
     pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
     # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
     external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
+    external_pub_indices = [i for i, msg in enumerate(all_msgs) if msg.which() in lr_pubs]
     internal_pub_queue: list[capnp._DynamicStructReader] = []
     # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
     internal_pub_index_heap: list[tuple[int, int]] = []
 
+    # a step is ordered by the log message it runs before or on, see order_keys
+    all_mono_times = [msg.logMonoTime for msg in all_msgs]
+    internal_step_keys: list[tuple] = []
+    if cfg_indices is None:
+      cfg_indices = list(range(len(cfgs)))
+    container_indices = {id(container): cfg_index for container, cfg_index in zip(containers, cfg_indices, strict=True)}
+
     pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
     while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
       if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
         msg = external_pub_queue.pop(0)
+        external_index = external_pub_indices.pop(0)
+        step_key: tuple = (external_index, 1)
+        next_index = external_index + 1
         pbar.update(1)
       else:
         _, index = heapq.heappop(internal_pub_index_heap)
         msg = internal_pub_queue[index]
+        step_key = internal_step_keys[index]
+        next_index = step_key[0]
 
       target_containers = pubs_to_containers[msg.which()]
       for container in target_containers:
         output_msgs = container.run_step(msg, frs)
-        for m in output_msgs:
+        cfg_index = container_indices[id(container)]
+        for i, m in enumerate(output_msgs):
           if m.which() in all_pubs:
             internal_pub_queue.append(m)
             heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
+            # runs before the first log message that isn't earlier, but not before the current step.
+            # ties are broken like the heap does, by the order in which messages were produced
+            internal_step_keys.append((max(bisect.bisect_left(all_mono_times, m.logMonoTime), next_index), 0, m.logMonoTime, step_key, cfg_index, i))
+          if order_keys is not None:
+            order_keys.append(step_key + (cfg_index, i))
         log_msgs.extend(output_msgs)
   finally:
     for container in containers:
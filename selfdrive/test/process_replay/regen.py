@@ -33,17 +33,17 @@ def regen_segment(
 def setup_data_readers(
     route: str, sidx: int, needs_driver_cam: bool = True, needs_road_cam: bool = True, dummy_driver_cam: bool = False
 ) -> tuple[LogReader, dict[str, Any]]:
-  lr = LogReader(f"{route}/{sidx}/r")
+  lr = LogReader(f"{route}/{sidx}/r", use_index=True)
   frs = {}
   if needs_road_cam:
     frs['roadCameraState'] = FrameReader(get_url(route, str(sidx), "fcamera.hevc"))
-    if next((True for m in lr if m.which() == "wideRoadCameraState"), False):
+    if lr.first("wideRoadCameraState") is not None:
       frs['wideRoadCameraState'] = FrameReader(get_url(route, str(sidx), "ecamera.hevc"))
   if needs_driver_cam:
     if dummy_driver_cam:
       frs['driverCameraState'] = FrameReader(get_url(route, str(sidx), "fcamera.hevc")) # Use fcam as dummy
     else:
-      device_type = next(str(msg.initData.deviceType) for msg in lr if msg.which() == "initData")
+      device_type = str(lr.first("initData").deviceType)
       assert device_type != "neo", "Driver camera not supported on neo segments. Use dummy dcamera."
       frs['driverCameraState'] = FrameReader(get_url(route, str(sidx), "dcamera.hevc"))
 
@@ -73,7 +73,11 @@ def regen_and_save(
                                needs_driver_cam="driverCameraState" in all_vision_pubs,
                                needs_road_cam="roadCameraState" in all_vision_pubs or "wideRoadCameraState" in all_vision_pubs,
                                dummy_driver_cam=dummy_driver_cam)
-  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+  try:
+    output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+  finally:
+    for fr in frs.values():
+      fr.close()
 
   log_dir = os.path.join(outdir, time.strftime("%Y-%m-%d--%H-%M-%S--0", time.gmtime()))
   rel_log_dir = os.path.relpath(log_dir)
@@ -0,0 +1,72 @@
+import math
+import numbers
+import random
+
+import dictdiffer
+import pytest
+
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, remove_ignored_fields
+
+
+def reference_compare_logs(log1, log2, ignore_fields, tolerance):
+  # previous to_dict based implementation
+  diff = []
+  for msg1, msg2 in zip(log1, log2, strict=True):
+    msg1 = remove_ignored_fields(msg1, ignore_fields)
+    msg2 = remove_ignored_fields(msg2, ignore_fields)
+    if msg1.to_bytes() != msg2.to_bytes():
+      dd = dictdiffer.diff(msg1.as_reader().to_dict(verbose=True), msg2.as_reader().to_dict(verbose=True), ignore=ignore_fields)
+
+      def outside_tolerance(diff):
+        try:
+          if diff[0] == "change":
+            a, b = diff[2]
+            finite = math.isfinite(a) and math.isfinite(b)
+            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+        except TypeError:
+          pass
+        return True
+
+      diff.extend(filter(outside_tolerance, dd))
+  return diff
+
+
+def make_log(seed, n=50):
+  rng = random.Random(seed)
+  msgs = []
+  for i in range(n):
+    msg = messaging.new_message('modelV2')
+    msg.logMonoTime = i + seed
+    msg.modelV2.frameId = i
+    msg.modelV2.modelExecutionTime = rng.random()
+    msg.modelV2.position.x = [float(j) + (rng.random() * 1e-3 if rng.random() < 0.1 else 0) for j in range(rng.choice([33, 33, 33, 30]))]
+    msg.modelV2.position.y = [float('nan') if j == 3 else 0.0 for j in range(33)]
+    msg.modelV2.confidence = rng.choice(['green', 'green', 'red'])
+    msg.modelV2.meta.disengagePredictions.brakeDisengageProbs = [rng.choice([0.0, 0.5]) for _ in range(6)]
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestCompareLogs:
+  @pytest.mark.parametrize("tolerance", [None, 1e-4])
+  def test_matches_dictdiffer(self, tolerance):
+    ignore = ["logMonoTime", "modelV2.modelExecutionTime"]
+    log1, log2 = make_log(0), make_log(1)
+    expected = reference_compare_logs(log1, log2, ignore, tolerance if tolerance is not None else 2.220446049250313e-16)
+    assert len(expected) > 0
+    assert compare_logs(log1, log2, ignore, tolerance=tolerance) == expected
+
+  def test_identical(self):
+    assert compare_logs(make_log(0), make_log(0), ["logMonoTime"]) == []
+
+  def test_ignored_fields_differ(self):
+    log1, log2 = make_log(0), make_log(0)
+    for i, msg in enumerate(log2):
+      msg = msg.as_builder()
+      msg.logMonoTime += 1
+      msg.modelV2.modelExecutionTime += 1
+      log2[i] = msg.as_reader()
+    assert compare_logs(log1, log2, ["logMonoTime", "modelV2.modelExecutionTime"]) == []
+    assert len(compare_logs(log1, log2, ["logMonoTime"])) == len(log1)
@@ -0,0 +1,102 @@
+import os
+import shutil
+
+import pytest
+
+from cereal import CEREAL_PATH, messaging
+import openpilot.selfdrive.test.process_replay.migration as migration_module
+from openpilot.selfdrive.test.process_replay.migration import migrate_cached, migration, migration_fingerprint
+from openpilot.tools.lib.logreader import LogReader
+
+migration_calls = 0
+
+
+@migration(inputs=["carState"], product="carOutput")
+def migrate_count(msgs):
+  global migration_calls
+  migration_calls += 1
+  return [], [], []
+
+
+@migration(inputs=["carState"], product="carControl")
+def migrate_other(msgs):
+  return [], [], []
+
+
+def make_log(n=10, v_ego=0.):
+  msgs = []
+  for i in range(n):
+    msg = messaging.new_message('carState')
+    msg.logMonoTime = i
+    msg.carState.vEgo = v_ego + i
+    msgs.append(msg)
+  return LogReader.from_bytes(b"".join(msg.to_bytes() for msg in msgs))
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  global migration_calls
+  migration_calls = 0
+  monkeypatch.setattr(migration_module, "MIGRATION_CACHE_DIR", str(tmp_path / "migrated"))
+  migration_module._migration_cache.clear()
+  yield tmp_path / "migrated"
+  migration_module._migration_cache.clear()
+
+
+class TestMigration:
+  def test_cache_hit(self, cache_dir):
+    lr = make_log()
+    expected = [m.as_builder().to_bytes() for m in migrate_cached(lr, [migrate_count])]
+    assert migration_calls == 1
+    assert len(os.listdir(cache_dir)) == 1
+
+    # in memory, then from disk
+    assert [m.as_builder().to_bytes() for m in migrate_cached(lr, [migrate_count])] == expected
+    migration_module._migration_cache.clear()
+    assert [m.as_builder().to_bytes() for m in migrate_cached(make_log(), [migrate_count])] == expected
+    assert migration_calls == 1
+
+  def test_cache_miss(self, cache_dir):
+    migrate_cached(make_log(), [migrate_count])
+    # different events or a different set of migrations
+    migrate_cached(make_log(v_ego=1.), [migrate_count])
+    migrate_cached(make_log(), [migrate_count, migrate_other])
+    assert migration_calls == 3
+    assert len(os.listdir(cache_dir)) == 3
+
+  def test_no_cache_key(self, cache_dir):
+    msgs = list(make_log())
+    migrate_cached(msgs, [migrate_count])
+    migrate_cached(msgs, [migrate_count])
+    assert migration_calls == 2
+    assert not cache_dir.exists()
+
+  def test_cache_bounded(self, cache_dir, monkeypatch):
+    migrate_cached(make_log(n=1000), [migrate_count])
+    log_size = sum(f.stat().st_size for f in cache_dir.iterdir())
+    monkeypatch.setattr(migration_module, "MIGRATION_CACHE_SIZE_LIMIT", int(log_size * 3.5))
+
+    for i in range(1, 10):
+      migrate_cached(make_log(n=1000, v_ego=i), [migrate_count])
+      assert sum(f.stat().st_size for f in cache_dir.iterdir()) <= log_size * 3.5
+
+    # the last one is kept
+    migration_module._migration_cache.clear()
+    migrate_cached(make_log(n=1000, v_ego=9), [migrate_count])
+    assert migration_calls == 10
+
+  def test_fingerprint_schema(self, tmp_path, monkeypatch):
+    schemas = []
+    for name in ("a", "b", "c"):
+      shutil.copytree(CEREAL_PATH, tmp_path / name, ignore=shutil.ignore_patterns("messaging", "__pycache__"))
+      schemas.append(str(tmp_path / name))
+    with open(os.path.join(schemas[2], "log.capnp"), "a") as f:
+      f.write("\n# changed\n")
+
+    fingerprints = []
+    for path in schemas:
+      monkeypatch.setattr(migration_module, "CEREAL_PATH", path)
+      fingerprints.append(migration_fingerprint([migrate_count]))
+    assert fingerprints[0] == fingerprints[1]
+    assert fingerprints[0] != fingerprints[2]
+    assert migration_fingerprint([migrate_count]) != migration_fingerprint([migrate_count, migrate_other])
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 import argparse
 import concurrent.futures
+import functools
+import mmap
 import os
+import shutil
 import sys
+import tempfile
+import zstandard as zstd
 from collections import defaultdict
 from tqdm import tqdm
 from typing import Any
@@ -69,10 +74,10 @@ EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
+  segment, cfg, args, cur_log_fn, ref_log_path, log_fn = data
   res = None
   if not args.upload_only:
-    lr = LogReader.from_bytes(lr_dat)
+    lr = load_log_data(log_fn)
     res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
@@ -85,10 +90,22 @@ def run_test_process(data):
   return (segment, cfg.proc_name, res)
 
 
-def get_log_data(segment):
+def get_log_data(log_dir, segment):
+  # decompress once, every test of the segment maps the same file instead of getting its own copy
   r, n = segment.rsplit("--", 1)
-  with FileReader(get_url(r, n, "rlog.zst")) as f:
-    return (segment, f.read())
+  log_fn = os.path.join(log_dir, f"{segment}.rlog")
+  with FileReader(get_url(r, n, "rlog.zst")) as f, open(log_fn + ".tmp", "wb") as out:
+    with zstd.ZstdDecompressor().stream_reader(f, read_across_frames=True) as reader:
+      shutil.copyfileobj(reader, out)
+  os.replace(log_fn + ".tmp", log_fn)
+  return (segment, log_fn)
+
+
+@functools.lru_cache(maxsize=1)
+def load_log_data(log_fn):
+  # tests are queued segment by segment, so workers mostly reuse the last parsed log
+  with open(log_fn, "rb") as f:
+    return LogReader.from_bytes(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
 
 def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
@@ -177,13 +194,13 @@ if __name__ == "__main__":
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
-  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool, tempfile.TemporaryDirectory() as log_dir:
     if not args.upload_only:
       download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
+      log_data: dict[str, str] = {}
+      p1 = pool.map(functools.partial(get_log_data, log_dir), download_segments)
+      for segment, log_fn in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
+        log_data[segment] = log_fn
 
     pool_args: Any = []
     for car_brand, segment in segments:
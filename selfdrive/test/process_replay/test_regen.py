@@ -31,7 +31,11 @@ class TestRegen:
   def test_engaged(self, case_name, segment):
     route, sidx = segment.rsplit("--", 1)
     lr, frs = ci_setup_data_readers(route, sidx)
-    output_logs = regen_segment(lr, frs, disable_tqdm=True)
+    try:
+      output_logs = regen_segment(lr, frs, disable_tqdm=True)
+    finally:
+      for fr in frs.values():
+        fr.close()
 
     engaged = check_openpilot_enabled(output_logs)
     assert engaged, f"openpilot not engaged in {case_name}"
@@ -283,9 +283,12 @@ def create_screenshots():
       driver_img = frames[2]
   else:
     with open(frames_cache, 'wb') as f:
-      road_img = FrameReader(route.camera_paths()[segnum], pix_fmt="nv12").get(0)
-      wide_road_img = FrameReader(route.ecamera_paths()[segnum], pix_fmt="nv12").get(0)
-      driver_img = FrameReader(route.dcamera_paths()[segnum], pix_fmt="nv12").get(0)
+      with FrameReader(route.camera_paths()[segnum], pix_fmt="nv12") as fr:
+        road_img = fr.get(0)
+      with FrameReader(route.ecamera_paths()[segnum], pix_fmt="nv12") as fr:
+        wide_road_img = fr.get(0)
+      with FrameReader(route.dcamera_paths()[segnum], pix_fmt="nv12") as fr:
+        driver_img = fr.get(0)
       pickle.dump([road_img, wide_road_img, driver_img], f)
 
   STREAMS.append((VisionStreamType.VISION_STREAM_ROAD, cam.fcam, road_img.flatten().tobytes()))
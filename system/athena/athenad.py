@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import base64
+import bisect
 import hashlib
 import io
 import json
@@ -22,6 +23,7 @@ from typing import cast
 from collections.abc import Callable
 
 import requests
+import zstandard as zstd
 from requests.adapters import HTTPAdapter, DEFAULT_POOLBLOCK
 from jsonrpc import JSONRPCResponseManager, dispatcher
 from websocket import (ABNF, WebSocket, WebSocketException, WebSocketTimeoutException,
@@ -32,6 +34,7 @@ from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
 from openpilot.common.file_helpers import CallbackReader, get_upload_stream
+from openpilot.common.inotify import IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
@@ -47,6 +50,9 @@ LOCAL_PORT_WHITELIST = {22, }  # SSH
 
 LOG_ATTR_NAME = 'user.upload'
 LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(2147483647, 4, sys.byteorder)
+LOG_RESCAN_INTERVAL = 600
+LOG_RESPONSE_TIMEOUT = 100
+LOG_SEND_WINDOW = 8
 RECONNECT_TIMEOUT_S = 70
 
 RETRY_DELAY = 10  # seconds
@@ -579,7 +585,6 @@ def takeSnapshot() -> str | dict[str, str] | None:
 
 
 def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
   curr_time = int(time.time())
   logs = []
   for log_entry in os.listdir(Paths.swaglog_root()):
@@ -598,67 +603,104 @@ def get_logs_to_send_sorted() -> list[str]:
   return sorted(logs)[:-1]
 
 
+def send_log(log_entry: str) -> bool:
+  cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
+  try:
+    curr_time = int(time.time())
+    log_path = os.path.join(Paths.swaglog_root(), log_entry)
+    setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
+    with open(log_path) as f:
+      jsonrpc = {
+        "method": "forwardLogs",
+        "params": {
+          "logs": f.read()
+        },
+        "jsonrpc": "2.0",
+        "id": log_entry
+      }
+      low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+    return True
+  except OSError:
+    return False  # file could be deleted by log rotation
+
+
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
+  # new and rotated logs are picked up from inotify events, the full rescan
+  # retries logs that never got a response and covers missed events
+  log_root = Paths.swaglog_root()
+  try:
+    inotify: Inotify | None = Inotify()
+    inotify.add_watch(log_root, IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+    rescan_interval = LOG_RESCAN_INTERVAL
+  except OSError:
+    cloudlog.exception("athena.log_handler.inotify_failed")
+    inotify = None
+    rescan_interval = 10
+
+  log_files: list[str] = []  # unsent logs, sorted
+  active_log: str | None = None
+  in_flight: dict[str, float] = {}  # log entry -> time sent
   last_scan = 0.
   while not end_event.is_set():
     try:
       curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
+      if curr_scan - last_scan > rescan_interval:
+        log_files = [log_entry for log_entry in get_logs_to_send_sorted() if log_entry not in in_flight]
+        active_log = max(os.listdir(log_root), default=None)
         last_scan = curr_scan
 
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
+      for _, mask, log_entry in (inotify.read(0) if inotify is not None else []):
+        if mask & IN_Q_OVERFLOW:
+          last_scan = 0.
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+          # the previous log was rotated and is complete now
+          if active_log is not None and active_log < log_entry:
+            if active_log not in in_flight and active_log not in log_files:
+              bisect.insort(log_files, active_log)
+            active_log = log_entry
+        elif log_entry in log_files:
+          log_files.remove(log_entry)
+
+      # send newest logs first, several waiting for a response at once
+      while len(log_files) > 0 and len(in_flight) < LOG_SEND_WINDOW:
+        log_entry = log_files.pop()
+        if send_log(log_entry):
+          in_flight[log_entry] = time.monotonic()
+
+      # give up waiting for responses after ~100 seconds
+      for log_entry, sent_time in list(in_flight.items()):
+        if time.monotonic() - sent_time > LOG_RESPONSE_TIMEOUT:
+          del in_flight[log_entry]
+
+      # wait up to a second for responses, then handle all that arrived
+      timeout = 1.
+      while True:
         try:
-          curr_time = int(time.time())
-          log_path = os.path.join(Paths.swaglog_root(), log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path) as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
-
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
-          break
-        try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(Paths.swaglog_root(), log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
+          log_resp = json.loads(log_recv_queue.get(timeout=timeout))
         except queue.Empty:
-          if curr_log is None:
-            break
+          break
+        timeout = 0.
+
+        log_entry = log_resp.get("id")
+        log_success = "result" in log_resp and log_resp["result"].get("success")
+        cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
+        if log_entry and log_success:
+          log_path = os.path.join(log_root, log_entry)
+          try:
+            setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+          except OSError:
+            pass  # file could be deleted by log rotation
+        in_flight.pop(log_entry, None)
 
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
 
+  if inotify is not None:
+    inotify.close()
+
 
 def stat_handler(end_event: threading.Event) -> None:
   STATS_DIR = Paths.stats_root()
@@ -671,16 +713,20 @@ def stat_handler(end_event: threading.Event) -> None:
         stat_filenames = list(filter(lambda name: not name.startswith(tempfile.gettempprefix()), os.listdir(STATS_DIR)))
         if len(stat_filenames) > 0:
           stat_path = os.path.join(STATS_DIR, stat_filenames[0])
-          with open(stat_path) as f:
-            jsonrpc = {
-              "method": "storeStats",
-              "params": {
-                "stats": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": stat_filenames[0]
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+          with open(stat_path, "rb") as f:
+            stats = f.read()
+          # statsd writes compressed files, older ones are plain text
+          if stat_path.endswith(".zst"):
+            stats = zstd.ZstdDecompressor().decompress(stats)
+          jsonrpc = {
+            "method": "storeStats",
+            "params": {
+              "stats": stats.decode()
+            },
+            "jsonrpc": "2.0",
+            "id": stat_filenames[0]
+          }
+          low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
           os.remove(stat_path)
         last_scan = curr_scan
     except Exception:
@@ -5,6 +5,7 @@ import multiprocessing
 import os
 import requests
 import shutil
+import sys
 import time
 import threading
 import queue
@@ -16,6 +17,7 @@ from websocket._exceptions import WebSocketConnectionClosedException
 
 from cereal import messaging
 
+from openpilot.common.inotify import IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.timeout import Timeout
 from openpilot.system.athena import athenad
@@ -23,6 +25,8 @@ from openpilot.system.athena.athenad import MAX_RETRY_COUNT, UPLOAD_SESS, dispat
 from openpilot.system.athena.tests.helpers import HTTPRequestHandler, MockWebsocket, MockApi, EchoSocket
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
+from openpilot.system.loggerd import xattr_cache
+from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 
 
 def seed_athena_server(host, port):
@@ -56,6 +60,40 @@ def host():
   with http_server_context(handler=HTTPRequestHandler, setup=seed_athena_server) as (host, port):
     yield f"http://{host}:{port}"
 
+@pytest.fixture
+def log_handler(mocker):
+  mocker.patch.object(athenad, "PC", False)
+  mocker.patch.object(athenad, "low_priority_send_queue", queue.Queue())
+  mocker.patch.object(athenad, "log_recv_queue", queue.Queue())
+  # the logs are recreated under the same names
+  mocker.patch.dict(xattr_cache._cached_attributes, clear=True)
+  shutil.rmtree(Paths.swaglog_root(), ignore_errors=True)
+  os.makedirs(Paths.swaglog_root())
+
+  end_event = threading.Event()
+  thread = threading.Thread(target=athenad.log_handler, args=(end_event,))
+  yield thread.start
+  end_event.set()
+  if thread.is_alive():
+    thread.join()
+
+class FakeInotify:
+  # only reports the events a test puts in
+  def __init__(self):
+    self.events: queue.Queue = queue.Queue()
+
+  def add_watch(self, path, mask):
+    pass
+
+  def read(self, timeout=None):
+    events = []
+    while not self.events.empty():
+      events.append(self.events.get())
+    return events
+
+  def close(self):
+    pass
+
 class TestAthenadMethods:
   @classmethod
   def setup_class(cls):
@@ -105,6 +143,26 @@ class TestAthenadMethods:
     return fn
 
 
+  @staticmethod
+  def _create_log(idx: int) -> str:
+    log_entry = f"swaglog.{idx:010}"
+    TestAthenadMethods._create_file(log_entry, Paths.swaglog_root(), data=f"log {idx}".encode())
+    return log_entry
+
+  @staticmethod
+  def _recv_logs(n: int) -> list[str]:
+    return [json.loads(athenad.low_priority_send_queue.get(timeout=5))['id'] for _ in range(n)]
+
+  @staticmethod
+  def _assert_no_logs_sent() -> None:
+    # the handler goes through its loop at least once a second
+    with pytest.raises(queue.Empty):
+      athenad.low_priority_send_queue.get(timeout=1.5)
+
+  @staticmethod
+  def _respond(log_entry: str, success: bool = True) -> None:
+    athenad.log_recv_queue.put_nowait(json.dumps({"result": {"success": success}, "id": log_entry, "jsonrpc": "2.0"}))
+
   # *** test cases ***
 
   def test_echo(self):
@@ -446,3 +504,73 @@ class TestAthenadMethods:
     # ensure the list is all logs except most recent
     sl = athenad.get_logs_to_send_sorted()
     assert sl == fl[:-1]
+
+  def test_log_handler_new_logs(self, log_handler):
+    active_log = self._create_log(0)
+    log_handler()
+    # the active log isn't sent
+    self._assert_no_logs_sent()
+
+    # it's complete once the next log is created
+    self._create_log(1)
+    msg = json.loads(athenad.low_priority_send_queue.get(timeout=5))
+    assert msg['method'] == "forwardLogs"
+    assert msg['id'] == active_log
+    assert msg['params']['logs'] == "log 0"
+    self._assert_no_logs_sent()
+
+  def test_log_handler_send_window(self, log_handler):
+    logs = [self._create_log(i) for i in range(athenad.LOG_SEND_WINDOW + 3)]
+    self._create_log(len(logs))
+    log_handler()
+
+    # newest first, only LOG_SEND_WINDOW waiting for a response
+    sent = self._recv_logs(athenad.LOG_SEND_WINDOW)
+    assert sent == logs[::-1][:athenad.LOG_SEND_WINDOW]
+    self._assert_no_logs_sent()
+
+    # an ack marks the log as sent for good and frees its slot
+    self._respond(sent[0])
+    assert self._recv_logs(1) == [logs[2]]
+    assert getxattr(os.path.join(Paths.swaglog_root(), sent[0]), athenad.LOG_ATTR_NAME) == athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME
+
+    # a failure frees the slot too, deleted logs aren't sent
+    os.unlink(os.path.join(Paths.swaglog_root(), logs[0]))
+    self._respond(sent[1], success=False)
+    assert self._recv_logs(1) == [logs[1]]
+    assert getxattr(os.path.join(Paths.swaglog_root(), sent[1]), athenad.LOG_ATTR_NAME) != athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME
+    self._respond(sent[2])
+    self._assert_no_logs_sent()
+
+  def test_log_handler_response_timeout(self, mocker, log_handler):
+    mocker.patch.object(athenad, "LOG_SEND_WINDOW", 1)
+    mocker.patch.object(athenad, "LOG_RESPONSE_TIMEOUT", 0)
+    mocker.patch.object(athenad, "LOG_RESCAN_INTERVAL", 0)
+    logs = [self._create_log(i) for i in range(2)]
+    self._create_log(2)
+    log_handler()
+
+    # no response, the next one is sent after the timeout
+    assert self._recv_logs(2) == logs[::-1]
+    self._assert_no_logs_sent()
+
+    # resent once the first try is old enough to be considered lost
+    setxattr(os.path.join(Paths.swaglog_root(), logs[1]), athenad.LOG_ATTR_NAME, int.to_bytes(int(time.time()) - 3601, 4, sys.byteorder))
+    assert self._recv_logs(1) == [logs[1]]
+
+  @pytest.mark.parametrize("overflow", [True, False], ids=["overflow", "interval"])
+  def test_log_handler_rescan(self, mocker, log_handler, overflow):
+    inotify = FakeInotify()
+    mocker.patch.object(athenad, "Inotify", return_value=inotify)
+    mocker.patch.object(athenad, "LOG_RESCAN_INTERVAL", 600 if overflow else 3)
+    logs = [self._create_log(0)]
+    log_handler()
+    self._assert_no_logs_sent()
+
+    # missed events, the logs are found by the next scan
+    logs += [self._create_log(i) for i in range(1, 3)]
+    if overflow:
+      self._assert_no_logs_sent()
+      inotify.events.put((Paths.swaglog_root(), IN_Q_OVERFLOW, ""))
+    assert self._recv_logs(2) == logs[1::-1]
+    self._assert_no_logs_sent()
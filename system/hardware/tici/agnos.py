@@ -14,6 +14,7 @@ import openpilot.system.updated.casync.casync as casync
 
 SPARSE_CHUNK_FMT = struct.Struct('H2xI4x')
 CAIBX_URL = "https://commadist.azureedge.net/agnosupdate/"
+CASYNC_CHUNK_INDEX = "/data/casync/chunk_index"
 
 AGNOS_MANIFEST_FILE = "system/hardware/tici/agnos.json"
 
@@ -192,6 +193,7 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
   seed_path = path[:-1] + ('b' if path[-1] == 'a' else 'a')
 
   target = casync.parse_caibx(partition['casync_caibx'])
+  index = casync.LocalChunkIndex.load(CASYNC_CHUNK_INDEX)
 
   sources: list[tuple[str, casync.ChunkReader, casync.ChunkDict]] = []
 
@@ -202,13 +204,18 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
 
     try:
       cloudlog.info(f"casync fetching {caibx_url}")
-      sources += [('seed', casync.FileChunkReader(seed_path), casync.build_chunk_dict(casync.parse_caibx(caibx_url)))]
+      seed = casync.parse_caibx(caibx_url)
+      sources += [('seed', casync.FileChunkReader(seed_path), casync.build_chunk_dict(seed))]
+      index.update(seed_path, seed)
     except requests.RequestException:
       cloudlog.error(f"casync failed to load {caibx_url}")
   except Exception:
     cloudlog.exception("casync failed to hash seed partition")
 
-  # Second source is the target partition, this allows for resuming
+  # Then any other chunk known to be on the device, e.g. in other partitions
+  sources += [('local', casync.IndexedChunkReader(index, exclude=[seed_path, path]), index.chunk_dict(exclude=[seed_path, path]))]
+
+  # Next source is the target partition, this allows for resuming
   sources += [('target', casync.FileChunkReader(path), casync.build_chunk_dict(target))]
 
   # Finally we add the remote source to download any missing chunks
@@ -227,7 +234,19 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
   cloudlog.error(f'casync done {json.dumps(stats)}')
 
   os.sync()
-  if not verify_partition(target_slot_number, partition, force_full_check=True):
+  verified = verify_partition(target_slot_number, partition, force_full_check=True)
+
+  # the target's old chunks were overwritten, the new ones are only indexed once the partition is verified
+  if verified:
+    index.update(path, target)
+  else:
+    index.remove(path)
+  try:
+    index.save()
+  except OSError:
+    cloudlog.exception("casync failed to save chunk index")
+
+  if not verified:
     raise Exception(f"Raw hash mismatch '{partition['hash_raw'].lower()}'")
 
 
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import os
+import psutil
 import shutil
 import threading
+import time
+from queue import Queue
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
 from openpilot.system.loggerd.uploader import listdir_by_creation
 from openpilot.system.loggerd.xattr_cache import getxattr
 
@@ -45,26 +47,132 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
   return preserved
 
 
-def deleter_thread(exit_event: threading.Event):
-  while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+def get_bytes_to_free(root: str) -> int:
+  """Bytes to delete to get back above both MIN_BYTES and MIN_PERCENT available"""
+  try:
+    statvfs = os.statvfs(root)
+  except OSError:
+    return 0
+  missing_bytes = MIN_BYTES - statvfs.f_bavail * statvfs.f_frsize
+  missing_percent_bytes = (MIN_PERCENT / 100 * statvfs.f_blocks - statvfs.f_bavail) * statvfs.f_frsize
+  return int(max(missing_bytes, missing_percent_bytes))
+
+
+def has_lock(path: str) -> bool:
+  """True if the directory is still being written to, or can't be listed"""
+  try:
+    return any(name.endswith(".lock") for name in os.listdir(path))
+  except OSError:
+    return True
+
+
+def get_dir_size(path: str) -> int:
+  size = 0
+  for root, _, files in os.walk(path):
+    for fn in files:
+      try:
+        size += os.lstat(os.path.join(root, fn)).st_blocks * 512
+      except OSError:
+        pass
+  return size
+
+
+class Reclaimer:
+  """Directories are moved out of the log root right away, then removed by a low I/O priority thread"""
+  def __init__(self, trash_dir: str):
+    self.trash_dir = trash_dir
+    self.lock = threading.Lock()
+    self.pending_bytes = 0
+    self.queue: Queue[tuple[str, int]] = Queue()
+
+    # leftovers from a previous run
+    if os.path.isdir(trash_dir):
+      for d in os.listdir(trash_dir):
+        self.queue.put((os.path.join(trash_dir, d), 0))
+
+    self.thread = threading.Thread(target=self.reclaim_thread, daemon=True)
+    self.thread.start()
+
+  def delete(self, path: str, size: int) -> None:
+    try:
+      os.makedirs(self.trash_dir, exist_ok=True)
+      trash_path = os.path.join(self.trash_dir, f"{os.path.basename(path)}.{time.monotonic_ns()}")
+      os.rename(path, trash_path)
+    except OSError:
+      # not on the same filesystem, delete in place
+      shutil.rmtree(path)
+      return
+
+    with self.lock:
+      self.pending_bytes += size
+    self.queue.put((trash_path, size))
+
+  def reclaim_thread(self) -> None:
+    try:
+      psutil.Process(threading.get_native_id()).ionice(psutil.IOPRIO_CLASS_BE, value=7)
+    except (AttributeError, psutil.Error, OSError):
+      cloudlog.exception("deleter: failed to lower io priority")
+
+    while True:
+      path, size = self.queue.get()
+      shutil.rmtree(path, ignore_errors=True)
+      with self.lock:
+        self.pending_bytes -= size
+
+
+class DeletionPlanner:
+  """Keeps the size of segments, and picks the directories to delete to free enough space in one pass"""
+  def __init__(self, root: str):
+    self.root = root
+    self.sizes: dict[str, int] = {}
+
+  def deletable_size(self, d: str) -> int | None:
+    """Size of the directory, None if it's still being written to"""
+    # a lock can show up again, only the size is kept
+    path = os.path.join(self.root, d)
+    if has_lock(path):
+      return None
+    if d not in self.sizes:
+      self.sizes[d] = get_dir_size(path)
+    return self.sizes[d]
+
+  def plan(self, bytes_to_free: int) -> list[tuple[str, int]]:
+    dirs = listdir_by_creation(self.root)
+    self.sizes = {d: size for d, size in self.sizes.items() if d in dirs}
+    preserved_dirs = get_preserved_segments(dirs)
+
+    # remove the earliest directories we can
+    to_delete = []
+    for d in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
+      if bytes_to_free <= 0:
+        break
+      size = self.deletable_size(d)
+      if size is None:
+        continue
+      to_delete.append((d, size))
+      # make progress even when sizes are off
+      bytes_to_free -= max(size, 1)
+    return to_delete
 
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
-      preserved_dirs = get_preserved_segments(dirs)
 
-      # remove the earliest directory we can
-      for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
+def deleter_thread(exit_event: threading.Event):
+  root = Paths.log_root()
+  planner = DeletionPlanner(root)
+  reclaimer = Reclaimer(os.path.join(os.path.dirname(os.path.normpath(root)), ".deleter_trash"))
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
+  while not exit_event.is_set():
+    with reclaimer.lock:
+      pending_bytes = reclaimer.pending_bytes
+    bytes_to_free = get_bytes_to_free(root)
+
+    if bytes_to_free > 0:
+      for delete_dir, size in planner.plan(bytes_to_free - pending_bytes):
+        delete_path = os.path.join(root, delete_dir)
+        if has_lock(delete_path):
           continue
-
         try:
           cloudlog.info(f"deleting {delete_path}")
-          shutil.rmtree(delete_path)
-          break
+          reclaimer.delete(delete_path, size)
         except OSError:
           cloudlog.exception(f"issue deleting {delete_path}")
       exit_event.wait(.1)
@@ -6,6 +6,7 @@ from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
 from openpilot.common.timeout import Timeout, TimeoutException
+from openpilot.system.hardware.hw import Paths
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
@@ -115,3 +116,28 @@ class TestDeleter(UploaderTestCase):
     self.join_thread()
 
     assert f_path.exists(), "File deleted when locked"
+
+  def test_delete_only_needed(self):
+    for i in range(4):
+      self.make_file_with_data(self.seg_format.format(i), self.f_type, 1)
+    self.make_file_with_data(self.seg_format2.format(0), self.f_type, 1, lock=True)
+
+    planner = deleter.DeletionPlanner(Paths.log_root())
+    plan = planner.plan(int(1.5 * 1024 * 1024))
+    assert [d for d, _ in plan] == [self.seg_format.format(0), self.seg_format.format(1)]
+
+    # locked segments are never planned
+    plan = planner.plan(100 * 1024 * 1024)
+    assert [d for d, _ in plan] == [self.seg_format.format(i) for i in range(4)]
+
+  def test_lock_after_plan(self):
+    f_path = self.make_file_with_data(self.seg_format.format(0), self.f_type, 1)
+    planner = deleter.DeletionPlanner(Paths.log_root())
+    assert [d for d, _ in planner.plan(1)] == [self.seg_format.format(0)]
+
+    # a cached size doesn't make a locked segment deletable
+    lock_path = f_path.with_suffix(f_path.suffix + ".lock")
+    lock_path.touch()
+    assert planner.plan(1) == []
+    lock_path.unlink()
+    assert [d for d, _ in planner.plan(1)] == [self.seg_format.format(0)]
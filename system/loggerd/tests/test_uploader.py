@@ -7,6 +7,7 @@ from pathlib import Path
 from openpilot.system.hardware.hw import Paths
 
 from openpilot.common.swaglog import cloudlog
+import openpilot.system.loggerd.uploader as uploader
 from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
 
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
@@ -148,6 +149,22 @@ class TestUploader(UploaderTestCase):
 
     assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
 
+  def test_concurrent_uploads(self):
+    uploader.upload_workers = 4
+    seg_nums = [0, 1, 2, 10, 20]
+    for i in seg_nums:
+      self.seg_dir = self.seg_format.format(i)
+      self.gen_files()
+
+    self.start_thread()
+    # allow enough time that files could upload twice if there is a bug in the logic
+    time.sleep(1)
+    self.join_thread()
+
+    exp_order = self.gen_order(seg_nums, [])
+    assert len(log_handler.upload_ignored) == 0, "Some files were ignored"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Some files failed to upload or were uploaded twice"
+
   def test_no_upload_with_lock_file(self):
     self.start_thread()
 
@@ -163,6 +180,46 @@ class TestUploader(UploaderTestCase):
       uploaded = UPLOAD_ATTR_NAME in os.listxattr(fn) and os.getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
       assert not uploaded, "File upload when locked"
 
+  def test_upload_after_lock_removed(self):
+    f_paths = self.gen_files(lock=True, boot=False)
+    self.start_thread()
+    time.sleep(0.25)
+    assert len(log_handler.upload_order) == 0, "File uploaded when locked"
+
+    for f_path in f_paths:
+      f_path.with_suffix(f_path.suffix + ".lock").unlink()
+
+    time.sleep(1)
+    self.join_thread()
+
+    exp_order = self.gen_order([self.seg_num], [], boot=False)
+    assert log_handler.upload_order == exp_order, "Files not uploaded after segment was closed"
+
+  def test_queue_lock_removed_same_tick(self):
+    self.gen_files(lock=True, boot=False)
+    seg_path = Path(Paths.log_root()) / self.seg_dir
+    queue = uploader.UploadQueue(Paths.log_root(), ["boot/"], {"qlog": 0})
+    assert queue.pop(False, []) is None
+
+    # the segment is closed without its mtime changing
+    mtime_ns = seg_path.stat().st_mtime_ns
+    for lock_path in seg_path.glob("*.lock"):
+      lock_path.unlink()
+    os.utime(seg_path, ns=(mtime_ns, mtime_ns))
+
+    assert queue.pop(False, []) == ("qlog", f"{self.seg_dir}/qlog", str(seg_path / "qlog"))
+
+  def test_queue_retries_failed_files(self, mocker):
+    self.gen_files(lock=False, boot=False)
+    queue = uploader.UploadQueue(Paths.log_root(), ["boot/"], {"qlog": 0})
+
+    getxattr = mocker.patch.object(uploader, "getxattr", side_effect=OSError)
+    assert queue.pop(False, []) is None
+
+    getxattr.side_effect = None
+    getxattr.return_value = None
+    assert queue.pop(False, []) is not None
+
   def test_no_upload_with_xattr(self):
     self.gen_files(lock=False, xattr=UPLOAD_ATTR_VALUE)
 
@@ -3,16 +3,18 @@ import json
 import os
 import random
 import requests
+from requests.adapters import HTTPAdapter
 import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
+import heapq
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import get_upload_stream
+from openpilot.common.file_helpers import MAX_COMPRESS_SIZE, get_upload_stream
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
@@ -33,6 +35,12 @@ allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
+# concurrent uploads, and bandwidth shared by all of them in bytes/s (0 is unlimited)
+# metered connections only upload qlogs and requested qcameras, 256 kB/s keeps up with driving without saturating the link
+upload_workers = int(os.getenv("UPLOADER_WORKERS", "2"))
+upload_bandwidth = float(os.getenv("UPLOADER_BANDWIDTH", "0"))
+upload_bandwidth_metered = float(os.getenv("UPLOADER_BANDWIDTH_METERED", str(256 * 1024)))
+
 
 class FakeRequest:
   def __init__(self):
@@ -45,6 +53,52 @@ class FakeResponse:
     self.request = FakeRequest()
 
 
+class TokenBucket:
+  """Limits the throughput of all readers sharing it to rate bytes/s, with up to a second of burst"""
+  def __init__(self, rate: float = 0):
+    self.rate = rate
+    self.tokens = 0.0
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def set_rate(self, rate: float) -> None:
+    with self.lock:
+      self.rate = rate
+      self.tokens = min(self.tokens, rate)
+
+  def consume(self, n: int) -> None:
+    with self.lock:
+      if self.rate <= 0:
+        return
+      now = time.monotonic()
+      self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      # go into debt, later readers wait for it to be paid off too
+      self.tokens -= n
+      delay = -self.tokens / self.rate
+    if delay > 0:
+      time.sleep(delay)
+
+
+class ThrottledReader:
+  """Wraps a file, reads wait for the bandwidth in a TokenBucket"""
+  def __init__(self, f, bucket: TokenBucket):
+    self.f = f
+    self.bucket = bucket
+
+  def __getattr__(self, attr):
+    return getattr(self.f, attr)
+
+  def read(self, *args, **kwargs):
+    chunk = self.f.read(*args, **kwargs)
+    self.bucket.consume(len(chunk))
+    return chunk
+
+
+def should_compress(key: str, fn: str) -> bool:
+  return key.endswith('.zst') and not fn.endswith('.zst')
+
+
 def get_directory_sort(d: str) -> list[str]:
   # ensure old format is sorted sooner
   o = ["0", ] if d.startswith("2024-") else ["1", ]
@@ -62,6 +116,142 @@ def listdir_by_creation(d: str) -> list[str]:
     cloudlog.exception("listdir_by_creation failed")
     return []
 
+class UploadQueue:
+  """
+    Files waiting for upload, in upload order. Directories are only rescanned when their mtime changes,
+    except locked ones, since removing a lock doesn't have to change the mtime within the same tick.
+    Finished segments (no locks) are not checked again once all their files were queued,
+    loggerd only writes to the current one.
+    Files in immediate folders come first, then files in immediate_priority, both by directory creation.
+  """
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+
+    # (in immediate folder, directory sort, name priority, name, logdir, ctime)
+    self.heap: list[tuple[int, list[str], int, str, str, float]] = []
+    self.queued: set[str] = set()
+    self.root_mtime: int | None = None
+    # mtime at the last scan of directories that can still change, None to always rescan
+    self.active_dirs: dict[str, int | None] = {}
+    self.known_dirs: set[str] = set()
+
+  def _update_dirs(self) -> None:
+    try:
+      root_mtime = os.stat(self.root).st_mtime_ns
+    except OSError:
+      return
+    if root_mtime == self.root_mtime:
+      return
+    self.root_mtime = root_mtime
+
+    logdirs = set(listdir_by_creation(self.root))
+    removed = self.known_dirs - logdirs
+    if removed:
+      # deleted by the deleter
+      self.heap = [entry for entry in self.heap if entry[4] not in removed]
+      heapq.heapify(self.heap)
+      self.queued = {os.path.join(entry[4], entry[3]) for entry in self.heap}
+      for logdir in removed:
+        self.active_dirs.pop(logdir, None)
+
+    for logdir in logdirs - self.known_dirs:
+      self.active_dirs[logdir] = None
+    self.known_dirs = logdirs
+
+  def _scan_dir(self, logdir: str) -> None:
+    path = os.path.join(self.root, logdir)
+    try:
+      mtime = os.stat(path).st_mtime_ns
+      if mtime == self.active_dirs[logdir]:
+        return
+      names = os.listdir(path)
+    except OSError:
+      return
+
+    if any(name.endswith(".lock") for name in names):
+      self.active_dirs[logdir] = None
+      return
+
+    failed = False
+    for name in names:
+      key = os.path.join(logdir, name)
+      fn = os.path.join(path, name)
+      in_immediate_folder = any(f in fn for f in self.immediate_folders)
+      if key in self.queued or not (in_immediate_folder or name in self.immediate_priority):
+        continue
+
+      # skip files already uploaded
+      try:
+        ctime = os.path.getctime(fn)
+        is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+      except OSError:
+        cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
+        # deleter could have deleted, so skip and retry on the next scan
+        failed = True
+        continue
+      if is_uploaded:
+        continue
+
+      entry = (0 if in_immediate_folder else 1, get_directory_sort(logdir), self.immediate_priority.get(name, 1000), name, logdir, ctime)
+      heapq.heappush(self.heap, entry)
+      self.queued.add(key)
+
+    if failed:
+      self.active_dirs[logdir] = None
+    # a complete segment doesn't change anymore, empty directories might not have their locks yet
+    elif names and not any(f in path + "/" for f in self.immediate_folders):
+      del self.active_dirs[logdir]
+    else:
+      self.active_dirs[logdir] = mtime
+
+  def update(self) -> None:
+    self._update_dirs()
+    for logdir in list(self.active_dirs):
+      self._scan_dir(logdir)
+
+  def pop(self, metered: bool, requested_routes: list[str], exclude: set[str] | None = None) -> tuple[str, str, str] | None:
+    """Next file to upload, except the keys in exclude. It stays queued until it's tagged as uploaded."""
+    self.update()
+
+    skipped = []
+    ret = None
+    while self.heap:
+      entry = heapq.heappop(self.heap)
+      _, _, _, name, logdir, ctime = entry
+      key = os.path.join(logdir, name)
+      fn = os.path.join(self.root, key)
+
+      try:
+        is_uploaded = not os.path.exists(fn) or getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+      except OSError:
+        is_uploaded = True
+      if is_uploaded:
+        self.queued.discard(key)
+        continue
+
+      skipped.append(entry)
+      if exclude is not None and key in exclude:
+        continue
+
+      # limit uploading on metered connections
+      if metered:
+        dt = datetime.timedelta(hours=12)
+        if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
+          continue
+
+        if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+          continue
+
+      ret = name, key, fn
+      break
+
+    for entry in skipped:
+      heapq.heappush(self.heap, entry)
+    return ret
+
+
 def clear_locks(root: str) -> None:
   for logdir in os.listdir(root):
     path = os.path.join(root, logdir)
@@ -86,58 +276,21 @@ class Uploader:
 
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self.queue = UploadQueue(root, self.immediate_folders, self.immediate_priority)
 
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
-    requested_routes = [] if r is None else [route for route in r.split(",") if route]
-
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
-          continue
-
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
-
-        yield name, key, fn
+    self.bucket = TokenBucket()
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=upload_workers)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self.pool = ThreadPoolExecutor(max_workers=upload_workers)
+    # queue key -> running upload
+    self.in_progress: dict[str, Future] = {}
 
   def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
-
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
-
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
-
-    return None
+    r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
+    requested_routes = [] if r is None else [route for route in r.split(",") if route]
+    return self.queue.pop(metered, requested_routes, exclude=set(self.in_progress))
 
   def do_upload(self, key: str, fn: str):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -154,9 +307,8 @@ class Uploader:
 
     stream = None
     try:
-      compress = key.endswith('.zst') and not fn.endswith('.zst')
-      stream, _ = get_upload_stream(fn, compress)
-      response = requests.put(url, data=stream, headers=headers, timeout=10)
+      stream, _ = get_upload_stream(fn, should_compress(key, fn))
+      response = self.session.put(url, data=ThrottledReader(stream, self.bucket), headers=headers, timeout=10)
       return response
     finally:
       if stream:
@@ -174,7 +326,7 @@ class Uploader:
     if sz == 0:
       # tag files of 0 size as uploaded
       success = True
-    elif name in MAX_UPLOAD_SIZES and sz > MAX_UPLOAD_SIZES[name]:
+    elif (name in MAX_UPLOAD_SIZES and sz > MAX_UPLOAD_SIZES[name]) or (should_compress(key, fn) and sz > MAX_COMPRESS_SIZE):
       cloudlog.event("uploader_too_large", key=key, fn=fn, sz=sz)
       success = True
     else:
@@ -213,17 +365,37 @@ class Uploader:
 
 
   def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
-    if d is None:
-      return None
+    """Starts uploads until all workers are busy, then waits for one to finish and returns its result.
+    None if there is nothing to upload."""
+    self.bucket.set_rate(upload_bandwidth_metered if metered else upload_bandwidth)
+
+    while len(self.in_progress) < upload_workers:
+      d = self.next_file_to_upload(metered)
+      if d is None:
+        break
+
+      name, key, fn = d
+      queue_key = key
 
-    name, key, fn = d
+      # qlogs and bootlogs need to be compressed before uploading
+      if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
+        key += ".zst"
 
-    # qlogs and bootlogs need to be compressed before uploading
-    if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
-      key += ".zst"
+      self.in_progress[queue_key] = self.pool.submit(self.upload, name, key, fn, network_type, metered)
 
-    return self.upload(name, key, fn, network_type, metered)
+    if not self.in_progress:
+      return None
+
+    done, _ = wait(self.in_progress.values(), return_when=FIRST_COMPLETED)
+    finished = next(iter(done))
+    for queue_key, future in list(self.in_progress.items()):
+      if future is finished:
+        del self.in_progress[queue_key]
+    return finished.result()
+
+  def close(self) -> None:
+    self.pool.shutdown(wait=True)
+    self.session.close()
 
 
 def main(exit_event: threading.Event = None) -> None:
@@ -268,6 +440,8 @@ def main(exit_event: threading.Event = None) -> None:
     if allow_sleep:
       time.sleep(backoff + random.uniform(0, backoff))
 
+  uploader.close()
+
 
 if __name__ == "__main__":
   main()
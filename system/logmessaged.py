@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+import json
+import re
+import time
 import zmq
 from typing import NoReturn
 
@@ -6,6 +9,43 @@ import cereal.messaging as messaging
 from openpilot.common.logging_extra import SwagLogFileFormatter
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import get_file_handler
+from openpilot.system.statsd import statlog
+
+# records drained per wakeup
+LOG_BATCH_SIZE = 1000
+# a record is late if it's received this long after it was created
+LATE_RECORD_S = 1.0
+STATS_INTERVAL_S = 10.
+MAX_PUBLISH_SIZE = 2*1024*1024
+
+# python records end with the created field, C++ records (sorted keys) start with it
+CREATED_END_RE = re.compile(r'"created": ([0-9.e+-]+)\}$')
+CREATED_START_RE = re.compile(r'\{"created": ([0-9.e+-]+)')
+# senders report the records they dropped with this event
+DROPPED_EVENT = '"event": "swaglog_dropped"'
+
+
+def get_created(record: str) -> float | None:
+  m = CREATED_END_RE.search(record, max(len(record) - 64, 0)) or CREATED_START_RE.match(record)
+  return float(m.group(1)) if m is not None else None
+
+
+def get_dropped_count(record: str) -> int:
+  try:
+    return int(json.loads(record)['msg']['count'])
+  except (ValueError, KeyError, TypeError):
+    return 0
+
+
+def recv_batch(sock: zmq.Socket) -> list[bytes]:
+  """Blocks for the first record, then drains whatever else is pending"""
+  batch = [b''.join(sock.recv_multipart())]
+  while len(batch) < LOG_BATCH_SIZE:
+    try:
+      batch.append(b''.join(sock.recv_multipart(zmq.NOBLOCK)))
+    except zmq.error.Again:
+      break
+  return batch
 
 
 def main() -> NoReturn:
@@ -15,32 +55,62 @@ def main() -> NoReturn:
 
   ctx = zmq.Context.instance()
   sock = ctx.socket(zmq.PULL)
+  sock.setsockopt(zmq.RCVHWM, 10 * LOG_BATCH_SIZE)
   sock.bind(Paths.swaglog_ipc())
 
   # and we publish them
   log_message_sock = messaging.pub_sock('logMessage')
   error_log_message_sock = messaging.pub_sock('errorLogMessage')
 
+  # records dropped by the senders or here
+  dropped = 0
+  late = 0
+  last_stats = time.monotonic()
+
   try:
     while True:
-      dat = b''.join(sock.recv_multipart())
-      level = dat[0]
-      record = dat[1:].decode("utf-8")
-      if level >= log_level:
-        log_handler.emit(record)
-
-      if len(record) > 2*1024*1024:
-        print("WARNING: log too big to publish", len(record))
-        print(record[:100])
-        continue
-
-      # then we publish them
-      msg = messaging.new_message(None, valid=True, logMessage=record)
-      log_message_sock.send(msg.to_bytes())
-
-      if level >= 40:  # logging.ERROR
-        msg = messaging.new_message(None, valid=True, errorLogMessage=record)
-        error_log_message_sock.send(msg.to_bytes())
+      batch = recv_batch(sock)
+      now = time.time()
+
+      to_write = []
+      for dat in batch:
+        level = dat[0]
+        try:
+          record = dat[1:].decode("utf-8")
+        except UnicodeDecodeError:
+          dropped += 1
+          continue
+
+        if DROPPED_EVENT in record:
+          dropped += get_dropped_count(record)
+
+        created = get_created(record)
+        if created is not None and now - created > LATE_RECORD_S:
+          late += 1
+
+        if level >= log_level:
+          to_write.append(record)
+
+        if len(record) > MAX_PUBLISH_SIZE:
+          print("WARNING: log too big to publish", len(record))
+          print(record[:100])
+          dropped += 1
+          continue
+
+        # then we publish them
+        msg = messaging.new_message(None, valid=True, logMessage=record)
+        log_message_sock.send(msg.to_bytes())
+
+        if level >= 40:  # logging.ERROR
+          msg = messaging.new_message(None, valid=True, errorLogMessage=record)
+          error_log_message_sock.send(msg.to_bytes())
+
+      dropped += log_handler.emit_batch(to_write)
+
+      if time.monotonic() - last_stats > STATS_INTERVAL_S:
+        statlog.gauge("logmessaged_dropped", dropped)
+        statlog.gauge("logmessaged_late", late)
+        last_stats = time.monotonic()
   finally:
     sock.close()
     ctx.term()
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
+import atexit
+import math
 import os
+import struct
+import tempfile
+import threading
 import zmq
 import time
 import uuid
+import zstandard as zstd
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter
+from collections.abc import Iterator
 from datetime import datetime, UTC
 from typing import NoReturn
 
@@ -13,7 +20,8 @@ from cereal.messaging import SubMaster
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
 from openpilot.system.hardware import HARDWARE
-from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.common.file_helpers import LOG_COMPRESSION_LEVEL, atomic_write_in_dir
+from openpilot.common.inotify import IN_DELETE, IN_MOVED_FROM, IN_Q_OVERFLOW, Inotify
 from openpilot.system.version import get_build_metadata
 from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET, STATS_FLUSH_TIME_S
 
@@ -22,70 +30,286 @@ class METRIC_TYPE:
   GAUGE = 'g'
   SAMPLE = 'sa'
 
+# metrics are buffered per process and sent in batches
+STATS_BATCH_SIZE = 100
+STATS_BATCH_TIME_S = 1.
+
+# binary batches start with a byte that can't start a legacy "name:value|type" string
+BATCH_MARKER = b"\x00"
+METRIC_HEADER = struct.Struct("<BdH")  # type, value, name length
+METRIC_TYPE_CODES = {METRIC_TYPE.GAUGE: 0, METRIC_TYPE.SAMPLE: 1}
+METRIC_TYPES = {code: metric_type for metric_type, code in METRIC_TYPE_CODES.items()}
+
+
+def encode_metrics(metrics: list[tuple[str, str, float]]) -> bytes:
+  """Packs (metric type, name, value) tuples into one message"""
+  parts = [BATCH_MARKER]
+  for metric_type, name, value in metrics:
+    encoded = name.encode()
+    parts.append(METRIC_HEADER.pack(METRIC_TYPE_CODES[metric_type], value, len(encoded)))
+    parts.append(encoded)
+  return b"".join(parts)
+
+
+def decode_metrics(dat: bytes) -> Iterator[tuple[str, str, float]]:
+  """Unpacks a message into (metric type, name, value) tuples, also accepts the legacy string format"""
+  if not dat.startswith(BATCH_MARKER):
+    metric = dat.decode()
+    name_value, metric_type = metric.split('|')
+    name, value = name_value.split(':')
+    yield metric_type, name, float(value)
+    return
+
+  pos = len(BATCH_MARKER)
+  while pos < len(dat):
+    type_code, value, name_len = METRIC_HEADER.unpack_from(dat, pos)
+    pos += METRIC_HEADER.size
+    yield METRIC_TYPES.get(type_code, str(type_code)), dat[pos:pos + name_len].decode(), value
+    pos += name_len
+
+
+class QuantileSketch:
+  """
+    Summarizes a series of samples in fixed memory, DDSketch style. Values are counted in logarithmic
+    buckets so quantiles have a bounded relative error, the lowest buckets are merged past max_buckets.
+  """
+  MIN_VALUE = 1e-9
+
+  def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.key_scale = 1 / math.log(self.gamma)
+    self.max_buckets = max_buckets
+
+    self.positive: dict[int, int] = {}
+    self.negative: dict[int, int] = {}
+    self.zero_count = 0
+    self.count = 0
+    self.sum = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  def _value(self, key: int) -> float:
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def _collapse(self, buckets: dict[int, int]) -> None:
+    keys = sorted(buckets)
+    lowest = keys[len(keys) - self.max_buckets]
+    for key in keys[:len(keys) - self.max_buckets]:
+      buckets[lowest] += buckets.pop(key)
+
+  def add(self, value: float) -> None:
+    if not math.isfinite(value):
+      raise ValueError(f"sample is not finite: {value}")
+
+    self.count += 1
+    self.sum += value
+    if value < self.min:
+      self.min = value
+    if value > self.max:
+      self.max = value
+
+    if value > self.MIN_VALUE:
+      buckets, key = self.positive, math.ceil(math.log(value) * self.key_scale)
+    elif value < -self.MIN_VALUE:
+      buckets, key = self.negative, math.ceil(math.log(-value) * self.key_scale)
+    else:
+      self.zero_count += 1
+      return
+
+    buckets[key] = buckets.get(key, 0) + 1
+    if len(buckets) > self.max_buckets:
+      self._collapse(buckets)
+
+  def merge(self, other: 'QuantileSketch') -> None:
+    for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+      for key, count in other_buckets.items():
+        buckets[key] = buckets.get(key, 0) + count
+      if len(buckets) > self.max_buckets:
+        self._collapse(buckets)
+    self.zero_count += other.zero_count
+    self.count += other.count
+    self.sum += other.sum
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+
+  def quantile(self, q: float) -> float:
+    """Value of the sample at rank round(q * (count - 1)), like indexing the sorted samples"""
+    rank = round(q * (self.count - 1))
+    if rank <= 0:
+      return self.min
+    if rank >= self.count - 1:
+      return self.max
+
+    seen = 0
+    for key in sorted(self.negative, reverse=True):
+      seen += self.negative[key]
+      if seen > rank:
+        return max(-self._value(key), self.min)
+    seen += self.zero_count
+    if seen > rank:
+      return 0.
+    for key in sorted(self.positive):
+      seen += self.positive[key]
+      if seen > rank:
+        return min(self._value(key), self.max)
+    return self.max
+
+
+def get_influxdb_line(measurement: str, value: float | dict[str, float], tags: str, suffix: str) -> str:
+  """tags is the rendered ",key=value" tag list, suffix ends the line with the dongle_id field and timestamp"""
+  if isinstance(value, float):
+    value = {'value': value}
+  fields = "".join([f"{k}={v}," for k, v in value.items()])
+  return f"{measurement}{tags} {fields}{suffix}"
+
+
+class StatsDir:
+  """
+    Writes flushed stats as compressed files, keeping count of the files without listing the directory on every
+    write. The count is seeded once and decremented on deletes (by athena), using inotify when available.
+  """
+  def __init__(self, path: str, file_limit: int = STATS_DIR_FILE_LIMIT):
+    self.path = path
+    self.file_limit = file_limit
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    self.inotify: Inotify | None = None
+    try:
+      self.inotify = Inotify()
+      self.inotify.add_watch(path, IN_DELETE | IN_MOVED_FROM)
+    except OSError:
+      cloudlog.exception("statsd: inotify unavailable, recounting stats files when full")
+      self.inotify = None
+
+    self.count = self._count_files()
+    self.compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
+
+  def _count_files(self) -> int:
+    with os.scandir(self.path) as entries:
+      return sum(1 for e in entries if not e.name.startswith(tempfile.gettempprefix()))
+
+  def _update_count(self) -> None:
+    if self.inotify is None:
+      # no delete events, only recount when we would otherwise refuse to write
+      if self.count >= self.file_limit:
+        self.count = self._count_files()
+      return
+
+    for _, mask, name in self.inotify.read(timeout=0):
+      if mask & IN_Q_OVERFLOW:
+        self.count = self._count_files()
+        return
+      if not name.startswith(tempfile.gettempprefix()):
+        self.count -= 1
+
+  def write(self, name: str, data: str) -> bool:
+    """Returns False if the directory is full"""
+    self._update_count()
+    if self.count >= self.file_limit:
+      return False
+
+    with atomic_write_in_dir(os.path.join(self.path, f"{name}.zst"), mode='wb') as f:
+      f.write(self.compressor.compress(data.encode()))
+    self.count += 1
+    return True
+
+  def close(self) -> None:
+    if self.inotify is not None:
+      self.inotify.close()
+
+
 class StatLog:
   def __init__(self):
     self.pid = None
     self.zctx = None
     self.sock = None
+    self.buffer: list[tuple[str, str, float]] = []
+    # when the oldest buffered metric was added
+    self.buffer_time = 0.
+    self.last_send = 0.
+    self.cond = threading.Condition()
 
   def connect(self) -> None:
     self.zctx = zmq.Context()
     self.sock = self.zctx.socket(zmq.PUSH)
     self.sock.setsockopt(zmq.LINGER, 10)
     self.sock.connect(STATS_SOCKET)
-    self.pid = os.getpid()
+
+    # first connect, or after a fork: the buffer is the parent's and its flush thread is gone
+    if self.pid != os.getpid():
+      self.pid = os.getpid()
+      self.buffer.clear()
+      self.cond = threading.Condition()
+      threading.Thread(target=self.flush_thread, name="statlog_flush", daemon=True).start()
 
   def __del__(self):
     if self.sock is not None:
+      self.flush()
       self.sock.close()
     if self.zctx is not None:
       self.zctx.term()
 
-  def _send(self, metric: str) -> None:
+  def flush(self) -> None:
     if os.getpid() != self.pid:
-      self.connect()
+      return
+    with self.cond:
+      self._flush()
+
+  def flush_thread(self) -> None:
+    # a burst is followed by a quiet period, send its tail within STATS_BATCH_TIME_S
+    with self.cond:
+      while True:
+        if len(self.buffer) == 0:
+          self.cond.wait()
+        elif (remaining := self.buffer_time + STATS_BATCH_TIME_S - time.monotonic()) > 0:
+          self.cond.wait(remaining)
+        else:
+          self._flush()
+
+  def _flush(self) -> None:
+    if len(self.buffer) == 0:
+      return
 
     try:
-      self.sock.send_string(metric, zmq.NOBLOCK)
+      self.sock.send(encode_metrics(self.buffer), zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
+    self.buffer.clear()
+    self.last_send = time.monotonic()
+
+  def _send(self, metric_type: str, name: str, value: float) -> None:
+    if os.getpid() != self.pid:
+      self.connect()
+
+    # a metric after a quiet period goes out right away, bursts are batched
+    with self.cond:
+      if len(self.buffer) == 0:
+        self.buffer_time = time.monotonic()
+        self.cond.notify()
+      self.buffer.append((metric_type, name, float(value)))
+      if len(self.buffer) >= STATS_BATCH_SIZE or time.monotonic() - self.last_send > STATS_BATCH_TIME_S:
+        self._flush()
 
   def gauge(self, name: str, value: float) -> None:
-    self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
+    self._send(METRIC_TYPE.GAUGE, name, value)
 
-  # Samples will be recorded in a buffer and at aggregation time,
+  # Samples will be aggregated in a sketch and at flush time,
   # statistical properties will be logged (mean, count, percentiles, ...)
   def sample(self, name: str, value: float):
-    self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
+    self._send(METRIC_TYPE.SAMPLE, name, value)
 
 
 def main() -> NoReturn:
   dongle_id = Params().get("DongleId", encoding='utf-8')
-  def get_influxdb_line(measurement: str, value: float | dict[str, float],  timestamp: datetime, tags: dict) -> str:
-    res = f"{measurement}"
-    for k, v in tags.items():
-      res += f",{k}={str(v)}"
-    res += " "
-
-    if isinstance(value, float):
-      value = {'value': value}
-
-    for k, v in value.items():
-      res += f"{k}={v},"
-
-    res += f"dongle_id=\"{dongle_id}\" {int(timestamp.timestamp() * 1e9)}\n"
-    return res
 
   # open statistics socket
   ctx = zmq.Context.instance()
   sock = ctx.socket(zmq.PULL)
   sock.bind(STATS_SOCKET)
 
-  STATS_DIR = Paths.stats_root()
-
   # initialize stats directory
-  Path(STATS_DIR).mkdir(parents=True, exist_ok=True)
+  stats_dir = StatsDir(Paths.stats_root())
 
   build_metadata = get_build_metadata()
 
@@ -106,7 +330,9 @@ def main() -> NoReturn:
   boot_uid = str(uuid.uuid4())[:8]
   last_flush_time = time.monotonic()
   gauges = {}
-  samples: dict[str, list[float]] = defaultdict(list)
+  samples: dict[str, QuantileSketch] = {}
+  # samples the sketches can't hold, reported per flush
+  not_finite: Counter[str] = Counter()
   try:
     while True:
       started_prev = sm['deviceState'].started
@@ -115,18 +341,24 @@ def main() -> NoReturn:
       # Update metrics
       while True:
         try:
-          metric = sock.recv_string(zmq.NOBLOCK)
+          metric = sock.recv(zmq.NOBLOCK)
           try:
-            metric_type = metric.split('|')[1]
-            metric_name = metric.split(':')[0]
-            metric_value = float(metric.split('|')[0].split(':')[1])
-
-            if metric_type == METRIC_TYPE.GAUGE:
-              gauges[metric_name] = metric_value
-            elif metric_type == METRIC_TYPE.SAMPLE:
-              samples[metric_name].append(metric_value)
-            else:
-              cloudlog.event("unknown metric type", metric_type=metric_type)
+            for metric_type, metric_name, metric_value in decode_metrics(metric):
+              # a bad metric doesn't take the rest of its batch with it
+              try:
+                if metric_type == METRIC_TYPE.GAUGE:
+                  gauges[metric_name] = metric_value
+                elif metric_type == METRIC_TYPE.SAMPLE:
+                  if not math.isfinite(metric_value):
+                    not_finite[metric_name] += 1
+                    continue
+                  if metric_name not in samples:
+                    samples[metric_name] = QuantileSketch()
+                  samples[metric_name].add(metric_value)
+                else:
+                  cloudlog.event("unknown metric type", metric_type=metric_type)
+              except Exception:
+                cloudlog.event("invalid metric", metric_name=metric_name, metric_value=metric_value)
           except Exception:
             cloudlog.event("malformed metric", metric=metric)
         except zmq.error.Again:
@@ -134,45 +366,44 @@ def main() -> NoReturn:
 
       # flush when started state changes or after FLUSH_TIME_S
       if (time.monotonic() > last_flush_time + STATS_FLUSH_TIME_S) or (sm['deviceState'].started != started_prev):
-        result = ""
+        lines = []
         current_time = datetime.now(UTC)
         tags['started'] = sm['deviceState'].started
+        tag_str = "".join([f",{k}={v}" for k, v in tags.items()])
+        suffix = f"dongle_id=\"{dongle_id}\" {int(current_time.timestamp() * 1e9)}\n"
 
         for key, value in gauges.items():
-          result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
-
-        for key, values in samples.items():
-          values.sort()
-          sample_count = len(values)
-          sample_sum = sum(values)
+          lines.append(get_influxdb_line(f"gauge.{key}", value, tag_str, suffix))
 
+        for key, sketch in samples.items():
           stats = {
-            'count': sample_count,
-            'min': values[0],
-            'max': values[-1],
-            'mean': sample_sum / sample_count,
+            'count': sketch.count,
+            'min': sketch.min,
+            'max': sketch.max,
+            'mean': sketch.sum / sketch.count,
           }
           for percentile in [0.05, 0.5, 0.95]:
-            value = values[int(round(percentile * (sample_count - 1)))]
-            stats[f"p{int(percentile * 100)}"] = value
+            stats[f"p{int(percentile * 100)}"] = sketch.quantile(percentile)
 
-          result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
+          lines.append(get_influxdb_line(f"sample.{key}", stats, tag_str, suffix))
+
+        if len(not_finite) > 0:
+          cloudlog.event("statsd: dropped non-finite samples", counts=dict(not_finite))
 
         # clear intermediate data
         gauges.clear()
         samples.clear()
+        not_finite.clear()
         last_flush_time = time.monotonic()
 
         # check that we aren't filling up the drive
-        if len(os.listdir(STATS_DIR)) < STATS_DIR_FILE_LIMIT:
-          if len(result) > 0:
-            stats_path = os.path.join(STATS_DIR, f"{boot_uid}_{idx}")
-            with atomic_write_in_dir(stats_path) as f:
-              f.write(result)
+        if len(lines) > 0:
+          if stats_dir.write(f"{boot_uid}_{idx}", "".join(lines)):
             idx += 1
-        else:
-          cloudlog.error("stats dir full")
+          else:
+            cloudlog.error("stats dir full")
   finally:
+    stats_dir.close()
     sock.close()
     ctx.term()
 
@@ -181,3 +412,4 @@ if __name__ == "__main__":
   main()
 else:
   statlog = StatLog()
+  atexit.register(statlog.flush)
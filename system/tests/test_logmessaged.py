@@ -6,6 +6,7 @@ import cereal.messaging as messaging
 from openpilot.system.manager.process_config import managed_processes
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog, ipchandler
+from openpilot.system.logmessaged import get_created, get_dropped_count
 
 
 class TestLogmessaged:
@@ -53,3 +54,28 @@ class TestLogmessaged:
     logsize = sum([os.path.getsize(f) for f in self._get_log_files()])
     assert (n*len(msg)) < logsize < (n*(len(msg)+1024))
 
+
+  def test_log_burst(self):
+    n = 500
+    for i in range(n):
+      cloudlog.info(f"burst {i}")
+    time.sleep(0.5)
+
+    msgs = [m.logMessage for m in messaging.drain_sock(self.sock) if "burst" in m.logMessage]
+    assert len(msgs) == n
+    assert all(f'"burst {i}"' in m for i, m in enumerate(msgs))
+
+    lines = []
+    for fn in sorted(self._get_log_files()):
+      with open(fn) as f:
+        lines += [line for line in f if "burst" in line]
+    assert len(lines) == n
+
+  def test_get_created(self):
+    assert get_created('{"msg": "a", "created": 1700000000.25}') == 1700000000.25
+    assert get_created('{"created": 1.7e+09, "ctx": {}, "msg": "a"}') == 1.7e9
+    assert get_created('{"msg": "a"}') is None
+
+  def test_get_dropped_count(self):
+    assert get_dropped_count('{"msg": {"event": "swaglog_dropped", "count": 3}, "created": 1.0}') == 3
+    assert get_dropped_count('{"msg": "\\"event\\": \\"swaglog_dropped\\""}') == 0
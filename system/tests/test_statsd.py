@@ -0,0 +1,158 @@
+import math
+import os
+import random
+import threading
+import pytest
+import zmq
+import zstandard as zstd
+
+import openpilot.system.statsd as statsd
+from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT
+from openpilot.system.statsd import METRIC_TYPE, STATS_BATCH_SIZE, STATS_BATCH_TIME_S, QuantileSketch, StatLog, StatsDir, encode_metrics, decode_metrics, \
+                                    get_influxdb_line
+
+
+class FakeClock:
+  def __init__(self):
+    self.t = 100.
+
+  def monotonic(self):
+    return self.t
+
+
+class TestStatsd:
+  def test_encode_decode(self):
+    metrics = [(METRIC_TYPE.GAUGE, "gauge_name", 1.5), (METRIC_TYPE.SAMPLE, "sample_name", -3.)]
+    assert list(decode_metrics(encode_metrics(metrics))) == metrics
+    assert list(decode_metrics(b"legacy_name:2.5|g")) == [(METRIC_TYPE.GAUGE, "legacy_name", 2.5)]
+
+  def test_sketch_quantiles(self):
+    values = [random.uniform(-100., 1000.) for _ in range(10000)] + [0.] * 100
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for v in values:
+      sketch.add(v)
+
+    values.sort()
+    assert sketch.count == len(values)
+    assert sketch.min == values[0] and sketch.max == values[-1]
+    for q in (0.05, 0.5, 0.95):
+      expected = values[round(q * (len(values) - 1))]
+      assert abs(sketch.quantile(q) - expected) <= 0.01 * abs(expected) + 1e-6
+
+  def test_sketch_bounded(self):
+    sketch = QuantileSketch(max_buckets=64)
+    for v in range(1, 100000):
+      sketch.add(v)
+    assert len(sketch.positive) <= 64
+    # the lowest buckets are collapsed, high quantiles stay accurate
+    assert abs(sketch.quantile(0.99) - 99000) < 0.01 * 99000
+
+  def test_sketch_merge(self):
+    a, b, full = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for v in range(1, 1001):
+      (a if v % 2 else b).add(v)
+      full.add(v)
+    a.merge(b)
+    assert (a.count, a.sum, a.min, a.max) == (full.count, full.sum, full.min, full.max)
+    assert a.quantile(0.5) == full.quantile(0.5)
+
+  def test_sketch_not_finite(self):
+    sketch = QuantileSketch()
+    sketch.add(1.)
+    for v in (math.inf, -math.inf, math.nan):
+      with pytest.raises(ValueError):
+        sketch.add(v)
+    assert (sketch.count, sketch.sum, sketch.min, sketch.max) == (1, 1., 1., 1.)
+
+  def test_statlog_batches(self, tmp_path, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(statsd, "time", clock)
+    monkeypatch.setattr(statsd, "STATS_SOCKET", f"ipc://{tmp_path}/stats")
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(statsd.STATS_SOCKET)
+
+    def recv():
+      assert sock.poll(5000)
+      return [value for _, _, value in decode_metrics(sock.recv())]
+
+    statlog = StatLog()
+    for i in range(STATS_BATCH_SIZE + 51):
+      statlog.gauge("burst", i)
+
+    # the first gauge after a quiet period goes out right away, the burst in full batches
+    assert recv() == [0]
+    assert recv() == list(range(1, STATS_BATCH_SIZE + 1))
+    with statlog.cond:
+      assert [value for _, _, value in statlog.buffer] == list(range(STATS_BATCH_SIZE + 1, STATS_BATCH_SIZE + 51))
+
+    # the tail is sent by the flush thread once it's STATS_BATCH_TIME_S old
+    with statlog.cond:
+      clock.t += STATS_BATCH_TIME_S
+      statlog.cond.notify()
+    assert recv() == list(range(STATS_BATCH_SIZE + 1, STATS_BATCH_SIZE + 51))
+
+    # the next burst starts batching again
+    statlog.gauge("burst", 0)
+    with statlog.cond:
+      assert len(statlog.buffer) == 1
+    sock.close()
+    ctx.term()
+
+  def test_statlog_one_flush_thread(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(statsd, "STATS_SOCKET", f"ipc://{tmp_path}/stats")
+    def flush_threads():
+      return [t.name for t in threading.enumerate()].count("statlog_flush")
+
+    threads = flush_threads()
+    statlog = StatLog()
+    for i in range(10):
+      statlog.gauge("gauge", i)
+      statlog.connect()
+    assert flush_threads() == threads + 1
+
+  def test_influxdb_line(self):
+    suffix = 'dongle_id="abc" 1000\n'
+    assert get_influxdb_line("gauge.x", 1.5, ",started=True", suffix) == 'gauge.x,started=True value=1.5,dongle_id="abc" 1000\n'
+    assert get_influxdb_line("sample.y", {'count': 2, 'min': 0.5}, "", suffix) == 'sample.y count=2,min=0.5,dongle_id="abc" 1000\n'
+
+  def test_stats_dir(self, tmp_path):
+    stats_dir = StatsDir(str(tmp_path), file_limit=2)
+    assert stats_dir.write("a", "line\n")
+    assert stats_dir.write("b", "line\n")
+    assert not stats_dir.write("c", "line\n")
+    with open(tmp_path / "a.zst", "rb") as f:
+      assert zstd.ZstdDecompressor().decompress(f.read()) == b"line\n"
+
+    # athena uploaded a file
+    os.remove(tmp_path / "a.zst")
+    assert stats_dir.write("c", "line\n")
+    assert sorted(os.listdir(tmp_path)) == ["b.zst", "c.zst"]
+    stats_dir.close()
+
+  def test_full_stats_dir(self, tmp_path, monkeypatch):
+    # a device that has been offline for a long time
+    for i in range(STATS_DIR_FILE_LIMIT - 100):
+      (tmp_path / f"old_{i}").touch()
+
+    stats_dir = StatsDir(str(tmp_path))
+    scandir_calls = 0
+    scandir = os.scandir
+
+    def counting_scandir(path):
+      nonlocal scandir_calls
+      scandir_calls += 1
+      return scandir(path)
+    monkeypatch.setattr(statsd.os, "scandir", counting_scandir)
+
+    written = 0
+    while stats_dir.write(f"new_{written}", "line\n"):
+      written += 1
+    for _ in range(100):
+      assert not stats_dir.write("full", "line\n")
+    stats_dir.close()
+
+    assert written == 100
+    assert len(os.listdir(tmp_path)) == STATS_DIR_FILE_LIMIT
+    # the count is kept from inotify, the directory isn't listed per write
+    assert scandir_calls == 0
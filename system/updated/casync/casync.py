@@ -5,14 +5,18 @@ import os
 import pathlib
 import struct
 import sys
+import threading
 import time
 from abc import ABC, abstractmethod
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import IO
 
 import requests
+from requests.adapters import HTTPAdapter
 from Crypto.Hash import SHA512
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.updated.casync import tar
 from openpilot.system.updated.casync.common import create_casync_tar_package
 
@@ -29,8 +33,16 @@ CA_TABLE_MIN_LEN = CA_TABLE_HEADER_LEN + CA_TABLE_ENTRY_LEN
 CHUNK_DOWNLOAD_TIMEOUT = 60
 CHUNK_DOWNLOAD_RETRIES = 3
 
+# chunks fetched, decompressed and verified concurrently, and how many are queued ahead per worker
+CHUNK_EXTRACT_WORKERS = 8
+CHUNK_EXTRACT_QUEUE = 4
+
 CAIBX_DOWNLOAD_TIMEOUT = 120
 
+CHUNK_INDEX_VERSION = 1
+CHUNK_INDEX_HEADER = struct.Struct("<II")  # version, number of files
+CHUNK_INDEX_ENTRY = struct.Struct("<32sHQI")  # sha, file number, offset, length
+
 Chunk = namedtuple('Chunk', ['sha', 'offset', 'length'])
 ChunkDict = dict[bytes, Chunk]
 
@@ -46,10 +58,12 @@ class BinaryChunkReader(ChunkReader):
   def __init__(self, file_like: IO[bytes]) -> None:
     super().__init__()
     self.f = file_like
+    self.lock = threading.Lock()
 
   def read(self, chunk: Chunk) -> bytes:
-    self.f.seek(chunk.offset)
-    return self.f.read(chunk.length)
+    with self.lock:
+      self.f.seek(chunk.offset)
+      return self.f.read(chunk.length)
 
 
 class FileChunkReader(BinaryChunkReader):
@@ -67,6 +81,9 @@ class RemoteChunkReader(ChunkReader):
     super().__init__()
     self.url = url
     self.session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=CHUNK_EXTRACT_WORKERS)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
 
   def read(self, chunk: Chunk) -> bytes:
     sha_hex = chunk.sha.hex()
@@ -79,19 +96,109 @@ class RemoteChunkReader(ChunkReader):
       for i in range(CHUNK_DOWNLOAD_RETRIES):
         try:
           resp = self.session.get(url, timeout=CHUNK_DOWNLOAD_TIMEOUT)
+          resp.raise_for_status()
+          contents = resp.content
           break
         except Exception:
           if i == CHUNK_DOWNLOAD_RETRIES - 1:
             raise
           time.sleep(CHUNK_DOWNLOAD_TIMEOUT)
 
-      resp.raise_for_status()
-      contents = resp.content
-
     decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_AUTO)
     return decompressor.decompress(contents)
 
 
+class LocalChunkIndex:
+  """Persistent index of the chunks available in local files (system images, update caches, ...).
+  Maps (chunk sha, path) to (offset, length), a chunk can be in several files. Entries are not trusted,
+  extract verifies every chunk."""
+
+  def __init__(self, path: str) -> None:
+    self.path = path
+    self.entries: dict[tuple[bytes, str], tuple[int, int]] = {}
+
+  @classmethod
+  def load(cls, path: str) -> 'LocalChunkIndex':
+    """Loads the index, a missing or unreadable index is empty"""
+    index = cls(path)
+    try:
+      with open(path, 'rb') as f:
+        dat = f.read()
+
+      version, num_files = CHUNK_INDEX_HEADER.unpack_from(dat)
+      if version != CHUNK_INDEX_VERSION:
+        return index
+
+      pos = CHUNK_INDEX_HEADER.size
+      files = []
+      for _ in range(num_files):
+        length = struct.unpack_from("<H", dat, pos)[0]
+        files.append(dat[pos + 2:pos + 2 + length].decode())
+        pos += 2 + length
+
+      for sha, file_num, offset, length in CHUNK_INDEX_ENTRY.iter_unpack(dat[pos:]):
+        index.entries[(sha, files[file_num])] = (offset, length)
+    except (OSError, struct.error, UnicodeDecodeError, IndexError):
+      index.entries = {}
+    return index
+
+  def save(self) -> None:
+    files = list(dict.fromkeys(path for _, path in self.entries))
+    file_nums = {path: i for i, path in enumerate(files)}
+
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    with atomic_write_in_dir(self.path, mode='wb', overwrite=True) as f:
+      f.write(CHUNK_INDEX_HEADER.pack(CHUNK_INDEX_VERSION, len(files)))
+      for path in files:
+        encoded = path.encode()
+        f.write(struct.pack("<H", len(encoded)) + encoded)
+      f.write(b"".join(CHUNK_INDEX_ENTRY.pack(sha, file_nums[path], offset, length) for (sha, path), (offset, length) in self.entries.items()))
+
+  def remove(self, path: str) -> None:
+    self.entries = {key: entry for key, entry in self.entries.items() if key[1] != path}
+
+  def update(self, path: str, chunks: list[Chunk]) -> None:
+    """Replaces the entries of a file with the chunks it contains now"""
+    self.remove(path)
+    for sha, chunk in build_chunk_dict(chunks).items():
+      self.entries[(sha, path)] = (chunk.offset, chunk.length)
+
+  def locations(self, exclude: list[str] | None = None) -> dict[bytes, tuple[str, int, int]]:
+    """One (path, offset, length) for every chunk, outside of the excluded files"""
+    exclude = exclude or []
+    ret: dict[bytes, tuple[str, int, int]] = {}
+    for (sha, path), (offset, length) in self.entries.items():
+      if sha not in ret and path not in exclude:
+        ret[sha] = (path, offset, length)
+    return ret
+
+  def chunk_dict(self, exclude: list[str] | None = None) -> ChunkDict:
+    """Chunks to use as an extract source together with an IndexedChunkReader with the same exclude"""
+    return {sha: Chunk(sha, offset, length) for sha, (_, offset, length) in self.locations(exclude).items()}
+
+
+class IndexedChunkReader(ChunkReader):
+  """Reads chunks from the local files of a LocalChunkIndex"""
+
+  def __init__(self, index: LocalChunkIndex, exclude: list[str] | None = None) -> None:
+    super().__init__()
+    self.locations = index.locations(exclude)
+    self.readers: dict[str, FileChunkReader | None] = {}
+    self.lock = threading.Lock()
+
+  def read(self, chunk: Chunk) -> bytes:
+    path = self.locations[chunk.sha][0]
+    with self.lock:
+      if path not in self.readers:
+        try:
+          self.readers[path] = FileChunkReader(path)
+        except OSError:
+          # file is gone, extract falls back to the next source
+          self.readers[path] = None
+      reader = self.readers[path]
+    return reader.read(chunk) if reader is not None else b""
+
+
 class DirectoryTarChunkReader(BinaryChunkReader):
   """creates a tar archive of a directory and reads chunks from it"""
 
@@ -168,12 +275,21 @@ def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
 def extract(target: list[Chunk],
             sources: list[tuple[str, ChunkReader, ChunkDict]],
             out_path: str,
-            progress: Callable[[int], None] = None):
+            progress: Callable[[int], None] = None,
+            workers: int = CHUNK_EXTRACT_WORKERS):
+  """Chunks are read, verified and written by a pool of workers. Stats and progress
+  are still updated in target order as chunks complete."""
   stats: dict[str, int] = defaultdict(int)
 
   mode = 'rb+' if os.path.exists(out_path) else 'wb'
   with open(out_path, mode) as out:
-    for cur_chunk in target:
+    fd = out.fileno()
+
+    def extract_chunk(cur_chunk: Chunk, first: Future | None) -> str:
+      # A repeated chunk waits for its first occurrence to be written,
+      # so it can be read back from the target instead of downloaded again
+      if first is not None:
+        first.result()
 
       # Find source for desired chunk
       for name, chunk_reader, store_chunks in sources:
@@ -189,17 +305,33 @@ def extract(target: list[Chunk],
             continue
 
           # Write to output
-          out.seek(cur_chunk.offset)
-          out.write(bts)
+          os.pwrite(fd, bts, cur_chunk.offset)
+          return name
 
-          stats[name] += cur_chunk.length
+      raise RuntimeError("Desired chunk not found in provided stores")
 
-          if progress is not None:
-            progress(sum(stats.values()))
+    def finish(cur_chunk: Chunk, future: Future) -> None:
+      stats[future.result()] += cur_chunk.length
 
-          break
-      else:
-        raise RuntimeError("Desired chunk not found in provided stores")
+      if progress is not None:
+        progress(sum(stats.values()))
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+      first_occurrence: dict[bytes, Future] = {}
+      pending: deque[tuple[Chunk, Future]] = deque()
+      for cur_chunk in target:
+        future = pool.submit(extract_chunk, cur_chunk, first_occurrence.get(cur_chunk.sha))
+        first_occurrence.setdefault(cur_chunk.sha, future)
+        pending.append((cur_chunk, future))
+
+        if len(pending) >= workers * CHUNK_EXTRACT_QUEUE:
+          finish(*pending.popleft())
+
+      while pending:
+        finish(*pending.popleft())
+    finally:
+      pool.shutdown(cancel_futures=True)
 
   return stats
 
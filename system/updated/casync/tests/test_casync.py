@@ -4,6 +4,8 @@ import pathlib
 import tempfile
 import subprocess
 
+from Crypto.Hash import SHA512
+
 from openpilot.system.updated.casync import casync
 from openpilot.system.updated.casync import tar
 
@@ -262,3 +264,77 @@ class TestCasyncDirectory:
     assert stats['remote'] > 0
     assert stats['cache'] > 0
     assert stats['cache'] > stats['remote']
+
+
+class TestExtract:
+  """Tests the concurrent extraction without needing casync"""
+
+  class MemoryChunkReader(casync.ChunkReader):
+    def __init__(self, contents):
+      self.contents = contents
+      self.reads = 0
+
+    def read(self, chunk):
+      self.reads += 1
+      return self.contents[chunk.offset:chunk.offset + chunk.length]
+
+  def test_chunk_reuse(self, tmp_path):
+    blocks = [bytes([i]) * 1024 for i in range(16)]
+    order = [i % 16 for i in range(0, 256, 3)]
+    contents = b"".join(blocks[i] for i in order)
+    target = [casync.Chunk(SHA512.new(blocks[i], truncate="256").digest(), n * 1024, 1024) for n, i in enumerate(order)]
+
+    out_fn = str(tmp_path / "out.bin")
+    pathlib.Path(out_fn).touch()
+    remote = self.MemoryChunkReader(contents)
+    sources = [('target', casync.FileChunkReader(out_fn), casync.build_chunk_dict(target))]
+    sources += [('remote', remote, casync.build_chunk_dict(target))]
+
+    progress = []
+    stats = casync.extract(target, sources, out_fn, progress.append, workers=4)
+
+    with open(out_fn, 'rb') as f:
+      assert f.read() == contents
+
+    assert remote.reads == len(blocks)
+    assert stats['remote'] == len(blocks) * 1024
+    assert stats['target'] == len(contents) - stats['remote']
+    assert progress == sorted(progress) and progress[-1] == len(contents)
+
+  def test_local_chunk_index(self, tmp_path):
+    blocks = [bytes([i]) * 1024 for i in range(8)]
+    chunks = [casync.Chunk(SHA512.new(b, truncate="256").digest(), i * 1024, 1024) for i, b in enumerate(blocks)]
+
+    # an old image containing the first half of the chunks
+    old_fn = str(tmp_path / "old.bin")
+    with open(old_fn, 'wb') as f:
+      f.write(b"".join(blocks[:4]))
+
+    index = casync.LocalChunkIndex(str(tmp_path / "index" / "chunk_index"))
+    index.update(old_fn, chunks[:4])
+    index.save()
+
+    index = casync.LocalChunkIndex.load(index.path)
+    assert index.entries == {(c.sha, old_fn): (c.offset, c.length) for c in chunks[:4]}
+
+    out_fn = str(tmp_path / "out.bin")
+    remote = self.MemoryChunkReader(b"".join(blocks))
+    sources = [('local', casync.IndexedChunkReader(index), index.chunk_dict())]
+    sources += [('remote', remote, casync.build_chunk_dict(chunks))]
+    stats = casync.extract(chunks, sources, out_fn)
+
+    with open(out_fn, 'rb') as f:
+      assert f.read() == b"".join(blocks)
+    assert stats['local'] == stats['remote'] == 4 * 1024
+
+    index.update(out_fn, chunks)
+    assert len(index.entries) == 4 + len(chunks)
+    assert index.chunk_dict(exclude=[old_fn]) == casync.build_chunk_dict(chunks)
+
+    # chunks shared with another file stay available when one of them is removed
+    index.remove(out_fn)
+    index.save()
+    index = casync.LocalChunkIndex.load(index.path)
+    assert index.chunk_dict() == casync.build_chunk_dict(chunks[:4])
+    assert casync.IndexedChunkReader(index).read(chunks[0]) == blocks[0]
+    assert index.chunk_dict(exclude=[old_fn]) == {}
@@ -1,6 +1,9 @@
 import os
 import urllib.parse
 
+from openpilot.tools.lib.filereader import resolve_name
+from openpilot.tools.lib.url_file import URLFile
+
 DEFAULT_CACHE_DIR = os.getenv("CACHE_ROOT", os.path.expanduser("~/.commacache"))
 
 def cache_path_for_file_path(fn, cache_dir=DEFAULT_CACHE_DIR):
@@ -12,3 +15,20 @@ def cache_path_for_file_path(fn, cache_dir=DEFAULT_CACHE_DIR):
   else:
     cache_fn = f'{fn_parsed.hostname}_{fn_parsed.path.replace("/", "_")}'
   return os.path.join(dir_, cache_fn)
+
+
+def file_cache_key(fn: str) -> str:
+  """Identifies the contents of a file, derived caches are thrown away when this changes."""
+  fn = resolve_name(fn)
+  if fn.startswith(("http://", "https://")):
+    return f"{fn.split('?')[0]}:{URLFile(fn).get_length()}"
+  st = os.stat(fn)
+  return f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def sidecar_path_for_file_path(fn: str, ext: str, cache_dir=DEFAULT_CACHE_DIR) -> str:
+  """Derived data is stored next to local files when possible, otherwise in the cache dir."""
+  fn = resolve_name(fn)
+  if not fn.startswith(("http://", "https://")) and os.access(os.path.dirname(os.path.abspath(fn)), os.W_OK):
+    return fn + ext
+  return cache_path_for_file_path(fn, cache_dir) + ext
@@ -1,33 +1,46 @@
 import os
+import queue
 import subprocess
 import json
-from collections.abc import Iterator
+import threading
+from collections.abc import Generator, Iterator
 from collections import OrderedDict
 
 import numpy as np
 from openpilot.tools.lib.filereader import FileReader, resolve_name
 from openpilot.tools.lib.exceptions import DataUnreadableError
-from openpilot.tools.lib.vidindex import hevc_index
+from openpilot.tools.lib.vidindex import cached_hevc_index
 
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+# raw video is fed to ffmpeg in blocks of this size
+FEED_CHUNK_SIZE = 1024 * 1024
+# decoded frames queued ahead of the consumer. by default only a single frame is decoded ahead,
+# pass a larger prefetch_bytes (e.g. 256 MB, roughly one GOP of road camera frames) to decode the next GOP in the background
+DEFAULT_PREFETCH_BYTES = 0
+
 
 class LRUCache:
-  def __init__(self, capacity: int):
+  def __init__(self, capacity: int, max_bytes: int|None = None):
     self._cache: OrderedDict = OrderedDict()
     self.capacity = capacity
+    self.max_bytes = max_bytes
+    self.nbytes = 0
 
   def __getitem__(self, key):
     self._cache.move_to_end(key)
     return self._cache[key]
 
   def __setitem__(self, key, value):
+    if key in self._cache:
+      self.nbytes -= self._cache.pop(key).nbytes
     self._cache[key] = value
-    if len(self._cache) > self.capacity:
-        self._cache.popitem(last=False)
+    self.nbytes += value.nbytes
+    while len(self._cache) > self.capacity or (self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._cache) > 1):
+      self.nbytes -= self._cache.popitem(last=False)[1].nbytes
 
   def __contains__(self, key):
     return key in self._cache
@@ -42,9 +55,9 @@ def assert_hvec(fn: str) -> None:
     if 'hevc' not in fn:
       raise NotImplementedError(fn)
 
-def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.ndarray:
+def ffmpeg_decode_args(pix_fmt="rgb24", vid_fmt='hevc') -> list[str]:
   threads = os.getenv("FFMPEG_THREADS", "0")
-  args = ["ffmpeg", "-v", "quiet",
+  return ["ffmpeg", "-v", "quiet",
           "-threads", threads,
           "-c:v", "hevc",
           "-vsync", "0",
@@ -54,15 +67,17 @@ def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.n
           "-f", "rawvideo",
           "-pix_fmt", pix_fmt,
           "-"]
-  dat = subprocess.check_output(args, input=rawdat)
 
+def frame_shape(w, h, pix_fmt="rgb24") -> tuple[int, ...]:
   if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
+    return (h, w, 3)
   elif pix_fmt in ["nv12", "yuv420p"]:
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  else:
-    raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
-  return ret
+    return (h*w*3//2,)
+  raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
+
+def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc') -> np.ndarray:
+  dat = subprocess.check_output(ffmpeg_decode_args(pix_fmt, vid_fmt), input=rawdat)
+  return np.frombuffer(dat, dtype=np.uint8).reshape(-1, *frame_shape(w, h, pix_fmt))
 
 def ffprobe(fn, fmt=None):
   fn = resolve_name(fn)
@@ -88,7 +103,7 @@ def get_index_data(fn: str, index_data: dict|None = None):
 
 def get_video_index(fn):
   assert_hvec(fn)
-  frame_types, dat_len, prefix = hevc_index(fn)
+  frame_types, dat_len, prefix = cached_hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
   probe = ffprobe(fn, "hevc")
   return {
@@ -123,22 +138,97 @@ class FfmpegDecoder:
     return self.iframes[np.searchsorted(self.iframes, frame_idx, side="right") - 1]
 
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
-                   frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
+                   frame_skip: int = 1, prefetch_bytes: int = DEFAULT_PREFETCH_BYTES) -> Generator[tuple[int, np.ndarray], None, None]:
     end_fidx = end_fidx or self.frame_count
-    fidx = start_fidx
-    while fidx < end_fidx:
-      f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
-      # number of frames to discard inside this GOP before the wanted one
-      for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt)):
-        fidx = f_b + i
+    if start_fidx >= end_fidx:
+      return
+    # one ffmpeg process decodes every GOP from the one containing start_fidx up to the one containing end_fidx
+    stream = FfmpegStream(self, self.get_gop_start(start_fidx), self._gop_bounds(end_fidx - 1)[1], prefetch_bytes)
+    try:
+      for fidx, frm in stream:
         if fidx >= end_fidx:
           return
         elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
           yield fidx, frm
-      fidx += 1
+    finally:
+      stream.close()
+
+
+class FfmpegStream:
+  """
+  Persistent ffmpeg pipe decoding frames [start_fidx, end_fidx) of a video, start_fidx must be the start of a GOP.
+  Raw data is fed and frames are read in background threads. Up to prefetch_bytes of decoded frames (at least one)
+  are queued ahead of the consumer, so with a large enough budget the next GOP is decoded while the current one is consumed.
+  """
+  def __init__(self, decoder: FfmpegDecoder, start_fidx: int, end_fidx: int, prefetch_bytes: int = DEFAULT_PREFETCH_BYTES):
+    self.decoder = decoder
+    self.start_fidx, self.end_fidx = start_fidx, end_fidx
+    self.shape = frame_shape(decoder.w, decoder.h, decoder.pix_fmt)
+    self.frame_size = int(np.prod(self.shape))
+
+    self._stop = threading.Event()
+    self._queue: queue.Queue = queue.Queue(maxsize=max(1, prefetch_bytes // self.frame_size))
+    self._proc = subprocess.Popen(ffmpeg_decode_args(decoder.pix_fmt), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self._threads = [threading.Thread(target=self._feed, daemon=True), threading.Thread(target=self._decode, daemon=True)]
+    for t in self._threads:
+      t.start()
+
+  def _feed(self):
+    off_b, off_e = self.decoder.index[self.start_fidx, 1], self.decoder.index[self.end_fidx, 1]
+    try:
+      with FileReader(self.decoder.fn) as f:
+        f.seek(off_b)
+        self._proc.stdin.write(self.decoder.prefix)
+        remaining = off_e - off_b
+        while remaining > 0 and not self._stop.is_set():
+          dat = f.read(min(FEED_CHUNK_SIZE, remaining))
+          if not dat:
+            break
+          self._proc.stdin.write(dat)
+          remaining -= len(dat)
+    except BrokenPipeError:
+      pass
+    except Exception as e:
+      self._put(e)
+    finally:
+      try:
+        self._proc.stdin.close()
+      except BrokenPipeError:
+        pass
+
+  def _decode(self):
+    for fidx in range(self.start_fidx, self.end_fidx):
+      dat = self._proc.stdout.read(self.frame_size)
+      if len(dat) < self.frame_size:
+        if self._proc.wait() != 0 and not self._stop.is_set():
+          self._put(subprocess.CalledProcessError(self._proc.returncode, "ffmpeg"))
+        break
+      if not self._put((fidx, np.frombuffer(dat, dtype=np.uint8).reshape(self.shape))):
+        return
+    self._put(None)
+
+  def _put(self, item) -> bool:
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def __iter__(self) -> Iterator[tuple[int, np.ndarray]]:
+    while (item := self._queue.get()) is not None:
+      if isinstance(item, Exception):
+        raise item
+      yield item
+
+  def close(self):
+    self._stop.set()
+    self._proc.kill()
+    for t in self._threads:
+      t.join()
+    self._proc.stdout.close()
+    self._proc.wait()
 
 def FrameIterator(fn: str, index_data: dict|None=None,
                         pix_fmt: str = "rgb24",
@@ -148,25 +238,49 @@ def FrameIterator(fn: str, index_data: dict|None=None,
     yield frame
 
 class FrameReader:
+  """Random access to the frames of a video. Keeps an ffmpeg process running between reads, use as a context manager or close() it"""
   def __init__(self, fn: str, index_data: dict|None = None,
-               cache_size: int = 30, pix_fmt: str = "rgb24"):
+               cache_size: int = 30, pix_fmt: str = "rgb24", cache_bytes: int|None = None,
+               prefetch_bytes: int = DEFAULT_PREFETCH_BYTES):
+    self.it: Generator[tuple[int, np.ndarray], None, None] | None = None
     self.decoder = FfmpegDecoder(fn, index_data, pix_fmt)
     self.iframes = self.decoder.iframes
-    self._cache: LRUCache = LRUCache(cache_size)
+    self._cache: LRUCache = LRUCache(cache_size, cache_bytes)
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
     self.pix_fmt = pix_fmt
-
-    self.it: Iterator[tuple[int, np.ndarray]] | None = None
+    self.prefetch_bytes = prefetch_bytes
     self.fidx = -1
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __del__(self):
+    # safety net for readers that aren't closed, don't leave ffmpeg running
+    self.close()
+
   def get(self, fidx:int):
     if fidx in self._cache:  # If frame is cached, return it
       return self._cache[fidx]
     read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
-      self.it = self.decoder.get_iterator(read_start)
+    # Keep decoding from the running stream unless seeking backwards or skipping whole GOPs
+    if not self.it or fidx < self.fidx or read_start > self.fidx + 1:
+      self.close()
+      self.it = self.decoder.get_iterator(read_start, prefetch_bytes=self.prefetch_bytes)
       self.fidx = -1
-    while self.fidx < fidx:
-      self.fidx, frame = next(self.it)
-      self._cache[self.fidx] = frame
+    try:
+      while self.fidx < fidx:
+        self.fidx, frame = next(self.it)
+        self._cache[self.fidx] = frame
+    except (StopIteration, subprocess.CalledProcessError) as e:
+      last_fidx = self.fidx
+      self.close()
+      raise DataUnreadableError(f"failed to decode frame {fidx} of {self.decoder.fn}, ffmpeg stopped after frame {last_fidx}") from e
     return self._cache[fidx]
+
+  def close(self):
+    if self.it is not None:
+      self.it.close()
+      self.it = None
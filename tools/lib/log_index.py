@@ -0,0 +1,79 @@
+import os
+import numpy as np
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import file_cache_key, sidecar_path_for_file_path
+
+# bump when the on-disk layout changes, old indexes are rebuilt
+INDEX_VERSION = 1
+INDEX_EXT = ".index.npz"
+
+
+def log_index_key(fn: str) -> str:
+  return file_cache_key(fn)
+
+
+def log_index_path(fn: str) -> str:
+  return sidecar_path_for_file_path(fn, INDEX_EXT)
+
+
+class LogIndex:
+  """Maps each Event union type to the decompressed byte offsets and logMonoTimes of its events."""
+  def __init__(self, key: str, types: list[str], type_ids: np.ndarray, offsets: np.ndarray, mono_times: np.ndarray):
+    self.key = key
+    self.types = types
+    self.type_ids = type_ids
+    self.offsets = offsets
+    self.mono_times = mono_times
+    self._type_lookup = {typ: i for i, typ in enumerate(types)}
+
+  @classmethod
+  def from_entries(cls, key: str, entries) -> 'LogIndex':
+    """entries is an iterable of (which or None for non-union events, offset, logMonoTime)"""
+    types: dict[str, int] = {}
+    type_ids, offsets, mono_times = [], [], []
+    for which, offset, mono_time in entries:
+      type_ids.append(-1 if which is None else types.setdefault(which, len(types)))
+      offsets.append(offset)
+      mono_times.append(mono_time)
+    return cls(key, list(types), np.array(type_ids, dtype=np.int16), np.array(offsets, dtype=np.uint64), np.array(mono_times, dtype=np.uint64))
+
+  def __len__(self) -> int:
+    return len(self.offsets)
+
+  def __contains__(self, msg_type: str) -> bool:
+    return msg_type in self._type_lookup
+
+  @property
+  def all_union_types(self) -> bool:
+    """False if some events don't have a known union type"""
+    return not bool(np.any(self.type_ids < 0))
+
+  def lookup(self, msg_types: list[str] | None = None, start_time: int | None = None, end_time: int | None = None) -> np.ndarray:
+    """Returns the sorted offsets of events matching the types and [start_time, end_time) window"""
+    mask = np.ones(len(self), dtype=bool)
+    if msg_types is not None:
+      ids = [self._type_lookup[t] for t in msg_types if t in self._type_lookup]
+      mask &= np.isin(self.type_ids, ids)
+    if start_time is not None:
+      mask &= self.mono_times >= start_time
+    if end_time is not None:
+      mask &= self.mono_times < end_time
+    return self.offsets[mask]
+
+  def save(self, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+      np.savez(f, version=np.array(INDEX_VERSION), key=np.array(self.key), types=np.array(self.types, dtype=str),
+               type_ids=self.type_ids, offsets=self.offsets, mono_times=self.mono_times)
+
+  @classmethod
+  def load(cls, path: str, key: str) -> 'LogIndex | None':
+    """Returns None if there is no index or it's stale"""
+    try:
+      with np.load(path, allow_pickle=False) as dat:
+        if int(dat['version']) != INDEX_VERSION or str(dat['key']) != key:
+          return None
+        return cls(key, [str(t) for t in dat['types']], dat['type_ids'], dat['offsets'], dat['mono_times'])
+    except (OSError, KeyError, ValueError):
+      return None
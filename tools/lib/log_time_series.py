@@ -1,5 +1,16 @@
 import numpy as np
 
+# not supported yet
+SKIPPED_TYPES = ('qcomGnss', 'ubloxGnss')
+
+NUMERIC_TYPES = {
+  'bool': np.bool_,
+  'int8': np.int8, 'int16': np.int16, 'int32': np.int32, 'int64': np.int64,
+  'uint8': np.uint8, 'uint16': np.uint16, 'uint32': np.uint32, 'uint64': np.uint64,
+  'float32': np.float32, 'float64': np.float64,
+}
+INITIAL_COLUMN_SIZE = 256
+
 
 def flatten_type_dict(d, sep="/", prefix=None):
   res = {}
@@ -16,64 +27,212 @@ def flatten_type_dict(d, sep="/", prefix=None):
     return {prefix: d}
 
 
-def get_message_dict(message, typ):
-  valid = message.valid
-  message = message._get(typ)
-  if not hasattr(message, 'to_dict') or typ in ('qcomGnss', 'ubloxGnss'):
-    # TODO: support these
-    #print("skipping", typ)
-    return
+def potentially_ragged_array(arr, dtype=None, **kwargs):
+  # TODO: is there a better way to detect inhomogeneous shapes?
+  try:
+    return np.array(arr, dtype=dtype, **kwargs)
+  except ValueError:
+    return _object_array(arr)
 
-  msg_dict = message.to_dict(verbose=True)
-  msg_dict = flatten_type_dict(msg_dict)
-  msg_dict['_valid'] = valid
-  return msg_dict
 
+def _object_array(items):
+  # np.array tries to broadcast equal length sequences, fill element-wise instead
+  out = np.empty(len(items), dtype=object)
+  for i, item in enumerate(items):
+    out[i] = item
+  return out
 
-def append_dict(path, t, d, values):
-  if path not in values:
-    group = {}
-    group["t"] = []
-    for k in d:
-      group[k] = []
-    values[path] = group
-  else:
-    group = values[path]
 
-  group["t"].append(t)
-  for k, v in d.items():
-    group[k].append(v)
+class _Column:
+  """
+    Growable, preallocated array for scalar fields. Everything else is collected in a list.
+    Sparse columns (under a union) also record the rows they have values for.
+  """
+  def __init__(self, dtype=None, sparse=False):
+    self.dtype = dtype
+    self.size = 0
+    self.data = np.empty(INITIAL_COLUMN_SIZE, dtype=dtype) if dtype is not None else []
+    self.rows = [] if sparse else None
+
+  def append(self, value, row):
+    if self.rows is not None:
+      self.rows.append(row)
+    if self.dtype is None:
+      self.data.append(value)
+      return
+    if self.size == len(self.data):
+      self.data = np.resize(self.data, 2 * self.size)
+    self.data[self.size] = value
+    self.size += 1
+
+  def finish(self, n_rows):
+    arr = potentially_ragged_array(self.data) if self.dtype is None else self.data[:self.size]
+    if self.rows is None or len(self.rows) == n_rows:
+      return arr
+
+    # union member that wasn't always active, None where it wasn't
+    out = np.full(n_rows, None, dtype=object)
+    for row, value in zip(self.rows, arr, strict=True):
+      out[row] = value
+    return out
+
+
+def _convert_list(value, elem_type):
+  if elem_type == 'struct':
+    return np.array([v.to_dict(verbose=True) for v in value])
+  elif elem_type in ('enum', 'text'):
+    return np.array([str(v) for v in value])
+  return np.array(list(value))
+
+
+def _wanted(path, whitelist):
+  # a path is extracted if it's whitelisted, or a parent or child of a whitelisted path
+  return whitelist is None or any(path == w or path.startswith(w + "/") or w.startswith(path + "/") for w in whitelist)
+
+
+def _plan_field(reader, name, path, whitelist, columns, sparse):
+  """Returns the plan node of one field, or None if it has no values"""
+  proto = reader.schema.fields[name].proto
+  if proto.which() == 'group':
+    return (name, _build_plan(getattr(reader, name), path, whitelist, columns, sparse))
+
+  typ = proto.slot.type.which()
+  if typ == 'struct':
+    return (name, _build_plan(getattr(reader, name), path, whitelist, columns, sparse))
+  elif typ in NUMERIC_TYPES:
+    columns[path] = _Column(NUMERIC_TYPES[typ], sparse)
+    return (name, None, columns[path])
+  elif typ in ('enum', 'text', 'data', 'void'):
+    columns[path] = _Column(sparse=sparse)
+    return (name, str if typ in ('enum', 'text') else None, columns[path])
+  elif typ == 'list':
+    columns[path] = _Column(sparse=sparse)
+    elem_type = proto.slot.type.list.elementType.which()
+    return (name, lambda v, elem_type=elem_type: _convert_list(v, elem_type), columns[path])
+  # anyPointer and interface fields have no values
+  return None
+
+
+class _UnionPlan:
+  """Plans of the members of a union, each built the first time that member is active"""
+  def __init__(self, prefix, whitelist, columns):
+    self.prefix = prefix
+    self.whitelist = whitelist
+    self.columns = columns
+    self.members = {}
+
+  def run(self, reader, row):
+    which = reader.which()
+    if which not in self.members:
+      path = which if self.prefix is None else self.prefix + "/" + which
+      node = _plan_field(reader, which, path, self.whitelist, self.columns, True) if _wanted(path, self.whitelist) else None
+      self.members[which] = [] if node is None else [node]
+    _run_plan(self.members[which], reader, row)
+
+
+def _build_plan(reader, prefix, whitelist, columns, sparse=False):
+  """
+    Walks the schema of a struct once, returns a list of (field name, converter, column) leaves,
+    (field name, sub plan) nodes for nested structs and groups, and a _UnionPlan for the active union member.
+  """
+  plan = []
+  for name in reader.schema.non_union_fields:
+    path = name if prefix is None else prefix + "/" + name
+    if _wanted(path, whitelist):
+      node = _plan_field(reader, name, path, whitelist, columns, sparse)
+      if node is not None:
+        plan.append(node)
+
+  if len(reader.schema.union_fields) > 0:
+    plan.append(_UnionPlan(prefix, whitelist, columns))
+  return plan
 
 
-def potentially_ragged_array(arr, dtype=None, **kwargs):
-  # TODO: is there a better way to detect inhomogeneous shapes?
-  try:
-    return np.array(arr, dtype=dtype, **kwargs)
-  except ValueError:
-    return np.array(arr, dtype=object, **kwargs)
+def _run_plan(plan, reader, row):
+  for node in plan:
+    if isinstance(node, _UnionPlan):
+      node.run(reader, row)
+      continue
 
-def msgs_to_time_series(msgs):
+    value = getattr(reader, node[0])
+    if len(node) == 2:
+      _run_plan(node[1], value, row)
+    else:
+      _, convert, column = node
+      column.append(value if convert is None else convert(value), row)
+
+
+def _is_struct_type(msg, typ):
+  return msg.schema.fields[typ].proto.slot.type.which() == 'struct'
+
+
+def _sort_by_time(values):
+  for group in values.values():
+    order = np.argsort(group["t"], kind="stable")
+    for name, group_values in group.items():
+      group[name] = group_values[order]
+  return values
+
+
+def msgs_to_time_series(msgs, fields: dict[str, list[str] | None] | None = None):
   """
     Convert an iterable of canonical capnp messages into a dictionary of time series.
     Each time series has a value with key "t" which consists of monotonically increasing timestamps
     in seconds.
+
+    fields optionally limits extraction to some message types, mapping each type to a whitelist
+    of "/"-separated field paths, or None for all fields of that type.
   """
-  values = {}
+  plans = {}
+  columns = {}
   for msg in msgs:
     typ = msg.which()
-
-    tm = msg.logMonoTime / 1.0e9
-    msg_dict = get_message_dict(msg, typ)
-    if msg_dict is not None:
-      append_dict(typ, tm, msg_dict, values)
-
-  # Sort values by time.
-  for group in values.values():
-    order = np.argsort(group["t"])
-    for name, group_values in group.items():
-      group[name] = potentially_ragged_array(group_values)[order]
-
-  return values
+    if typ not in plans:
+      if typ in SKIPPED_TYPES or (fields is not None and typ not in fields) or not _is_struct_type(msg, typ):
+        plans[typ] = None
+      else:
+        columns[typ] = {"t": _Column(np.float64), "_valid": _Column(np.bool_)}
+        plans[typ] = _build_plan(msg._get(typ), None, fields[typ] if fields is not None else None, columns[typ])
+
+    if plans[typ] is None:
+      continue
+
+    group = columns[typ]
+    row = group["t"].size
+    group["t"].append(msg.logMonoTime / 1.0e9, row)
+    group["_valid"].append(msg.valid, row)
+    _run_plan(plans[typ], msg._get(typ), row)
+
+  ts = {}
+  for typ, group in columns.items():
+    n_rows = group["t"].size
+    ts[typ] = {name: col.finish(n_rows) for name, col in group.items()}
+  return _sort_by_time(ts)
+
+
+def filter_time_series(ts, fields: dict[str, list[str] | None] | None):
+  """Applies a msgs_to_time_series fields whitelist to an already extracted time series."""
+  if fields is None:
+    return ts
+  return {typ: {name: arr for name, arr in group.items() if name in ("t", "_valid") or _wanted(name, fields[typ])}
+          for typ, group in ts.items() if typ in fields}
+
+
+def merge_time_series(parts):
+  """Merge time series of several segments, as returned by msgs_to_time_series."""
+  merged = {}
+  for typ in dict.fromkeys(typ for part in parts for typ in part):
+    groups = [part[typ] for part in parts if typ in part]
+    merged[typ] = {}
+    for name in dict.fromkeys(name for g in groups for name in g):
+      # union members might only be active in some segments
+      arrays = [g[name] if name in g else np.full(len(g["t"]), None, dtype=object) for g in groups]
+      try:
+        merged[typ][name] = np.concatenate(arrays)
+      except ValueError:
+        # ragged across segments
+        merged[typ][name] = _object_array([v for arr in arrays for v in arr])
+  return _sort_by_time(merged)
 
 
 if __name__ == "__main__":
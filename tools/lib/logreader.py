@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
 import bz2
-from functools import cache, partial
+import collections
+from functools import partial
 import multiprocessing
 import capnp
 import enum
+import hashlib
+import io
 import os
 import pathlib
+import struct
 import sys
+import threading
+import time
 import tqdm
 import urllib.parse
 import warnings
 import zstandard as zstd
 
 from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
@@ -20,8 +27,11 @@ from openpilot.common.swaglog import cloudlog
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
 from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
+from openpilot.tools.lib.cache import file_cache_key
+from openpilot.tools.lib.log_index import LogIndex, log_index_key, log_index_path
 from openpilot.tools.lib.route import Route, SegmentRange
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.log_time_series import filter_time_series, merge_time_series, msgs_to_time_series
+from openpilot.tools.lib.time_series_cache import load_time_series, save_time_series, time_series_cache_path
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
@@ -48,41 +58,184 @@ def decompress_stream(data: bytes):
 
   return decompressed_data
 
+# size of compressed reads and decompressed blocks when streaming a log
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+BZ2_MAGIC = b'BZh9'
+# https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+ZST_MAGIC = b'\x28\xB5\x2F\xFD'
+
+
+def _is_compressed(dat) -> bool:
+  magic = bytes(dat[:4])
+  return magic.startswith(BZ2_MAGIC) or magic.startswith(ZST_MAGIC)
+
+
+def _decompressed_chunks(f, ext: str | None, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+  magic = f.read(4)
+  f.seek(0)
+
+  if ext == ".bz2" or magic.startswith(BZ2_MAGIC):
+    dctx = bz2.BZ2Decompressor()
+    while dat := f.read(chunk_size):
+      while dat:
+        yield dctx.decompress(dat)
+        if not dctx.eof:
+          break
+        # multi-stream bz2, continue with the next stream
+        dat, dctx = dctx.unused_data, bz2.BZ2Decompressor()
+  elif ext == ".zst" or magic.startswith(ZST_MAGIC):
+    with zstd.ZstdDecompressor().stream_reader(f, read_size=chunk_size, read_across_frames=True, closefd=False) as reader:
+      while dat := reader.read(chunk_size):
+        yield dat
+  else:
+    while dat := f.read(chunk_size):
+      yield dat
+
+
+def _message_ends(buf: bytearray) -> list[int]:
+  # walk capnp stream framing headers, return the end offsets of the complete messages in buf
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  ends = []
+  pos = 0
+  while len(buf) - pos >= 4:
+    num_segments = struct.unpack_from('<I', buf, pos)[0] + 1
+    header_size = (4 * (num_segments + 1) + 7) & ~7
+    if len(buf) - pos < header_size:
+      break
+    end = pos + header_size + 8 * sum(struct.unpack_from(f'<{num_segments}I', buf, pos + 4))
+    if end > len(buf):
+      break
+    ends.append(end)
+    pos = end
+  return ends
+
+
+def _raw_messages(chunks: Iterable[bytes]) -> Iterator[tuple[int, memoryview]]:
+  # yields (offset in the decompressed log, serialized message)
+  buf = bytearray()
+  offset = 0
+  for dat in chunks:
+    buf += dat
+    ends = _message_ends(buf)
+    if not ends:
+      continue
+    block = memoryview(bytes(buf[:ends[-1]]))
+    start = 0
+    for end in ends:
+      yield offset + start, block[start:end]
+      start = end
+    offset += ends[-1]
+    del buf[:ends[-1]]
+
+  # trailing bytes are an incomplete message, let capnp raise on them
+  if len(buf):
+    yield offset, memoryview(bytes(buf))
+
+
+def read_events_streaming(chunks: Iterable[bytes]) -> Iterator[capnp._DynamicStructReader]:
+  buf = bytearray()
+  for dat in chunks:
+    buf += dat
+    ends = _message_ends(buf)
+    if ends:
+      yield from capnp_log.Event.read_multiple_bytes(bytes(buf[:ends[-1]]))
+      del buf[:ends[-1]]
+
+  # trailing bytes are an incomplete message, let capnp raise on them
+  if len(buf):
+    yield from capnp_log.Event.read_multiple_bytes(bytes(buf))
+
+
+def _log_ext(fn: str) -> str:
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ('', '.bz2', '.zst'):
+    # old rlogs weren't compressed
+    raise ValueError(f"unknown extension {ext}")
+  return ext
+
+
+def get_log_index(fn: str) -> LogIndex:
+  """Loads the message type index of a log, building it with a single pass over the log if it's missing or stale."""
+  key = log_index_key(fn)
+  path = log_index_path(fn)
+  index = LogIndex.load(path, key)
+  if index is not None:
+    return index
+
+  def entries():
+    with FileReader(fn) as f:
+      for offset, msg in _raw_messages(_decompressed_chunks(f, _log_ext(fn))):
+        try:
+          for ent in capnp_log.Event.read_multiple_bytes(bytes(msg)):
+            try:
+              yield ent.which(), offset, ent.logMonoTime
+            except capnp.KjException:
+              yield None, offset, ent.logMonoTime
+        except capnp.KjException:
+          warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+          return
+
+  index = LogIndex.from_entries(key, entries())
+  index.save(path)
+  return index
+
+
+def read_indexed_events(fn: str, offsets) -> Iterator[capnp._DynamicStructReader]:
+  """Decodes only the events at the given decompressed offsets, stops reading after the last one."""
+  if not len(offsets):
+    return
+  wanted = set(offsets.tolist())
+  last = max(wanted)
+  with FileReader(fn) as f:
+    for offset, msg in _raw_messages(_decompressed_chunks(f, _log_ext(fn))):
+      if offset in wanted:
+        yield from capnp_log.Event.read_multiple_bytes(bytes(msg))
+      if offset >= last:
+        break
+
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, streaming=False):
     self.data_version = None
+    self._fn = fn
+    self._dat = dat
     self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
 
-    ext = None
-    if not dat:
-      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-      if ext not in ('', '.bz2', '.zst'):
-        # old rlogs weren't compressed
-        raise ValueError(f"unknown extension {ext}")
-
-      with FileReader(fn) as f:
-        dat = f.read()
-
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
-      dat = decompress_stream(dat)
+    self._ext = None if dat else _log_ext(fn)
 
-    ents = capnp_log.Event.read_multiple_bytes(dat)
+    # streaming readers decode events lazily on every iteration, sorting needs all events up front
+    self._ents: list[capnp._DynamicStructReader] | None = None
+    if not streaming or sort_by_time:
+      self._ents = list(self._read_events())
+      if sort_by_time:
+        self._ents.sort(key=lambda x: x.logMonoTime)
 
-    self._ents = []
-    try:
-      for e in ents:
-        self._ents.append(e)
-    except capnp.KjException:
-      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+  @property
+  def cache_key(self) -> str:
+    """Identifies the events of this reader, for caching data derived from them"""
+    source = hashlib.sha256(self._dat).hexdigest() if self._dat else file_cache_key(self._fn)
+    return f"{source}:{self._sort_by_time}:{self._only_union_types}"
+
+  def _read_events(self) -> Iterator[capnp._DynamicStructReader]:
+    if self._dat and not _is_compressed(self._dat):
+      # already decompressed buffers (e.g. mmaps) are read in place, without copying
+      try:
+        yield from capnp_log.Event.read_multiple_bytes(self._dat)
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+      return
 
-    if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+    with (io.BytesIO(self._dat) if self._dat else FileReader(self._fn)) as f:
+      try:
+        yield from read_events_streaming(_decompressed_chunks(f, self._ext))
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in (self._ents if self._ents is not None else self._read_events()):
       if self._only_union_types:
         try:
           ent.which()
@@ -93,6 +246,21 @@ class _LogFileReader:
         yield ent
 
 
+def _run_on_segment(func, sort_by_time, only_union_types, streaming, fn):
+  # pool workers open the segment themselves, the LogReader and its decoded segments aren't pickled
+  return func(_LogFileReader(fn, sort_by_time=sort_by_time, only_union_types=only_union_types, streaming=streaming))
+
+
+def _segment_time_series(fields, cache, lr: _LogFileReader):
+  if not cache:
+    return msgs_to_time_series(lr, fields)
+
+  # the cache always holds every field, whitelisted ones are selected after loading
+  path = time_series_cache_path(lr._fn)
+  save_time_series(path, msgs_to_time_series(lr))
+  return filter_time_series(load_time_series(path), fields)
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -112,14 +280,41 @@ class LogsUnavailable(Exception):
   pass
 
 
-@cache
+# existence checks are cached for a short while, so source resolution never probes the same path twice
+FILE_EXISTS_TTL = 300
+FILE_EXISTS_WORKERS = 16
+_file_exists_cache: dict[str, tuple[float, bool]] = {}
+_file_exists_lock = threading.Lock()
+
+
+def cached_file_exists(fn: str) -> bool:
+  with _file_exists_lock:
+    cached = _file_exists_cache.get(fn)
+  if cached is not None and time.monotonic() - cached[0] < FILE_EXISTS_TTL:
+    return cached[1]
+
+  exists = file_exists(fn)
+  with _file_exists_lock:
+    _file_exists_cache[fn] = (time.monotonic(), exists)
+  return exists
+
+
 def default_valid_file(fn: LogPath) -> bool:
-  return fn is not None and file_exists(fn)
+  return fn is not None and cached_file_exists(fn)
+
+
+def check_files(files: list[LogPath], valid_file: ValidFileCallable = default_valid_file) -> list[bool]:
+  """Runs valid_file on all files concurrently, results are in the same order as files"""
+  if len(files) <= 1:
+    return [valid_file(f) for f in files]
+  with ThreadPoolExecutor(max_workers=min(FILE_EXISTS_WORKERS, len(files))) as executor:
+    return list(executor.map(valid_file, files))
 
 
 def auto_strategy(rlog_paths: list[LogPath], qlog_paths: list[LogPath], interactive: bool, valid_file: ValidFileCallable) -> list[LogPath]:
   # auto select logs based on availability
-  missing_rlogs = [rlog is None or not valid_file(rlog) for rlog in rlog_paths].count(True)
+  valid_rlogs = check_files(rlog_paths, valid_file)
+  missing_rlogs = valid_rlogs.count(False)
   if missing_rlogs != 0:
     if interactive:
       if input(f"{missing_rlogs}/{len(rlog_paths)} rlogs were not found, would you like to fallback to qlogs for those segments? (y/n) ").lower() != "y":
@@ -127,8 +322,9 @@ def auto_strategy(rlog_paths: list[LogPath], qlog_paths: list[LogPath], interact
     else:
       cloudlog.warning(f"{missing_rlogs}/{len(rlog_paths)} rlogs were not found, falling back to qlogs for those segments...")
 
-    return [rlog if valid_file(rlog) else (qlog if valid_file(qlog) else None)
-            for (rlog, qlog) in zip(rlog_paths, qlog_paths, strict=True)]
+    valid_qlogs = check_files([qlog for qlog, valid in zip(qlog_paths, valid_rlogs, strict=True) if not valid], valid_file)[::-1]
+    return [rlog if valid else (qlog if valid_qlogs.pop() else None)
+            for (rlog, qlog, valid) in zip(rlog_paths, qlog_paths, valid_rlogs, strict=True)]
   return rlog_paths
 
 
@@ -201,8 +397,9 @@ def direct_source(file_or_url: str) -> list[LogPath]:
 
 
 def get_invalid_files(files):
-  for f in files:
-    if f is None or not file_exists(f):
+  files = list(files)
+  for f, valid in zip(files, check_files(files), strict=True):
+    if not valid:
       yield f
 
 
@@ -275,7 +472,8 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               source: Source = auto_source, sort_by_time=False, only_union_types=False):
+               source: Source = auto_source, sort_by_time=False, only_union_types=False, streaming=False, use_index=False,
+               cache_time_series=False, prefetch=0):
     self.default_mode = default_mode
     self.source = source
     self.identifier = identifier
@@ -284,30 +482,81 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.streaming = streaming
+    # seek straight to the events needed by filter/first using per-log type index sidecars
+    self.use_index = use_index
+    # keep decoded time series columns of each log in the cache dir, memory-mapped on later reads
+    self.cache_time_series = cache_time_series
+    # number of segments downloaded and decoded in the background ahead of iteration
+    self.prefetch = prefetch
 
     self.__lrs: dict[int, _LogFileReader] = {}
     self.reset()
 
+  def _new_lr(self, i):
+    return _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                          streaming=self.streaming)
+
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = self._new_lr(i)
     return self.__lrs[i]
 
+  def _iter_prefetch(self):
+    # Segments are yielded in order while the next ones are read in worker threads. Prefetched readers aren't kept
+    # around after iteration, so at most prefetch + 1 decoded segments are held at once.
+    num_segs = len(self.logreader_identifiers)
+    executor = ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix="logreader_prefetch")
+    pending: collections.deque[Future] = collections.deque()
+
+    def submit(i):
+      if i in self.__lrs:
+        fut: Future = Future()
+        fut.set_result(self.__lrs[i])
+        pending.append(fut)
+      else:
+        pending.append(executor.submit(self._new_lr, i))
+
+    try:
+      for i in range(min(self.prefetch, num_segs)):
+        submit(i)
+      next_seg = len(pending)
+      while pending:
+        lr = pending.popleft().result()
+        if next_seg < num_segs:
+          submit(next_seg)
+          next_seg += 1
+        yield from lr
+        del lr
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
+
   def __iter__(self):
+    if self.prefetch > 0:
+      yield from self._iter_prefetch()
+      return
+
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
-  def _run_on_segment(self, func, i):
-    return func(self._get_lr(i))
+  def _imap_segments(self, pool, func, segs):
+    run = partial(_run_on_segment, func, self.sort_by_time, self.only_union_types, self.streaming)
+    return pool.imap(run, [self.logreader_identifiers[i] for i in segs])
 
   def run_across_segments(self, num_processes, func, disable_tqdm=False, desc=None):
     with multiprocessing.Pool(num_processes) as pool:
       ret = []
       num_segs = len(self.logreader_identifiers)
-      for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, disable=disable_tqdm, desc=desc):
+      for p in tqdm.tqdm(self._imap_segments(pool, func, range(num_segs)), total=num_segs, disable=disable_tqdm, desc=desc):
         ret.extend(p)
       return ret
 
+  @property
+  def cache_key(self) -> str:
+    """Identifies the events of this reader, for caching data derived from them"""
+    sources = "|".join(file_cache_key(fn) for fn in self.logreader_identifiers)
+    return f"{sources}:{self.sort_by_time}:{self.only_union_types}"
+
   def reset(self):
     self.logreader_identifiers = []
     for identifier in self.identifier:
@@ -317,15 +566,56 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
-  def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+  def _filter_segment(self, i, msg_type: str, start_time: int | None, end_time: int | None):
+    fn = self.logreader_identifiers[i]
+    index = get_log_index(fn) if self.use_index and i not in self.__lrs else None
+    # the index skips events without a known union type, a full read only does that with only_union_types
+    if index is not None and (self.only_union_types or index.all_union_types):
+      msgs = read_indexed_events(fn, index.lookup([msg_type], start_time, end_time))
+      if self.sort_by_time:
+        msgs = iter(sorted(msgs, key=lambda m: m.logMonoTime))
+    else:
+      msgs = filter(lambda m: m.which() == msg_type, self._get_lr(i))
+      if start_time is not None or end_time is not None:
+        msgs = filter(lambda m: (start_time is None or m.logMonoTime >= start_time) and (end_time is None or m.logMonoTime < end_time), msgs)
+    return (getattr(m, m.which()) for m in msgs)
+
+  def filter(self, msg_type: str, start_time: int | None = None, end_time: int | None = None):
+    """Messages of msg_type, optionally limited to logMonoTime in [start_time, end_time)"""
+    for i in range(len(self.logreader_identifiers)):
+      yield from self._filter_segment(i, msg_type, start_time, end_time)
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def _load_cached_time_series(self, i):
+    return load_time_series(time_series_cache_path(self.logreader_identifiers[i]))
+
+  def get_time_series(self, fields: dict[str, list[str] | None] | None = None, workers: int = 0):
+    """Time series of all segments, see msgs_to_time_series for fields. With workers > 1, segments are extracted in a process pool."""
+    parts = {}
+    if self.cache_time_series:
+      for i in range(len(self.logreader_identifiers)):
+        ts = self._load_cached_time_series(i)
+        if ts is not None:
+          parts[i] = filter_time_series(ts, fields)
+
+    missing = [i for i in range(len(self.logreader_identifiers)) if i not in parts]
+    func = partial(_segment_time_series, fields, self.cache_time_series)
+    if workers > 1 and len(missing) > 1:
+      with multiprocessing.Pool(min(len(missing), workers)) as pool:
+        parts.update(zip(missing, self._imap_segments(pool, func, missing), strict=True))
+    else:
+      for i in missing:
+        parts[i] = func(self._get_lr(i))
+
+    if len(parts) == 1:
+      return next(iter(parts.values()))
+    return merge_time_series([parts[i] for i in sorted(parts)])
+
   @property
   def time_series(self):
-    return msgs_to_time_series(self)
+    return self.get_time_series()
 
 if __name__ == "__main__":
   import codecs
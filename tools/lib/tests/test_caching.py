@@ -6,7 +6,7 @@ import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.url_file import ChunkCacheIndex, URLFile
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -128,3 +128,19 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  def test_cache_eviction(self, tmp_path):
+    for i in range(5):
+      (tmp_path / f"chunk_{i}").write_bytes(b"0" * 100)
+      os.utime(tmp_path / f"chunk_{i}", (i, i))
+    (tmp_path / "chunk_length").write_text("100")
+
+    index = ChunkCacheIndex(str(tmp_path), limit=500)
+    assert index.size == 500
+
+    # chunk_0 is used again, the next least recently used chunks get evicted
+    index.touch("chunk_0")
+    (tmp_path / "chunk_5").write_bytes(b"0" * 100)
+    index.add("chunk_5", 100)
+    assert index.size <= 450
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["chunk_0", "chunk_3", "chunk_4", "chunk_5", "chunk_length"]
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.exceptions import DataUnreadableError
+from openpilot.tools.lib.framereader import HEVC_SLICE_I, HEVC_SLICE_P, FfmpegDecoder, FfmpegStream, FrameReader, LRUCache
+
+W, H = 8, 4
+FRAME_COUNT = 20
+GOP_SIZE = 5
+FRAME_SIZE = W * H * 3
+
+
+@pytest.fixture
+def raw_video(tmp_path, monkeypatch):
+  # uncompressed frames, passed through cat instead of ffmpeg
+  monkeypatch.setattr(framereader, "ffmpeg_decode_args", lambda *args, **kwargs: ["cat"])
+
+  fn = str(tmp_path / "video.raw")
+  frames = [np.full((H, W, 3), i, dtype=np.uint8) for i in range(FRAME_COUNT)]
+  with open(fn, "wb") as f:
+    for frm in frames:
+      f.write(frm.tobytes())
+
+  index = [(HEVC_SLICE_I if i % GOP_SIZE == 0 else HEVC_SLICE_P, i * FRAME_SIZE) for i in range(FRAME_COUNT)]
+  index_data = {
+    'index': np.array(index + [(0xFFFFFFFF, FRAME_COUNT * FRAME_SIZE)], dtype=np.uint32),
+    'global_prefix': b"",
+    'probe': {'streams': [{'width': W, 'height': H}]},
+  }
+  return fn, index_data, frames
+
+
+class TestFrameReader:
+  @pytest.mark.parametrize("prefetch_bytes", [0, FRAME_SIZE * GOP_SIZE, 1024 * 1024])
+  def test_stream_sequential(self, raw_video, prefetch_bytes):
+    fn, index_data, frames = raw_video
+    decoder = FfmpegDecoder(fn, index_data)
+
+    stream = FfmpegStream(decoder, 0, FRAME_COUNT, prefetch_bytes)
+    try:
+      out = list(stream)
+    finally:
+      stream.close()
+    assert [fidx for fidx, _ in out] == list(range(FRAME_COUNT))
+    for fidx, frm in out:
+      assert np.array_equal(frm, frames[fidx])
+
+    out = list(decoder.get_iterator(7, 16, frame_skip=3, prefetch_bytes=prefetch_bytes))
+    assert [fidx for fidx, _ in out] == [7, 10, 13]
+    for fidx, frm in out:
+      assert np.array_equal(frm, frames[fidx])
+
+  def test_stream_close_early(self, raw_video):
+    fn, index_data, _ = raw_video
+    stream = FfmpegStream(FfmpegDecoder(fn, index_data), 0, FRAME_COUNT, FRAME_SIZE)
+    assert next(iter(stream))[0] == 0
+    # the background threads are blocked on a full queue, closing must not hang
+    stream.close()
+
+  def test_seek(self, raw_video):
+    fn, index_data, frames = raw_video
+    with FrameReader(fn, index_data, cache_size=2) as fr:
+      for fidx in [0, 1, 2, 12, 13, 3, 19, 18, 4, 0]:
+        assert np.array_equal(fr.get(fidx), frames[fidx]), fidx
+    assert fr.it is None
+
+  @pytest.mark.parametrize("exit_code", [0, 1])
+  def test_ffmpeg_exits_early(self, raw_video, monkeypatch, exit_code):
+    fn, index_data, frames = raw_video
+    # only the first 3 frames come out
+    monkeypatch.setattr(framereader, "ffmpeg_decode_args", lambda *args, **kwargs: ["sh", "-c", f"head -c {3 * FRAME_SIZE}; cat > /dev/null; exit {exit_code}"])
+
+    with FrameReader(fn, index_data) as fr:
+      assert np.array_equal(fr.get(2), frames[2])
+      with pytest.raises(DataUnreadableError, match="frame 3 "):
+        fr.get(3)
+      # the failed stream is closed, earlier frames are still readable
+      assert fr.it is None
+      assert np.array_equal(fr.get(1), frames[1])
+
+  def test_cache_byte_bound(self):
+    frm = np.zeros(100, dtype=np.uint8)
+    cache = LRUCache(capacity=10, max_bytes=250)
+    for i in range(5):
+      cache[i] = frm
+    assert cache.nbytes == 200
+    assert [i for i in range(5) if i in cache] == [3, 4]
+
+    # recently used frames are kept
+    _ = cache[3]
+    cache[5] = frm
+    assert [i for i in range(6) if i in cache] == [3, 5]
+
+    # replacing a frame doesn't leak its size
+    cache[5] = np.zeros(50, dtype=np.uint8)
+    assert cache.nbytes == 150
+
+    # a single frame larger than the bound is still cached
+    cache[6] = np.zeros(1000, dtype=np.uint8)
+    assert [i for i in range(7) if i in cache] == [6]
+    assert cache.nbytes == 1000
+
+    cache = LRUCache(capacity=2)
+    for i in range(5):
+      cache[i] = frm
+    assert [i for i in range(5) if i in cache] == [3, 4]
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import numpy as np
+
+from cereal import log as capnp_log
+from openpilot.tools.lib.log_time_series import filter_time_series, flatten_type_dict, merge_time_series, msgs_to_time_series
+from openpilot.tools.lib.time_series_cache import load_time_series, save_time_series
+
+
+def make_msgs(n, start=0):
+  msgs = []
+  for i in range(start, start + n):
+    msg = capnp_log.Event.new_message(logMonoTime=int(i * 1e7), valid=bool(i % 2))
+    cs = msg.init('carState')
+    cs.vEgo = i * 0.5
+    cs.gearShifter = 'drive'
+    cs.cruiseState.speed = i
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+def make_controls_msgs(n, start=0, lateral='torqueState'):
+  msgs = []
+  for i in range(start, start + n):
+    msg = capnp_log.Event.new_message(logMonoTime=int(i * 1e7), valid=True)
+    cs = msg.init('controlsState')
+    cs.curvature = i * 0.01
+    lat = cs.lateralControlState.init(lateral)
+    lat.active = True
+    lat.output = i
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestLogTimeSeries:
+  def test_matches_to_dict(self):
+    msgs = make_msgs(100)
+    ts = msgs_to_time_series(msgs)['carState']
+
+    expected = flatten_type_dict(msgs[0].carState.to_dict(verbose=True))
+    assert set(expected) | {"t", "_valid"} >= set(k for k in ts if not isinstance(ts[k][0], np.ndarray))
+    assert len(ts["t"]) == 100
+    np.testing.assert_allclose(ts["vEgo"], [m.carState.vEgo for m in msgs])
+    np.testing.assert_allclose(ts["cruiseState/speed"], np.arange(100))
+    assert list(ts["_valid"]) == [m.valid for m in msgs]
+    assert set(ts["gearShifter"]) == {"drive"}
+
+  def test_whitelist(self):
+    ts = msgs_to_time_series(make_msgs(10), fields={"carState": ["vEgo", "cruiseState/speed"]})
+    assert set(ts["carState"]) == {"t", "_valid", "vEgo", "cruiseState/speed"}
+    assert msgs_to_time_series(make_msgs(10), fields={"controlsState": None}) == {}
+
+  def test_merge(self):
+    parts = [msgs_to_time_series(make_msgs(10, start=10)), msgs_to_time_series(make_msgs(10))]
+    merged = merge_time_series(parts)["carState"]
+    full = msgs_to_time_series(make_msgs(20))["carState"]
+    assert set(merged) == set(full)
+    for k in full:
+      assert np.array_equal(merged[k], full[k]), k
+
+  def test_cache_round_trip(self):
+    ts = msgs_to_time_series(make_msgs(10))
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, "entry")
+      assert load_time_series(path) is None
+      save_time_series(path, ts)
+      cached = load_time_series(path)
+
+      assert set(cached) == set(ts)
+      for k in ts["carState"]:
+        assert np.array_equal(cached["carState"][k], ts["carState"][k]), k
+      assert set(filter_time_series(cached, {"carState": ["vEgo"]})["carState"]) == {"t", "_valid", "vEgo"}
+
+  def test_union(self):
+    msgs = make_controls_msgs(10)
+    ts = msgs_to_time_series(msgs)['controlsState']
+
+    expected = flatten_type_dict(msgs[0].controlsState.to_dict(verbose=True))
+    assert "lateralControlState/torqueState/output" in expected
+    assert set(expected) | {"t", "_valid"} == set(ts)
+    np.testing.assert_allclose(ts["lateralControlState/torqueState/output"], np.arange(10))
+
+    # the active member changes, rows where a member isn't active are None
+    ts = msgs_to_time_series(make_controls_msgs(5) + make_controls_msgs(5, start=5, lateral='pidState'))['controlsState']
+    assert list(ts["lateralControlState/torqueState/output"]) == [0, 1, 2, 3, 4] + [None] * 5
+    assert list(ts["lateralControlState/pidState/output"]) == [None] * 5 + [5, 6, 7, 8, 9]
+
+    merged = merge_time_series([msgs_to_time_series(make_controls_msgs(5)), msgs_to_time_series(make_controls_msgs(5, start=5, lateral='pidState'))])
+    assert list(merged["controlsState"]["lateralControlState/pidState/output"]) == [None] * 5 + [5, 6, 7, 8, 9]
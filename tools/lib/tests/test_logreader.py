@@ -1,6 +1,7 @@
 import capnp
 import contextlib
 import io
+import numpy as np
 import shutil
 import tempfile
 import os
@@ -10,7 +11,10 @@ import requests
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException, save_log, \
+                                           apply_strategy, get_invalid_files
+from openpilot.tools.lib.log_index import log_index_path
+from openpilot.tools.lib.log_time_series import msgs_to_time_series
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
 
@@ -254,3 +258,111 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_streaming(self, ext):
+    msgs = [capnp_log.Event.new_message(logMonoTime=i) for i in range(1000)]
+    with tempfile.NamedTemporaryFile(suffix=f"rlog{ext}") as rlog:
+      save_log(rlog.name, msgs)
+
+      eager = LogReader(rlog.name)
+      streaming = LogReader(rlog.name, streaming=True)
+      assert [m.logMonoTime for m in streaming] == [m.logMonoTime for m in eager] == list(range(1000))
+      # streaming readers can be iterated multiple times
+      assert len(list(streaming)) == len(list(streaming))
+
+  def test_index(self):
+    msgs = [capnp_log.Event.new_message(logMonoTime=i, **({"carParams": {}} if i % 10 == 0 else {"can": []})) for i in range(1000)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog.zst")
+      save_log(fn, msgs)
+
+      lr = LogReader(fn, use_index=True)
+      assert len(list(lr.filter("carParams"))) == 100
+      assert len(list(lr.filter("carParams", start_time=100, end_time=200))) == 10
+      assert lr.first("sendcan") is None
+      assert os.path.exists(log_index_path(fn))
+
+      # stale index is rebuilt
+      save_log(fn, msgs[:500])
+      assert len(list(LogReader(fn, use_index=True).filter("carParams"))) == 50
+      assert len(list(LogReader(fn).filter("carParams"))) == 50
+
+  @pytest.mark.parametrize("sort_by_time", [False, True])
+  @pytest.mark.parametrize("only_union_types", [False, True])
+  def test_index_matches_full_read(self, sort_by_time, only_union_types):
+    # out of order logMonoTimes
+    msgs = [capnp_log.Event.new_message(logMonoTime=(i * 37) % 1000, **({"logMessage": str(i)} if i % 10 == 0 else {"can": []})) for i in range(1000)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "rlog")
+      with open(fn, "wb") as f:
+        f.write(b"".join(m.to_bytes() for m in msgs))
+
+      def read(fn, use_index, *args):
+        lr = LogReader(fn, sort_by_time=sort_by_time, only_union_types=only_union_types, use_index=use_index)
+        return list(lr.filter("logMessage", *args))
+
+      for args in [(), (100, 600)]:
+        expected = read(fn, False, *args)
+        assert len(expected) > 0
+        assert read(fn, True, *args) == expected
+
+      # append non-union Event message
+      event_msg = capnp_log.Event.new_message()
+      non_union_bytes = bytearray(event_msg.to_bytes())
+      non_union_bytes[event_msg.total_size.word_count * 8] = 0xff
+      with open(fn, "ab") as f:
+        f.write(non_union_bytes)
+
+      if only_union_types:
+        assert read(fn, True) == read(fn, False)
+      else:
+        for use_index in (False, True):
+          with pytest.raises(capnp.KjException):
+            read(fn, use_index)
+
+  @pytest.mark.parametrize("prefetch", [1, 2, 8])
+  def test_prefetch(self, prefetch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(5):
+        fns.append(os.path.join(tmpdir, f"{seg}_rlog.zst"))
+        save_log(fns[-1], [capnp_log.Event.new_message(logMonoTime=seg * 100 + i) for i in range(100)])
+
+      expected = [m.logMonoTime for m in LogReader(fns)]
+      assert expected == list(range(500))
+      assert [m.logMonoTime for m in LogReader(fns, prefetch=prefetch)] == expected
+
+  def test_time_series_workers(self, monkeypatch):
+    def no_pickle(self, protocol):
+      raise AssertionError("LogReader sent to pool workers")
+    monkeypatch.setattr(LogReader, "__reduce_ex__", no_pickle)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(3):
+        fns.append(os.path.join(tmpdir, f"{seg}_rlog"))
+        msgs = [capnp_log.Event.new_message(logMonoTime=seg * 100 + i, controlsState={"curvature": seg + i * 0.01}) for i in range(100)]
+        with open(fns[-1], "wb") as f:
+          f.write(b"".join(m.to_bytes() for m in msgs))
+
+      expected = msgs_to_time_series(LogReader(fns))["controlsState"]
+      for workers in (0, 2):
+        lr = LogReader(fns)
+        # cached readers stay in this process, workers open the segments themselves
+        list(lr)
+        ts = lr.get_time_series(workers=workers)["controlsState"]
+        assert ts.keys() == expected.keys()
+        for k in expected:
+          np.testing.assert_array_equal(ts[k], expected[k])
+
+  def test_file_exists_cache(self, mocker):
+    file_exists_mock = mocker.patch("openpilot.tools.lib.logreader.file_exists", side_effect=lambda fn: "missing" not in fn)
+    mocker.patch.dict("openpilot.tools.lib.logreader._file_exists_cache", clear=True)
+    files = [f"https://example.com/{i}/rlog.zst" for i in range(50)] + ["https://example.com/missing/rlog.zst", None]
+
+    assert list(get_invalid_files(files)) == ["https://example.com/missing/rlog.zst", None]
+    assert list(get_invalid_files(files)) == ["https://example.com/missing/rlog.zst", None]
+    assert apply_strategy(ReadMode.AUTO, files[-2:], ["https://example.com/q", "https://example.com/missing/q"]) == ["https://example.com/q", None]
+    # every path is only probed once
+    assert file_exists_mock.call_count == 53
@@ -0,0 +1,150 @@
+import os
+import random
+
+import pytest
+
+from openpilot.tools.lib import vidindex
+from openpilot.tools.lib.vidindex import (HEVC_CODED_SLICE_SEGMENT_NAL_UNITS, HEVC_PARAMETER_SET_NAL_UNITS, NAL_UNIT_START_CODE, HevcNalUnitType,
+                                          VideoFileInvalid, cached_hevc_index, get_hevc_nal_unit_type, get_hevc_slice_type, hevc_index)
+
+
+def reference_get_ue(dat, start_idx, skip_bits):
+  # bit by bit Exp-Golomb decoding, as vidindex did before the start code scan was vectorized
+  prefix_val = prefix_len = suffix_val = suffix_len = 0
+  for i in range(start_idx, len(dat)):
+    for j in range(7, -1, -1):
+      if skip_bits > 0:
+        skip_bits -= 1
+      elif prefix_val == 0:
+        prefix_val = (dat[i] >> j) & 1
+        prefix_len += 1
+      else:
+        suffix_val = (suffix_val << 1) | ((dat[i] >> j) & 1)
+        suffix_len += 1
+      if prefix_val == 1 and prefix_len - 1 == suffix_len:
+        return 2**(prefix_len - 1) - 1 + suffix_val, prefix_len + suffix_len
+  raise VideoFileInvalid("invalid exponential-golomb code")
+
+
+def reference_hevc_index(dat):
+  # NAL unit by NAL unit walk with bytes.index, as vidindex did before the start code scan was vectorized
+  prefix_dat = b""
+  frame_types = []
+  i = 1
+  while i < len(dat):
+    assert dat[i:i + 3] == NAL_UNIT_START_CODE
+    try:
+      end = dat.index(NAL_UNIT_START_CODE, i + 3)
+    except ValueError:
+      end = len(dat)
+    nal_unit_type = get_hevc_nal_unit_type(dat, i)
+    if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+      prefix_dat += dat[i:end]
+    elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
+      slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
+      if is_first_slice:
+        frame_types.append((slice_type, i))
+    i = end
+  return frame_types, len(dat), prefix_dat
+
+
+class BitWriter:
+  def __init__(self):
+    self.bits = []
+
+  def put(self, val, n):
+    self.bits += [(val >> (n - 1 - i)) & 1 for i in range(n)]
+
+  def put_ue(self, val):
+    n = (val + 1).bit_length()
+    self.put(0, n - 1)
+    self.put(val + 1, n)
+
+  def to_bytes(self):
+    bits = self.bits + [1] + [0] * (-(len(self.bits) + 1) % 8)
+    return bytes(int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+
+
+def escape(payload):
+  # emulation prevention, the payload can't contain a start code
+  out = bytearray()
+  for b in payload:
+    if len(out) >= 2 and out[-1] == 0 and out[-2] == 0 and b <= 3:
+      out.append(3)
+    out.append(b)
+  if len(out) and out[-1] == 0:
+    out.append(0x80)
+  return bytes(out)
+
+
+def nal_unit(nal_unit_type, payload, long_start_code=False):
+  return (b"\x00" if long_start_code else b"") + NAL_UNIT_START_CODE + bytes([nal_unit_type << 1, 1]) + escape(payload)
+
+
+def make_stream(seed, frames=60, gop=20):
+  rng = random.Random(seed)
+  dat = b"\x00"
+  for fidx in range(frames):
+    if fidx % gop == 0:
+      for typ in HEVC_PARAMETER_SET_NAL_UNITS:
+        dat += nal_unit(typ, rng.randbytes(rng.randint(4, 40)))
+      nal_unit_type, slice_type = HevcNalUnitType.IDR_W_RADL, 2
+    else:
+      nal_unit_type, slice_type = HevcNalUnitType.TRAIL_R, rng.choice([0, 1])
+
+    for slice_idx in range(rng.randint(1, 3)):
+      bits = BitWriter()
+      bits.put(slice_idx == 0, 1)
+      if nal_unit_type >= HevcNalUnitType.BLA_W_LP:
+        bits.put(0, 1)
+      bits.put_ue(rng.randint(0, 63))
+      bits.put_ue(slice_type)
+      bits.put(rng.getrandbits(64), 64)
+      dat += nal_unit(nal_unit_type, bits.to_bytes() + rng.randbytes(rng.randint(0, 2000)), long_start_code=rng.random() < 0.2)
+
+    if rng.random() < 0.1:
+      dat += nal_unit(HevcNalUnitType.PREFIX_SEI_NUT, rng.randbytes(16))
+  return dat
+
+
+class TestVidIndex:
+  def test_get_ue(self):
+    rng = random.Random(0)
+    for _ in range(1000):
+      bits = BitWriter()
+      skip = rng.randint(0, 15)
+      bits.put(rng.getrandbits(skip), skip)
+      bits.put_ue(rng.randint(0, 2**rng.randint(0, 20)))
+      dat = bits.to_bytes() + b"\xff"
+      assert vidindex.get_ue(dat, 0, skip) == reference_get_ue(dat, 0, skip)
+
+  @pytest.mark.parametrize("seed", range(5))
+  def test_matches_reference(self, tmp_path, seed):
+    dat = make_stream(seed)
+    fn = str(tmp_path / "video.hevc")
+    with open(fn, "wb") as f:
+      f.write(dat)
+
+    expected = reference_hevc_index(dat)
+    assert len(expected[0]) == 60
+    assert hevc_index(fn) == expected
+
+  def test_cache_invalidated(self, tmp_path, monkeypatch):
+    fn = str(tmp_path / "video.hevc")
+    with open(fn, "wb") as f:
+      f.write(make_stream(0))
+    expected = reference_hevc_index(make_stream(0))
+    assert cached_hevc_index(fn) == expected
+    assert os.path.isfile(fn + vidindex.VIDEO_INDEX_EXT)
+
+    # served from the cache
+    with monkeypatch.context() as m:
+      m.setattr(vidindex, "hevc_index", lambda *args, **kwargs: pytest.fail("index should be cached"))
+      assert cached_hevc_index(fn) == expected
+
+    # the video changed, the index is rebuilt
+    with open(fn, "wb") as f:
+      f.write(make_stream(1, frames=30))
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert cached_hevc_index(fn) == reference_hevc_index(make_stream(1, frames=30))
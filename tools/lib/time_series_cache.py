@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import urllib.parse
+from functools import cache
+from hashlib import sha256
+
+import numpy as np
+
+from cereal import CEREAL_PATH
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR
+from openpilot.tools.lib.log_index import log_index_key
+
+# bump when the on-disk layout or the extraction output changes
+TIME_SERIES_CACHE_VERSION = 2
+TIME_SERIES_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "time_series")
+SCHEMA_FILES = ("log.capnp", "car.capnp", "custom.capnp", "legacy.capnp")
+
+# object columns (ragged lists, nested structs) can't be memory-mapped and are pickled instead
+OBJECT_SUFFIX = ".obj.npy"
+
+
+@cache
+def schema_version() -> str:
+  h = sha256()
+  for fn in SCHEMA_FILES:
+    with open(os.path.join(CEREAL_PATH, fn), "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()[:16]
+
+
+def time_series_cache_path(fn: str, cache_dir: str = TIME_SERIES_CACHE_DIR) -> str:
+  key = f"{log_index_key(fn)}:{schema_version()}:{TIME_SERIES_CACHE_VERSION}"
+  return os.path.join(cache_dir, sha256(key.encode()).hexdigest())
+
+
+def save_time_series(path: str, ts: dict) -> None:
+  """Writes one .npy file per column, the directory is moved in place atomically once complete."""
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+  try:
+    for typ, group in ts.items():
+      os.makedirs(os.path.join(tmp, typ))
+      for name, arr in group.items():
+        col_fn = os.path.join(tmp, typ, urllib.parse.quote(name, safe=""))
+        if arr.dtype == object:
+          np.save(col_fn + OBJECT_SUFFIX, arr, allow_pickle=True)
+        else:
+          np.save(col_fn + ".npy", arr, allow_pickle=False)
+    os.replace(tmp, path)
+  except OSError:
+    # another process finished the same entry first
+    if not os.path.isdir(path):
+      raise
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load_time_series(path: str) -> dict | None:
+  """Memory-maps the columns of a cached time series, None if it isn't cached."""
+  if not os.path.isdir(path):
+    return None
+
+  ts = {}
+  for typ in os.listdir(path):
+    group = ts[typ] = {}
+    for col_fn in os.listdir(os.path.join(path, typ)):
+      full_fn = os.path.join(path, typ, col_fn)
+      if col_fn.endswith(OBJECT_SUFFIX):
+        group[urllib.parse.unquote(col_fn.removesuffix(OBJECT_SUFFIX))] = np.load(full_fn, allow_pickle=True)
+      else:
+        group[urllib.parse.unquote(col_fn.removesuffix(".npy"))] = np.load(full_fn, mmap_mode="r")
+  return ts
@@ -1,7 +1,10 @@
 import logging
 import os
 import socket
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -12,6 +15,11 @@ from openpilot.system.hardware.hw import Paths
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+#  Missing chunks of a read are downloaded concurrently
+DOWNLOAD_THREADS = int(os.environ.get("FILEREADER_DOWNLOAD_THREADS", "8"))
+#  Least recently used chunks are evicted once the download cache is above this size
+CACHE_SIZE_LIMIT = int(os.environ.get("FILEREADER_CACHE_SIZE_MB", "10000")) * K * K
+CACHE_EVICT_TARGET = 0.9
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -23,12 +31,64 @@ class URLFileException(Exception):
   pass
 
 
+class ChunkCacheIndex:
+  """
+  LRU bookkeeping of the chunks in the download cache. Seeded once from the cache
+  directory (mtime is the last use), then kept up to date in-process.
+  """
+  def __init__(self, root: str, limit: int = CACHE_SIZE_LIMIT):
+    self.root = root
+    self.limit = limit
+    self.lock = threading.Lock()
+    self.entries: OrderedDict[str, int] = OrderedDict()
+    self.size = 0
+
+    with os.scandir(root) as it:
+      files = [(e.stat().st_mtime, e.name, e.stat().st_size) for e in it if e.is_file() and not e.name.endswith("_length")]
+    for _, name, size in sorted(files):
+      self.entries[name] = size
+      self.size += size
+
+  def touch(self, name: str) -> None:
+    with self.lock:
+      if name in self.entries:
+        self.entries.move_to_end(name)
+    try:
+      os.utime(os.path.join(self.root, name))
+    except FileNotFoundError:
+      pass
+
+  def add(self, name: str, size: int) -> None:
+    with self.lock:
+      self.size += size - self.entries.pop(name, 0)
+      self.entries[name] = size
+      if self.size > self.limit:
+        self._evict()
+
+  def _evict(self) -> None:
+    while self.entries and self.size > self.limit * CACHE_EVICT_TARGET:
+      name, size = self.entries.popitem(last=False)
+      self.size -= size
+      try:
+        os.unlink(os.path.join(self.root, name))
+      except FileNotFoundError:
+        pass
+
+
 class URLFile:
   _pool_manager: PoolManager|None = None
+  _cache_index: ChunkCacheIndex|None = None
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._cache_index = None
+
+  @staticmethod
+  def cache_index() -> ChunkCacheIndex:
+    if URLFile._cache_index is None:
+      URLFile._cache_index = ChunkCacheIndex(Paths.download_cache_root())
+    return URLFile._cache_index
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -85,6 +145,23 @@ class URLFile:
         file_length.write(str(self._length))
     return self._length
 
+  def _get_chunk(self, position: int) -> bytes:
+    chunk_number = position / CHUNK_SIZE
+    file_name = hash_256(self._url) + "_" + str(chunk_number)
+    full_path = os.path.join(Paths.download_cache_root(), str(file_name))
+    #  If we don't have a file, download it
+    if not os.path.exists(full_path):
+      data = self._read_range(position, CHUNK_SIZE)
+      with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
+        new_cached_file.write(data)
+      URLFile.cache_index().add(file_name, len(data))
+      return data
+
+    with open(full_path, "rb") as cached_file:
+      data = cached_file.read()
+    URLFile.cache_index().touch(file_name)
+    return data
+
   def read(self, ll: int|None=None) -> bytes:
     if self._force_download:
       return self.read_aux(ll=ll)
@@ -93,41 +170,42 @@ class URLFile:
     file_end = self._pos + ll if ll is not None else self.get_length()
     assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
     #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    positions = range((file_begin // CHUNK_SIZE) * CHUNK_SIZE, max(file_end, file_begin + 1), CHUNK_SIZE)
+    if len(positions) > 1 and DOWNLOAD_THREADS > 1:
+      self.get_length()
+      with ThreadPoolExecutor(max_workers=min(DOWNLOAD_THREADS, len(positions))) as executor:
+        chunks = list(executor.map(self._get_chunk, positions))
+    else:
+      chunks = [self._get_chunk(position) for position in positions]
+
+    #  Assemble into a single preallocated buffer
+    response = bytearray(max(0, file_end - file_begin))
+    written = 0
+    for position, data in zip(positions, chunks, strict=True):
+      piece = memoryview(data)[max(0, file_begin - position): max(0, min(CHUNK_SIZE, file_end - position))]
+      response[written:written + len(piece)] = piece
+      written += len(piece)
+    del response[written:]
+
+    self._pos = file_end
+    return bytes(response)
 
   def read_aux(self, ll: int|None=None) -> bytes:
+    ret = self._read_range(self._pos, ll)
+    self._pos += len(ret)
+    return ret
+
+  def _read_range(self, pos: int, ll: int|None=None) -> bytes:
     download_range = False
     headers = {}
-    if self._pos != 0 or ll is not None:
+    if pos != 0 or ll is not None:
       if ll is None:
         end = self.get_length() - 1
       else:
-        end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+        end = min(pos + ll, self.get_length()) - 1
+      if pos >= end:
         return b""
-      headers['Range'] = f"bytes={self._pos}-{end}"
+      headers['Range'] = f"bytes={pos}-{end}"
       download_range = True
 
     if self._debug:
@@ -149,7 +227,6 @@ class URLFile:
     if (not download_range) and response_code != 200:  # OK
       raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
 
-    self._pos += len(ret)
     return ret
 
   def seek(self, pos:int) -> None:
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 import argparse
+import mmap
 import os
 import struct
 from enum import IntEnum
 
-from openpilot.tools.lib.filereader import FileReader
+import numpy as np
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import file_cache_key, sidecar_path_for_file_path
+from openpilot.tools.lib.filereader import FileReader, resolve_name
 
 DEBUG = int(os.getenv("DEBUG", "0"))
 
@@ -18,6 +23,10 @@ NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
 
+# bump when the on-disk layout changes, old indexes are rebuilt
+VIDEO_INDEX_VERSION = 1
+VIDEO_INDEX_EXT = ".vidindex.npz"
+
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
   TRAIL_R = 1         # RBSP structure: slice_segment_layer_rbsp( )
@@ -120,32 +129,18 @@ class VideoFileInvalid(Exception):
   pass
 
 def get_ue(dat: bytes, start_idx: int, skip_bits: int) -> tuple[int, int]:
-  prefix_val = 0
-  prefix_len = 0
-  suffix_val = 0
-  suffix_len = 0
-
-  i = start_idx
-  while i < len(dat):
-    j = 7
-    while j >= 0:
-      if skip_bits > 0:
-        skip_bits -= 1
-      elif prefix_val == 0:
-        prefix_val = (dat[i] >> j) & 1
-        prefix_len += 1
-      else:
-        suffix_val = (suffix_val << 1) | ((dat[i] >> j) & 1)
-        suffix_len += 1
-      j -= 1
-
-      if prefix_val == 1 and prefix_len - 1 == suffix_len:
-        val = 2**(prefix_len-1) - 1 + suffix_val
-        size = prefix_len + suffix_len
-        return val, size
-    i += 1
-
-  raise VideoFileInvalid("invalid exponential-golomb code")
+  # unsigned Exp-Golomb code: N leading zero bits, a one bit, then N suffix bits
+  # read a 64 bit window starting at the code and count the leading zeros with bit_length
+  byte_idx = start_idx + skip_bits // 8
+  window = dat[byte_idx:byte_idx + 8]
+  num_bits = len(window) * 8 - skip_bits % 8
+  bits = int.from_bytes(window, "big") & ((1 << num_bits) - 1)
+
+  leading_zeros = num_bits - bits.bit_length()
+  size = 2 * leading_zeros + 1
+  if bits == 0 or size > num_bits:
+    raise VideoFileInvalid("invalid exponential-golomb code")
+  return (bits >> (num_bits - size)) - 1, size
 
 def require_nal_unit_start(dat: bytes, nal_unit_start: int) -> None:
   if nal_unit_start < 1:
@@ -258,10 +253,15 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
-def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
-  with FileReader(hevc_file_name) as f:
-    dat = f.read()
+def find_nal_unit_starts(dat) -> np.ndarray:
+  # vectorized scan for 0x000001 start codes, returns the index of each start code
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  candidates = np.flatnonzero(arr[2:] == 1)
+  starts = candidates[(arr[candidates] == 0) & (arr[candidates + 1] == 0)]
+  del arr
+  return starts
 
+def _hevc_index(dat, allow_corrupt: bool) -> tuple[list, int, bytes]:
   if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
     raise VideoFileInvalid("data is too short")
 
@@ -271,19 +271,21 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
   prefix_dat = b""
   frame_types = list()
 
+  # NAL units span from one start code to the next
+  starts = find_nal_unit_starts(dat).tolist()
+  ends = starts[1:] + [len(dat)]
+
   i = 1 # skip past first byte 0x00
   try:
-    while i < len(dat):
-      require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
+    require_nal_unit_start(dat, i)
+    for i, end in zip(starts, ends, strict=True):
       nal_unit_type = get_hevc_nal_unit_type(dat, i)
       if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
+        prefix_dat += dat[i:end]
       elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
         slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
         if is_first_slice:
           frame_types.append((slice_type, i))
-      i += nal_unit_len
   except Exception as e:
     if not allow_corrupt:
       raise
@@ -291,6 +293,34 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
 
   return frame_types, len(dat), prefix_dat
 
+def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  fn = resolve_name(hevc_file_name)
+  if fn.startswith(("http://", "https://")) or os.path.getsize(fn) == 0:
+    with FileReader(fn) as f:
+      return _hevc_index(f.read(), allow_corrupt)
+
+  # local files are memory-mapped instead of read
+  with open(fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dat:
+    return _hevc_index(dat, allow_corrupt)
+
+def cached_hevc_index(hevc_file_name: str) -> tuple[list, int, bytes]:
+  """hevc_index, stored next to the video (or in the cache dir) and reused until the video changes"""
+  key = file_cache_key(hevc_file_name)
+  path = sidecar_path_for_file_path(hevc_file_name, VIDEO_INDEX_EXT)
+  try:
+    with np.load(path, allow_pickle=False) as cached:
+      if int(cached['version']) == VIDEO_INDEX_VERSION and str(cached['key']) == key:
+        return [tuple(ft) for ft in cached['frame_types'].tolist()], int(cached['dat_len']), cached['prefix'].tobytes()
+  except (OSError, KeyError, ValueError):
+    pass
+
+  frame_types, dat_len, prefix_dat = hevc_index(hevc_file_name)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    np.savez(f, version=np.array(VIDEO_INDEX_VERSION), key=np.array(key), dat_len=np.array(dat_len),
+             frame_types=np.array(frame_types, dtype=np.int64).reshape(-1, 2), prefix=np.frombuffer(prefix_dat, dtype=np.uint8))
+  return frame_types, dat_len, prefix_dat
+
 def main() -> None:
   parser = argparse.ArgumentParser()
   parser.add_argument("input_file", type=str)
@@ -33,11 +33,11 @@ segments = r.json()[camera]
 if segment >= len(segments):
   raise Exception(f"segment {segment} not found, got {len(segments)} segments")
 
-fr = FrameReader(segments[segment])
-if frame >= fr.frame_count:
-  raise Exception("frame {frame} not found, got {fr.frame_count} frames")
+with FrameReader(segments[segment]) as fr:
+  if frame >= fr.frame_count:
+    raise Exception("frame {frame} not found, got {fr.frame_count} frames")
 
-im = Image.fromarray(fr.get(frame))
+  im = Image.fromarray(fr.get(frame))
 fn = f"uxxx_{route.replace('|', '_')}_{segment}_{frame}.png"
 im.save(fn)
 print(f"saved {fn}")